@@ -1,13 +1,13 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
 from flask_babel import Babel
 from flask_socketio import SocketIO
+from backend.database import TunedSQLAlchemy
 
 # Initialize extensions
-db = SQLAlchemy()
+db = TunedSQLAlchemy()
 bcrypt = Bcrypt()
 jwt = JWTManager()
 migrate = Migrate()
@@ -1,13 +1,17 @@
 from flask import Flask, request, jsonify, make_response
 from flask import Flask, request, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, unset_jwt_cookies
+from flask_jwt_extended import JWTManager, create_access_token, decode_token, jwt_required, get_jwt_identity, unset_jwt_cookies
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
 from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
 from flask_babel import Babel, _
 from flask_socketio import SocketIO, join_room, leave_room, send, emit
 import os
+import json
+from datetime import datetime
+import click
 import logging
 from logging.handlers import RotatingFileHandler
 from flask_limiter import Limiter
@@ -20,22 +24,112 @@ app = Flask(__name__)
 # Configure the database URI and other settings
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Database performance profile: pooling for every database, WAL and pragmas for SQLite
+app.config['DB_TUNING'] = os.getenv('DB_TUNING', 'true').lower() == 'true'
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+app.config['SQLALCHEMY_READ_URI'] = os.getenv('SQLALCHEMY_READ_URI')
+# Comma-separated read replicas for GET endpoints, and how long a user's own writes pin their reads to the primary
+app.config['SQLALCHEMY_REPLICA_URIS'] = [uri for uri in os.getenv('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri]
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+app.config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_CACHE_SIZE'] = int(os.getenv('SQLITE_CACHE_SIZE', -64000))
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your_secret_key')
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your_jwt_secret_key')
 app.config['BABEL_DEFAULT_LOCALE'] = 'en'
+app.config['PROBLEM_CATALOG_ENABLED'] = os.getenv('PROBLEM_CATALOG_ENABLED', 'true').lower() == 'true'
+app.config['PROBLEM_CATALOG_TTL'] = int(os.getenv('PROBLEM_CATALOG_TTL', 300))
+app.config['PROBLEM_CATALOG_MAX_BYTES'] = int(os.getenv('PROBLEM_CATALOG_MAX_BYTES', 64 * 1024 * 1024))
+app.config['PAGE_SIZE_DEFAULT'] = int(os.getenv('PAGE_SIZE_DEFAULT', 50))
+app.config['PAGE_SIZE_MAX'] = int(os.getenv('PAGE_SIZE_MAX', 200))
+app.config['EXPORT_CHUNK_SIZE'] = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+app.config['EXPORT_GZIP_LEVEL'] = int(os.getenv('EXPORT_GZIP_LEVEL', 6))
+app.config['INGEST_CHUNK_SIZE'] = int(os.getenv('INGEST_CHUNK_SIZE', 1000))
+app.config['INGEST_MAX_CHUNK_SIZE'] = int(os.getenv('INGEST_MAX_CHUNK_SIZE', 10000))
+app.config['INGEST_MAX_ERRORS'] = int(os.getenv('INGEST_MAX_ERRORS', 1000))
+app.config['WRITE_BEHIND_ENABLED'] = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+app.config['WRITE_BEHIND_FLUSH_MS'] = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 50))
+app.config['WRITE_BEHIND_BATCH_SIZE'] = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 500))
+app.config['WRITE_BEHIND_MAX_QUEUE'] = int(os.getenv('WRITE_BEHIND_MAX_QUEUE', 10000))
+app.config['WRITE_BEHIND_ENQUEUE_TIMEOUT_MS'] = int(os.getenv('WRITE_BEHIND_ENQUEUE_TIMEOUT_MS', 50))
+app.config['WRITE_BEHIND_SPILL_PATH'] = os.getenv('WRITE_BEHIND_SPILL_PATH', 'logs/write_behind.ndjson')
+app.config['WRITE_BEHIND_FSYNC'] = os.getenv('WRITE_BEHIND_FSYNC', 'true').lower() == 'true'
+app.config['WRITE_BEHIND_SPILL_MAX_BYTES'] = int(os.getenv('WRITE_BEHIND_SPILL_MAX_BYTES', 16 * 1024 * 1024))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_EXECUTOR'] = os.getenv('PASSWORD_HASH_EXECUTOR', 'auto')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 4 * (os.cpu_count() or 1)))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 30))
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+app.config['WHITEBOARD_BATCHING'] = os.getenv('WHITEBOARD_BATCHING', 'true').lower() == 'true'
+app.config['WHITEBOARD_TICK_HZ'] = float(os.getenv('WHITEBOARD_TICK_HZ', 30))
+app.config['WHITEBOARD_MAX_FRAME_POINTS'] = int(os.getenv('WHITEBOARD_MAX_FRAME_POINTS', 2000))
+app.config['WHITEBOARD_MAX_PENDING_POINTS'] = int(os.getenv('WHITEBOARD_MAX_PENDING_POINTS', 20000))
+app.config['WHITEBOARD_DROP_POLICY'] = os.getenv('WHITEBOARD_DROP_POLICY', 'drop_oldest')
+app.config['WHITEBOARD_SIMPLIFY_EPSILON'] = float(os.getenv('WHITEBOARD_SIMPLIFY_EPSILON', 1.0))
+app.config['WHITEBOARD_MAX_COORDINATE'] = int(os.getenv('WHITEBOARD_MAX_COORDINATE', 100000))
+app.config['WHITEBOARD_MAX_LINE_WIDTH'] = int(os.getenv('WHITEBOARD_MAX_LINE_WIDTH', 1000))
+app.config['WHITEBOARD_COMPACT_EVERY'] = int(os.getenv('WHITEBOARD_COMPACT_EVERY', 100))
+app.config['WHITEBOARD_ROOM_MAX_BYTES'] = int(os.getenv('WHITEBOARD_ROOM_MAX_BYTES', 1024 * 1024))
+app.config['WHITEBOARD_STATE_IDLE_SECONDS'] = int(os.getenv('WHITEBOARD_STATE_IDLE_SECONDS', 300))
+app.config['WHITEBOARD_STATE_DIR'] = os.getenv('WHITEBOARD_STATE_DIR', 'whiteboards')
+app.config['SLOW_QUERY_MS'] = int(os.getenv('SLOW_QUERY_MS', 200))
+app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 1000))
+app.config['LOG_MAX_BYTES'] = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['HTTP_CACHE_ENABLED'] = os.getenv('HTTP_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['HTTP_CACHE_TTL'] = int(os.getenv('HTTP_CACHE_TTL', 30))
+app.config['HTTP_CACHE_MAX_BYTES'] = int(os.getenv('HTTP_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+app.config['SOCKETIO_CHANNEL'] = os.getenv('SOCKETIO_CHANNEL', 'intelligent-math-tutor')
+app.config['SOCKET_SID_MESSAGE_RATE'] = float(os.getenv('SOCKET_SID_MESSAGE_RATE', 5))
+app.config['SOCKET_ROOM_MESSAGE_RATE'] = float(os.getenv('SOCKET_ROOM_MESSAGE_RATE', 50))
+app.config['SOCKET_SID_DRAW_RATE'] = float(os.getenv('SOCKET_SID_DRAW_RATE', 120))
+app.config['SOCKET_ROOM_DRAW_RATE'] = float(os.getenv('SOCKET_ROOM_DRAW_RATE', 1000))
+app.config['SOCKET_BURST_SECONDS'] = float(os.getenv('SOCKET_BURST_SECONDS', 2))
+app.config['SOCKET_MAX_ROOMS_PER_SID'] = int(os.getenv('SOCKET_MAX_ROOMS_PER_SID', 20))
+app.config['HOT_RANKER_ENABLED'] = os.getenv('HOT_RANKER_ENABLED', 'true').lower() == 'true'
+app.config['HOT_RECOMPUTE_SECONDS'] = int(os.getenv('HOT_RECOMPUTE_SECONDS', 300))
+app.config['HOT_WINDOW_DAYS'] = int(os.getenv('HOT_WINDOW_DAYS', 7))
+app.config['HOT_GRAVITY'] = float(os.getenv('HOT_GRAVITY', 1.8))
+app.config['SEARCH_MAX_OFFSET'] = int(os.getenv('SEARCH_MAX_OFFSET', 1000))
+app.config['RATING_RECOMMENDER'] = os.getenv('RATING_RECOMMENDER', 'false').lower() == 'true'
+app.config['RATING_K'] = float(os.getenv('RATING_K', 0.4))
+app.config['RATING_K_MIN'] = float(os.getenv('RATING_K_MIN', 0.05))
+app.config['RATING_TARGET_SUCCESS'] = float(os.getenv('RATING_TARGET_SUCCESS', 0.7))
+app.config['RATING_WINDOW'] = float(os.getenv('RATING_WINDOW', 0.25))
+app.config['RATING_MAX_WINDOW'] = float(os.getenv('RATING_MAX_WINDOW', 4.0))
+app.config['BATCH_RECOMMEND_MAX_USERS'] = int(os.getenv('BATCH_RECOMMEND_MAX_USERS', 500))
+app.config['NOTIFY_FANOUT_ENABLED'] = os.getenv('NOTIFY_FANOUT_ENABLED', 'true').lower() == 'true'
+app.config['NOTIFY_CHUNK_SIZE'] = int(os.getenv('NOTIFY_CHUNK_SIZE', 1000))
+app.config['FEED_GRAPH_TTL'] = int(os.getenv('FEED_GRAPH_TTL', 300))
+app.config['FEED_TIMELINE_SIZE'] = int(os.getenv('FEED_TIMELINE_SIZE', 500))
+app.config['FEED_MAX_TIMELINES'] = int(os.getenv('FEED_MAX_TIMELINES', 10000))
 
 # Initialize extensions
-db = SQLAlchemy(app)
+# The models are declared against the shared backend.db instance, so bind that one here
+from backend import db
+from backend.database import reads, run_db_benchmark
+db.init_app(app)
+db.app = app
+reads.init_app(app, db)
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 migrate = Migrate(app, db)
 babel = Babel(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# SOCKETIO_MESSAGE_QUEUE shares rooms between worker processes (see backend/bus.py)
+from backend.bus import RoomBus, run_load_test, room_size, socketio_options
+socketio = SocketIO(app, cors_allowed_origins="*", **socketio_options(app.config))
 
 # Set up logging
 if not os.path.exists('logs'):
     os.mkdir('logs')
-file_handler = RotatingFileHandler('logs/app.log', maxBytes=10240, backupCount=10)
+file_handler = RotatingFileHandler('logs/app.log', maxBytes=app.config['LOG_MAX_BYTES'], backupCount=10)
 file_handler.setFormatter(logging.Formatter(
     '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
 file_handler.setLevel(logging.INFO)
@@ -52,8 +146,48 @@ limiter = Limiter(
 )
 
 # Import models after initializing extensions to avoid circular imports
-from backend.models import User, Progress, Problem, Feedback, Badge, Notification, Tutorial, LearningPath, Hint, Comment, Vote, Report, Follow, Message, Discussion, DiscussionTopic, DiscussionPost
-from backend.utils import recommend_problem
+from backend.models import User, Progress, Problem, Feedback, Badge, Notification, Tutorial, LearningPath, Hint, Comment, ForumPost, Vote, Report, Follow, Message, Discussion, DiscussionTopic, DiscussionPost, ConversationParticipant
+from backend.utils import recommend_group, recommend_problem
+from backend.catalog import catalog
+from backend.stats import get_performance, rebuild_user_stats
+from backend.ratings import recalibrate_ratings, run_rating_benchmark
+from backend.pagination import PaginationError, keyset_page, parse_limit
+from backend.export import EXPORTS, FORMATS, export_response, wants_gzip
+from backend.ingest import SPECS as INGEST_SPECS, InvalidRecord, ingest, parse_ndjson
+from backend.writebehind import MODELS as WRITE_MODELS, QueueFull, write_queue
+from backend.hashing import HasherSaturated, password_hasher
+from backend.identity import STAFF_ROLES, identity_for, is_stale, is_staff, user_cache
+from backend.whiteboard import board_store, draw_aggregator, share_boards
+from backend.presence import presence, valid_room
+from backend.http_cache import response_cache
+from backend.metrics import request_metrics
+from backend.engagement import COMMENT_AGGREGATES, hot_ranker, rebuild_vote_scores, recompute_hot_scores
+from backend.search import KINDS as SEARCH_KINDS, SearchUnavailable, create_search_index, rebuild_search_index, run_search_benchmark, search
+from backend.notifications import mark_all_read, notifier, rebuild_unread_counts, unread_count, user_room
+from backend.social import feed_page, social_graph
+from backend.conversations import backfill_conversations, mark_conversation_read
+
+# Start the write-behind worker when that mode is enabled (flushes on shutdown)
+write_queue.init_app(app)
+password_hasher.init_app(app)
+draw_aggregator.init_app(app, socketio)
+board_store.init_app(app)
+if isinstance(socketio.server.manager, RoomBus):
+    share_boards(socketio.server.manager, socketio)
+presence.init_app(app)
+request_metrics.init_app(app)
+hot_ranker.init_app(app)
+notifier.init_app(app, socketio)
+social_graph.init_app(app)
+
+# Once per process, when it starts serving: make sure the FTS5 search table exists
+# (migrations do not create it) and start the notification worker and, if enabled,
+# the hot-score refresh
+@app.before_first_request
+def start_background_work():
+    create_search_index()
+    notifier.start()
+    hot_ranker.start()
 
 @babel.localeselector
 def get_locale():
@@ -71,6 +205,49 @@ def unauthorized(error):
     app.logger.error(f'Unauthorized: {error}')
     return jsonify({'message': _('Unauthorized'), 'details': str(error)}), 401
 
+# Reject tokens whose claims were issued before the user's last profile change
+@jwt.token_in_blocklist_loader
+def token_is_stale(jwt_header, jwt_payload):
+    return is_stale(jwt_payload['sub'])
+
+# Password hashing pool is saturated or too slow; shed load instead of queueing behind it
+@app.errorhandler(HasherSaturated)
+def hashing_saturated(error):
+    app.logger.warning('Password hashing pool saturated')
+    response = jsonify({'message': _('Server busy, please retry')})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Invalid limit/after/fields query parameters on list endpoints
+@app.errorhandler(PaginationError)
+def invalid_page_request(error):
+    return bad_request(_(str(error)))
+
+# Build a list response, passing the next-page cursor in a header
+def page_response(items, next_cursor):
+    response = jsonify(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# Insert a new row now, or hand it to the write-behind queue and answer 202 with its event id
+def create_record(kind, fields, success_message, error_message):
+    if write_queue.enabled:
+        try:
+            event_id = write_queue.enqueue(kind, {**fields, 'timestamp': datetime.utcnow()})
+        except QueueFull:
+            return jsonify({'message': _('Server busy, please retry')}), 503
+        return jsonify({'message': success_message, 'event_id': event_id}), 202
+
+    db.session.add(WRITE_MODELS[kind](**fields))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': error_message}), 500
+
+    return jsonify({'message': success_message}), 201
+
 # User registration endpoint
 @app.route('/register', methods=['POST'])
 def register():
@@ -85,7 +262,7 @@ def register():
     if User.query.filter_by(email=email).first() or User.query.filter_by(username=username).first():
         return bad_request(_('User already exists'))
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = password_hasher.generate_password_hash(password)
     new_user = User(username=username, email=email, password=hashed_password)
     db.session.add(new_user)
     try:
@@ -108,8 +285,8 @@ def login():
         return bad_request(_('Missing email or password'))
 
     user = User.query.filter_by(email=email).first()
-    if user and bcrypt.check_password_hash(user.password, password):
-        access_token = create_access_token(identity={'user_id': user.id, 'username': user.username, 'email': user.email})
+    if user and password_hasher.check_password_hash(user.password, password):
+        access_token = create_access_token(identity=identity_for(user))
         response = jsonify({'access_token': access_token})
         return response, 200
 
@@ -127,14 +304,12 @@ def logout():
 @app.route('/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
+    # Claims were checked against the current token version, so they are the profile
     current_user = get_jwt_identity()
-    user = User.query.filter_by(id=current_user['user_id']).first()
-    if user:
-        return jsonify({
-            'username': user.username,
-            'email': user.email
-        }), 200
-    return jsonify({'message': _('User not found')}), 404
+    return jsonify({
+        'username': current_user['username'],
+        'email': current_user['email']
+    }), 200
 
 # Update user profile endpoint
 @app.route('/profile', methods=['PUT'])
@@ -146,8 +321,18 @@ def update_profile():
     if user:
         user.username = data.get('username', user.username)
         user.email = data.get('email', user.email)
-        db.session.commit()
-        return jsonify({'message': _('Profile updated successfully')}), 200
+        user.token_version = (user.token_version or 0) + 1
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'message': _('Error updating profile')}), 500
+        user_cache.invalidate(user.id)
+        # Tokens carrying the old claims are now rejected; hand back a fresh one
+        return jsonify({
+            'message': _('Profile updated successfully'),
+            'access_token': create_access_token(identity=identity_for(user))
+        }), 200
     return jsonify({'message': _('User not found')}), 404
 
 # Get user dashboard data endpoint
@@ -155,44 +340,88 @@ def update_profile():
 @jwt_required()
 def get_dashboard():
     current_user = get_jwt_identity()
-    user = User.query.filter_by(id=current_user['user_id']).first()
-    if user:
-        progress = Progress.query.filter_by(user_id=user.id).all()
-        total_problems = len(progress)
-        correct_answers = sum(1 for p in progress if p.status == 'completed')
-        incorrect_answers = total_problems - correct_answers
-        performance_ratio = correct_answers / total_problems if total_problems else 0
-        return jsonify({
-            'username': user.username,
-            'email': user.email,
-            'total_problems': total_problems,
-            'correct_answers': correct_answers,
-            'incorrect_answers': incorrect_answers,
-            'performance_ratio': performance_ratio
-        }), 200
-    return jsonify({'message': _('User not found')}), 404
+    performance = get_performance(current_user['user_id'])
+    return jsonify({
+        'username': current_user['username'],
+        'email': current_user['email'],
+        **performance
+    }), 200
 
 # Get user analytics endpoint
 @app.route('/analytics', methods=['GET'])
 @jwt_required()
 def get_analytics():
     current_user = get_jwt_identity()
-    user = User.query.filter_by(id=current_user['user_id']).first()
-    if user:
-        progress = Progress.query.filter_by(user_id=user.id).all()
-        total_problems = len(progress)
-        correct_answers = sum(1 for p in progress if p.status == 'completed')
-        incorrect_answers = total_problems - correct_answers
-        performance_ratio = correct_answers / total_problems if total_problems else 0
-        feedback_count = Feedback.query.filter_by(user_id=user.id).count()
+    performance = get_performance(current_user['user_id'])
+    feedback_count = reads.query(Feedback).filter_by(user_id=current_user['user_id']).count()
+    return jsonify({
+        **performance,
+        'feedback_count': feedback_count
+    }), 200
+
+# Recommend an unsolved problem for a user
+@app.route('/recommend/<int:user_id>', methods=['GET'])
+@jwt_required()
+def recommend(user_id):
+    problem = recommend_problem(user_id)
+    if problem:
         return jsonify({
-            'total_problems': total_problems,
-            'correct_answers': correct_answers,
-            'incorrect_answers': incorrect_answers,
-            'performance_ratio': performance_ratio,
-            'feedback_count': feedback_count
+            'problem_id': problem.id,
+            'question': problem.question,
+            'difficulty': problem.difficulty,
+            'feedback': problem.feedback
         }), 200
-    return jsonify({'message': _('User not found')}), 404
+    return jsonify({'message': _('No problem available')}), 404
+
+# Track progress on a problem
+@app.route('/progress', methods=['POST'])
+@jwt_required()
+def track_progress():
+    data = request.get_json()
+    current_user = get_jwt_identity()
+    # Progress is recorded for the caller; teachers and admins may record it for another user
+    user_id = data.get('user_id', current_user['user_id'])
+    problem_id = data.get('problem_id')
+    status = data.get('status')
+
+    if not user_id or not problem_id or not status:
+        return bad_request(_('Missing user_id, problem_id or status'))
+    if user_id != current_user['user_id'] and not is_staff(current_user):
+        return jsonify({'message': _('Forbidden')}), 403
+
+    return create_record('progress', {'user_id': user_id, 'problem_id': problem_id, 'status': status},
+                         _('Progress tracked successfully'), _('Error tracking progress'))
+
+# Get progress for a user
+@app.route('/progress/<int:user_id>', methods=['GET'])
+@jwt_required()
+def get_progress(user_id):
+    current_user = get_jwt_identity()
+    if user_id != current_user['user_id'] and not is_staff(current_user):
+        return jsonify({'message': _('Forbidden')}), 403
+    progress, next_cursor = keyset_page(reads.query(Progress).filter_by(user_id=user_id), Progress,
+                                        ('id', 'problem_id', 'status', 'timestamp'))
+    return page_response(progress, next_cursor), 200
+
+# Recommend problems for a whole group of users at once (e.g. a classroom session).
+# With "unique": true no two users in the group get the same problem.
+@app.route('/recommend/batch', methods=['POST'])
+@jwt_required()
+def recommend_for_group():
+    data = request.get_json() or {}
+    user_ids = data.get('user_ids')
+    if not isinstance(user_ids, list) or not user_ids or \
+            not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+        return bad_request(_('user_ids must be a non-empty list of ids'))
+    if len(user_ids) > app.config['BATCH_RECOMMEND_MAX_USERS']:
+        return bad_request(_('Too many users'))
+    # Other users' ratings and performance are for teachers and admins
+    current_user = get_jwt_identity()
+    if any(user_id != current_user['user_id'] for user_id in user_ids) and not is_staff(current_user):
+        return jsonify({'message': _('Forbidden')}), 403
+
+    results = recommend_group(user_ids, unique=bool(data.get('unique')))
+    return jsonify([{'user_id': user_id, **results[user_id]} for user_id in dict.fromkeys(user_ids)]), 200
 
 # Create a learning path for a user
 @app.route('/learning-path', methods=['POST'])
@@ -204,23 +433,16 @@ def create_learning_path():
     if not path_description:
         return bad_request(_('Missing path description'))
 
-    new_path = LearningPath(user_id=get_jwt_identity()['user_id'], path_description=path_description)
-    db.session.add(new_path)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error creating learning path')}), 500
-
-    return jsonify({'message': _('Learning path created successfully')}), 201
+    return create_record('learning_path', {'user_id': get_jwt_identity()['user_id'], 'path_description': path_description},
+                         _('Learning path created successfully'), _('Error creating learning path'))
 
 # Get learning paths for a user
 @app.route('/learning-path/<int:user_id>', methods=['GET'])
 @jwt_required()
 def get_learning_paths(user_id):
-    paths = LearningPath.query.filter_by(user_id=user_id).all()
-    path_list = [{'id': p.id, 'path_description': p.path_description, 'timestamp': p.timestamp} for p in paths]
-    return jsonify(path_list), 200
+    paths, next_cursor = keyset_page(reads.query(LearningPath).filter_by(user_id=user_id), LearningPath,
+                                     ('id', 'path_description', 'timestamp'))
+    return page_response(paths, next_cursor), 200
 
 # Add a hint to a problem
 @app.route('/hint', methods=['POST'])
@@ -233,23 +455,17 @@ def add_hint():
     if not problem_id or not hint_text:
         return bad_request(_('Missing problem_id or hint_text'))
 
-    new_hint = Hint(problem_id=problem_id, hint_text=hint_text)
-    db.session.add(new_hint)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error adding hint')}), 500
-
-    return jsonify({'message': _('Hint added successfully')}), 201
+    return create_record('hint', {'problem_id': problem_id, 'hint_text': hint_text},
+                         _('Hint added successfully'), _('Error adding hint'))
 
 # Get hints for a problem
 @app.route('/hint/<int:problem_id>', methods=['GET'])
 @jwt_required()
+@response_cache.cached(lambda problem_id: ('hints', problem_id))
 def get_hints(problem_id):
-    hints = Hint.query.filter_by(problem_id=problem_id).all()
-    hint_list = [{'id': h.id, 'hint_text': h.hint_text, 'timestamp': h.timestamp} for h in hints]
-    return jsonify(hint_list), 200
+    hints, next_cursor = keyset_page(reads.query(Hint).filter_by(problem_id=problem_id), Hint,
+                                     ('id', 'hint_text', 'timestamp'))
+    return page_response(hints, next_cursor), 200
 
 # Add a comment to a discussion
 @app.route('/comment', methods=['POST'])
@@ -262,64 +478,154 @@ def add_comment():
     if not discussion_id or not comment_text:
         return bad_request(_('Missing discussion_id or comment_text'))
 
-    new_comment = Comment(discussion_id=discussion_id, user_id=get_jwt_identity()['user_id'], comment_text=comment_text)
-    db.session.add(new_comment)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error adding comment')}), 500
-
-    return jsonify({'message': _('Comment added successfully')}), 201
+    return create_record('comment', {'discussion_id': discussion_id, 'user_id': get_jwt_identity()['user_id'], 'comment_text': comment_text},
+                         _('Comment added successfully'), _('Error adding comment'))
 
 # Get comments for a discussion
 @app.route('/comment/<int:discussion_id>', methods=['GET'])
 @jwt_required()
 def get_comments(discussion_id):
-    comments = Comment.query.filter_by(discussion_id=discussion_id).all()
-    comment_list = [{'id': c.id, 'user_id': c.user_id, 'comment_text': c.comment_text, 'timestamp': c.timestamp} for c in comments]
-    return jsonify(comment_list), 200
+    comments, next_cursor = keyset_page(reads.query(Comment).filter_by(discussion_id=discussion_id), Comment,
+                                        ('id', 'user_id', 'comment_text', 'timestamp', 'score', 'vote_count'),
+                                        computed=COMMENT_AGGREGATES)
+    return page_response(comments, next_cursor), 200
+
+RANKINGS = {'hot': 'hot_score', 'top': 'score'}
+
+# Top-N by a ranking column, served from the (scope, ranking, id) indexes
+def ranked(query, model, ranking, fields):
+    column = getattr(model, RANKINGS[ranking])
+    rows = query.with_entities(*[getattr(model, name) for name in fields]) \
+        .order_by(column.desc(), model.id.desc()).limit(parse_limit()).all()
+    return jsonify([dict(zip(fields, row)) for row in rows]), 200
+
+# Get the hottest or best-scored comments of a discussion
+@app.route('/comment/<int:discussion_id>/<any(hot, top):ranking>', methods=['GET'])
+@jwt_required()
+def get_ranked_comments(discussion_id, ranking):
+    return ranked(reads.query(Comment).filter_by(discussion_id=discussion_id), Comment, ranking,
+                  ('id', 'user_id', 'comment_text', 'timestamp', 'score', 'vote_count'))
+
+# Create a forum post
+@app.route('/forum-post', methods=['POST'])
+@jwt_required()
+def add_forum_post():
+    data = request.get_json()
+    title = data.get('title')
+    content = data.get('content')
+
+    if not title or not content:
+        return bad_request(_('Missing title or content'))
+
+    return create_record('forum_post', {'user_id': get_jwt_identity()['user_id'], 'title': title, 'content': content},
+                         _('Forum post created successfully'), _('Error creating forum post'))
+
+# Get the hottest or best-scored forum posts
+@app.route('/forum-posts/<any(hot, top):ranking>', methods=['GET'])
+@jwt_required()
+def get_ranked_forum_posts(ranking):
+    return ranked(reads.query(ForumPost), ForumPost, ranking,
+                  ('id', 'user_id', 'title', 'timestamp', 'score', 'vote_count'))
+
+# Up- or downvote a forum post or comment; a value of 0 withdraws the vote.
+# The target's score and vote_count are kept in step by the Vote listeners in backend/engagement.py.
+@app.route('/vote', methods=['POST'])
+@jwt_required()
+def vote():
+    data = request.get_json()
+    post_id = data.get('post_id')
+    comment_id = data.get('comment_id')
+    value = data.get('value')
+
+    if bool(post_id) == bool(comment_id) or value not in (-1, 0, 1):
+        return bad_request(_('Provide either post_id or comment_id and a value of -1, 0 or 1'))
+
+    model, target_id = (ForumPost, post_id) if post_id else (Comment, comment_id)
+    target = db.session.get(model, target_id)
+    if target is None:
+        return jsonify({'message': _('Post or comment not found')}), 404
+
+    user_id = get_jwt_identity()['user_id']
+    # A concurrent first vote by the same user loses on the unique index; retry as an update
+    for attempt in range(2):
+        existing = Vote.query.filter_by(user_id=user_id, post_id=post_id or None, comment_id=comment_id or None).first()
+        if value == 0:
+            if existing is not None:
+                db.session.delete(existing)
+        elif existing is not None:
+            existing.value = value
+        else:
+            db.session.add(Vote(user_id=user_id, post_id=post_id or None, comment_id=comment_id or None, value=value))
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        return jsonify({'message': _('Error saving vote')}), 500
+
+    db.session.refresh(target)
+    return jsonify({'score': target.score, 'vote_count': target.vote_count}), 200
 
 # Follow a user
 @app.route('/follow/<int:followed_id>', methods=['POST'])
 @jwt_required()
 def follow_user(followed_id):
     current_user = get_jwt_identity()
-    user = User.query.filter_by(id=current_user['user_id']).first()
-    if user:
-        followed_user = User.query.get(followed_id)
-        if followed_user:
-            follow = Follow(follower_id=user.id, followed_id=followed_id)
-            db.session.add(follow)
-            try:
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
-                return jsonify({'message': _('Error following user')}), 500
-            return jsonify({'message': _('User followed successfully')}), 201
-        else:
-            return bad_request(_('User not found'))
-    return unauthorized(_('Unauthorized'))
+    if user_cache.get(followed_id):
+        follow = Follow(follower_id=current_user['user_id'], followed_id=followed_id)
+        db.session.add(follow)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'message': _('Error following user')}), 500
+        return jsonify({'message': _('User followed successfully')}), 201
+    return bad_request(_('User not found'))
 
 # Unfollow a user
 @app.route('/unfollow/<int:followed_id>', methods=['DELETE'])
 @jwt_required()
 def unfollow_user(followed_id):
     current_user = get_jwt_identity()
-    user = User.query.filter_by(id=current_user['user_id']).first()
-    if user:
-        follow = Follow.query.filter_by(follower_id=user.id, followed_id=followed_id).first()
-        if follow:
-            db.session.delete(follow)
-            try:
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
-                return jsonify({'message': _('Error unfollowing user')}), 500
-            return jsonify({'message': _('User unfollowed successfully')}), 200
-        else:
-            return bad_request(_('Not following this user'))
-    return unauthorized(_('Unauthorized'))
+    follow = Follow.query.filter_by(follower_id=current_user['user_id'], followed_id=followed_id).first()
+    if follow:
+        db.session.delete(follow)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'message': _('Error unfollowing user')}), 500
+        return jsonify({'message': _('User unfollowed successfully')}), 200
+    return bad_request(_('Not following this user'))
+
+# Discussion posts by the users the current user follows, newest first
+@app.route('/feed', methods=['GET'])
+@jwt_required()
+def get_feed():
+    posts, next_cursor = feed_page(get_jwt_identity()['user_id'])
+    return page_response(posts, next_cursor), 200
+
+# The current user's notifications, newest first; `unread=true` lists only unread ones.
+# The unread total comes from the maintained counter, in X-Unread-Count.
+@app.route('/notifications', methods=['GET'])
+@jwt_required()
+def get_notifications():
+    user_id = get_jwt_identity()['user_id']
+    query = reads.query(Notification).filter_by(user_id=user_id)
+    if request.args.get('unread', 'false').lower() == 'true':
+        query = query.filter_by(is_read=False)
+    notifications, next_cursor = keyset_page(query, Notification, ('id', 'message', 'date_sent', 'is_read'),
+                                             order_by='date_sent', descending=True)
+    response = page_response(notifications, next_cursor)
+    response.headers['X-Unread-Count'] = str(unread_count(user_id))
+    return response, 200
+
+# Mark all of the current user's notifications read
+@app.route('/notifications/read', methods=['POST'])
+@jwt_required()
+def read_notifications():
+    return jsonify({'marked_read': mark_all_read(get_jwt_identity()['user_id']), 'unread_count': 0}), 200
 
 # Send a private message
 @app.route('/message', methods=['POST'])
@@ -333,30 +639,63 @@ def send_message():
         return bad_request(_('Missing recipient_id or message_text'))
 
     current_user = get_jwt_identity()
-    new_message = Message(sender_id=current_user['user_id'], recipient_id=recipient_id, message_text=message_text)
-    db.session.add(new_message)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error sending message')}), 500
-
-    return jsonify({'message': _('Message sent successfully')}), 201
+    return create_record('message', {'sender_id': current_user['user_id'], 'recipient_id': recipient_id, 'message_text': message_text},
+                         _('Message sent successfully'), _('Error sending message'))
 
 # Get messages for a user
 @app.route('/messages', methods=['GET'])
 @jwt_required()
 def get_messages():
     current_user = get_jwt_identity()
-    received_messages = Message.query.filter_by(recipient_id=current_user['user_id']).all()
-    sent_messages = Message.query.filter_by(sender_id=current_user['user_id']).all()
+    received, received_cursor = keyset_page(reads.query(Message).filter_by(recipient_id=current_user['user_id']),
+                                            Message, ('id', 'sender_id', 'message_text', 'timestamp'),
+                                            after_param='received_after')
+    sent, sent_cursor = keyset_page(reads.query(Message).filter_by(sender_id=current_user['user_id']),
+                                    Message, ('id', 'recipient_id', 'message_text', 'timestamp'),
+                                    after_param='sent_after')
 
     messages = {
-        'received': [{'id': m.id, 'sender_id': m.sender_id, 'message_text': m.message_text, 'timestamp': m.timestamp} for m in received_messages],
-        'sent': [{'id': m.id, 'recipient_id': m.recipient_id, 'message_text': m.message_text, 'timestamp': m.timestamp} for m in sent_messages]
+        'received': received,
+        'sent': sent,
+        'next_cursor': {'received': received_cursor, 'sent': sent_cursor}
     }
     return jsonify(messages), 200
 
+# The current user's conversations, most recently active first, each with the other
+# user, a preview of the last message and the unread count from the inbox summary rows.
+# Pages are keyed on (last_message_at, id), so a conversation that gets a new message
+# while a client pages moves ahead of the cursor: it shows up on a fresh first page,
+# not on the later pages of the walk in progress.
+@app.route('/conversations', methods=['GET'])
+@jwt_required()
+def get_conversations():
+    query = reads.query(ConversationParticipant).filter_by(user_id=get_jwt_identity()['user_id'])
+    conversations, next_cursor = keyset_page(query, ConversationParticipant,
+                                             ('conversation_id', 'other_user_id', 'last_sender_id',
+                                              'last_message_preview', 'last_message_at', 'unread_count'),
+                                             order_by='last_message_at', descending=True)
+    return page_response(conversations, next_cursor), 200
+
+# Messages of one conversation, newest first
+@app.route('/conversations/<int:conversation_id>/messages', methods=['GET'])
+@jwt_required()
+def get_conversation_messages(conversation_id):
+    user_id = get_jwt_identity()['user_id']
+    if not reads.query(ConversationParticipant.id).filter_by(conversation_id=conversation_id,
+                                                             user_id=user_id).first():
+        return jsonify({'message': _('Conversation not found')}), 404
+    messages, next_cursor = keyset_page(reads.query(Message).filter_by(conversation_id=conversation_id), Message,
+                                        ('id', 'sender_id', 'message_text', 'timestamp'), descending=True)
+    return page_response(messages, next_cursor), 200
+
+# Reset the current user's unread count for a conversation
+@app.route('/conversations/<int:conversation_id>/read', methods=['POST'])
+@jwt_required()
+def read_conversation(conversation_id):
+    if not mark_conversation_read(conversation_id, get_jwt_identity()['user_id']):
+        return jsonify({'message': _('Conversation not found')}), 404
+    return jsonify({'unread_count': 0}), 200
+
 # Create a discussion topic
 @app.route('/discussion-topic', methods=['POST'])
 @jwt_required()
@@ -368,23 +707,17 @@ def create_discussion_topic():
     if not topic_title or not description:
         return bad_request(_('Missing topic_title or description'))
 
-    new_topic = DiscussionTopic(topic_title=topic_title, description=description)
-    db.session.add(new_topic)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error creating discussion topic')}), 500
+    return create_record('discussion_topic', {'topic_title': topic_title, 'description': description},
+                         _('Discussion topic created successfully'), _('Error creating discussion topic'))
 
-    return jsonify({'message': _('Discussion topic created successfully')}), 201
-
-# Get all discussion topics
+# Get discussion topics, one page at a time
 @app.route('/discussion-topics', methods=['GET'])
 @jwt_required()
+@response_cache.cached(lambda: ('discussion_topics',))
 def get_discussion_topics():
-    topics = DiscussionTopic.query.all()
-    topic_list = [{'id': t.id, 'topic_title': t.topic_title, 'description': t.description, 'timestamp': t.timestamp} for t in topics]
-    return jsonify(topic_list), 200
+    topics, next_cursor = keyset_page(reads.query(DiscussionTopic), DiscussionTopic,
+                                      ('id', 'topic_title', 'description', 'timestamp'))
+    return page_response(topics, next_cursor), 200
 
 # Add a post to a discussion
 @app.route('/discussion-post', methods=['POST'])
@@ -397,46 +730,301 @@ def add_discussion_post():
     if not topic_id or not post_content:
         return bad_request(_('Missing topic_id or post_content'))
 
-    new_post = DiscussionPost(topic_id=topic_id, user_id=get_jwt_identity()['user_id'], post_content=post_content)
-    db.session.add(new_post)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        return jsonify({'message': _('Error adding discussion post')}), 500
-
-    return jsonify({'message': _('Discussion post added successfully')}), 201
+    return create_record('discussion_post', {'topic_id': topic_id, 'user_id': get_jwt_identity()['user_id'], 'post_content': post_content},
+                         _('Discussion post added successfully'), _('Error adding discussion post'))
 
 # Get all posts for a discussion topic
 @app.route('/discussion-posts/<int:topic_id>', methods=['GET'])
 @jwt_required()
+@response_cache.cached(lambda topic_id: ('discussion_posts', topic_id))
 def get_discussion_posts(topic_id):
-    posts = DiscussionPost.query.filter_by(topic_id=topic_id).all()
-    post_list = [{'id': p.id, 'user_id': p.user_id, 'post_content': p.post_content, 'timestamp': p.timestamp} for p in posts]
-    return jsonify(post_list), 200
+    posts, next_cursor = keyset_page(reads.query(DiscussionPost).filter_by(topic_id=topic_id), DiscussionPost,
+                                     ('id', 'user_id', 'post_content', 'timestamp'))
+    return page_response(posts, next_cursor), 200
+
+# Full-text search over problems, tutorials, hints and discussions, best match first.
+# `kind` narrows it to a comma-separated list of kinds; the next page is `?after=<X-Next-Cursor>`.
+@app.route('/search', methods=['GET'])
+@jwt_required()
+def search_content():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return bad_request(_('Missing search query'))
+    kinds = [kind for kind in request.args.get('kind', '').split(',') if kind]
+    if any(kind not in SEARCH_KINDS for kind in kinds):
+        return bad_request(_('Unknown kind'))
+    try:
+        offset = int(request.args.get('after', 0))
+    except ValueError:
+        raise PaginationError('Invalid cursor')
+    if not 0 <= offset <= app.config['SEARCH_MAX_OFFSET']:
+        raise PaginationError('Invalid cursor')
+
+    limit = parse_limit()
+    try:
+        results, has_more = search(query, kinds, limit, offset)
+    except SearchUnavailable:
+        return jsonify({'message': _('Search is not available')}), 501
+    return page_response(results, str(offset + limit) if has_more else None), 200
+
+# Stream a full progress, message or comment history, optionally for one user
+@app.route('/export/<resource>', methods=['GET'])
+@jwt_required()
+def export_history(resource):
+    if resource not in EXPORTS:
+        return jsonify({'message': _('Unknown export')}), 404
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return bad_request(_('Unsupported export format'))
+
+    # Students may only export their own history; teachers and admins may export anyone's or everyone's
+    current_user = get_jwt_identity()
+    user_id = request.args.get('user_id', type=int)
+    if user_id != current_user['user_id'] and not is_staff(current_user):
+        return jsonify({'message': _('Forbidden')}), 403
+    return export_response(resource, user_id=user_id, fmt=fmt, gzip=wants_gzip())
+
+# Bulk-load problems, hints, tutorials or progress events from a JSON array or an NDJSON stream
+@app.route('/bulk/<kind>', methods=['POST'])
+@jwt_required()
+def bulk_ingest(kind):
+    # Loading content or other users' attempts is a teacher/admin job
+    if not is_staff(get_jwt_identity()):
+        return jsonify({'message': _('Forbidden')}), 403
+    if kind not in INGEST_SPECS:
+        return jsonify({'message': _('Unknown record type')}), 404
+
+    if request.mimetype == 'application/x-ndjson':
+        records = parse_ndjson(request.stream)
+    else:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            return bad_request(_('Expected a JSON array or an NDJSON body'))
+
+    summary = ingest(kind, records, chunk_size=request.args.get('chunk_size', type=int))
+    return jsonify(summary), 200
+
+# Runtime metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    values = {**password_hasher.metrics(), **draw_aggregator.metrics(), **presence.metrics(),
+              **response_cache.metrics(), **notifier.metrics(), **social_graph.metrics(), **catalog.metrics()}
+    if isinstance(socketio.server.manager, RoomBus):
+        values.update(socketio.server.manager.metrics())
+    lines = [f'{name} {value}' for name, value in values.items()] + request_metrics.render()
+    response = make_response('\n'.join(lines) + '\n', 200)
+    response.mimetype = 'text/plain'
+    return response
+
+# Members of a collaboration room across all workers
+@app.route('/rooms/<room>/presence', methods=['GET'])
+@jwt_required()
+def room_presence(room):
+    return jsonify({'room': room, 'members': room_size(socketio.server.manager, room)}), 200
 
 # Real-Time Collaboration - Socket.IO event handlers
+# Clients that connect with auth={'token': <access token>} join their own room for live notifications
+@socketio.on('connect')
+@request_metrics.socket_event('connect')
+def on_connect(auth=None):
+    token = auth.get('token') if isinstance(auth, dict) else None
+    if not token:
+        return
+    try:
+        identity = decode_token(token)['sub']
+    except (JWTExtendedException, PyJWTError):
+        return
+    if not is_stale(identity):
+        join_room(user_room(identity['user_id']))
+
 @socketio.on('join')
+@request_metrics.socket_event('join')
 def on_join(data):
-    room = data['room']
+    room = valid_room(data)
+    if room is None:
+        emit('error', {'message': _('Invalid room')})
+        return
+    username = data.get('username')
+    if not presence.join(request.sid, room, username):
+        emit('error', {'message': _('Too many rooms')})
+        return
     join_room(room)
-    send({'message': f'{data["username"]} has entered the room.'}, room=room)
+    send({'message': f'{username} has entered the room.'}, room=room)
+    if draw_aggregator.enabled:
+        # Late joiners get the current board in one payload instead of asking peers to replay it.
+        # This worker only holds the board if it already had members in the room; otherwise
+        # another worker drawing there sends it (see share_boards).
+        manager = socketio.server.manager
+        if isinstance(manager, RoomBus) and manager.local_members(room) == 1 and \
+                manager.request_state(request.sid, room):
+            return
+        emit('board_state', board_store.catch_up(room))
 
 @socketio.on('leave')
+@request_metrics.socket_event('leave')
 def on_leave(data):
-    room = data['room']
+    room = valid_room(data)
+    if room is None or not presence.leave(request.sid, room):
+        return
     leave_room(room)
-    send({'message': f'{data["username"]} has left the room.'}, room=room)
+    draw_aggregator.forget(room, request.sid)
+    send({'message': f'{data.get("username")} has left the room.'}, room=room)
+
+# Flask-SocketIO drops the sid from its rooms itself; clear our presence, buckets and pending strokes
+@socketio.on('disconnect')
+@request_metrics.socket_event('disconnect')
+def on_disconnect():
+    for room in presence.disconnect(request.sid):
+        draw_aggregator.forget(room, request.sid)
+
+# Chat and draw events are only relayed for members of the room, within the rate limits
+def admit(data, event):
+    room = valid_room(data)
+    if room is None or not presence.is_member(request.sid, room):
+        return None
+    return room if presence.allow(request.sid, room, event) else None
 
 @socketio.on('message')
+@request_metrics.socket_event('message')
 def handle_message(data):
-    emit('response', {'message': data['message']}, room=data['room'])
+    room = admit(data, 'message')
+    if room is not None:
+        emit('response', {'message': data.get('message')}, room=room)
 
 # Shared Whiteboard for real-time collaboration
+# Packets are coalesced into binary 'draw_frame' events once per tick unless batching is off
 @socketio.on('draw')
+@request_metrics.socket_event('draw')
 def handle_draw(data):
-    room = data['room']
-    emit('draw', data['drawData'], to=room)
+    room = admit(data, 'draw')
+    if room is None:
+        return
+    if draw_aggregator.enabled:
+        draw_aggregator.add(room, request.sid, data.get('drawData'))
+    else:
+        emit('draw', data.get('drawData'), to=room)
+
+# Rebuild the per-user stats table from the Progress log
+@app.cli.command('rebuild-user-stats')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_user_stats_command(user_id):
+    rebuilt = rebuild_user_stats(user_id)
+    click.echo(f'Rebuilt stats for {rebuilt} user(s).')
+
+# Grant a user the student, teacher or admin role
+@app.cli.command('set-role')
+@click.argument('email')
+@click.argument('role', type=click.Choice(('student',) + STAFF_ROLES))
+def set_role_command(email, role):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f'No user with email {email}.')
+    user.role = role
+    db.session.commit()
+    user_cache.invalidate(user.id)
+    click.echo(f'{email} is now a {role}.')
+
+# Group messages sent before conversations existed into conversations
+@app.cli.command('backfill-conversations')
+@click.option('--chunk-size', type=int, default=5000)
+def backfill_conversations_command(chunk_size):
+    click.echo(f'Assigned {backfill_conversations(chunk_size)} message(s) to conversations.')
+
+# Recount every user's unread notifications
+@app.cli.command('rebuild-unread-counts')
+def rebuild_unread_counts_command():
+    rebuild_unread_counts()
+    click.echo('Rebuilt unread notification counts.')
+
+# Recount forum post and comment scores from the Vote table
+@app.cli.command('rebuild-vote-scores')
+def rebuild_vote_scores_command():
+    rebuild_vote_scores()
+    click.echo('Rebuilt vote scores.')
+
+# Recompute hot scores now instead of waiting for the background refresh
+@app.cli.command('recompute-hot-scores')
+def recompute_hot_scores_command():
+    click.echo(f'Recomputed hot scores for {recompute_hot_scores(app.config)} row(s).')
+
+# Refit every user and problem rating from the Progress log
+@app.cli.command('recalibrate-ratings')
+@click.option('--iterations', type=int, default=25)
+def recalibrate_ratings_command(iterations):
+    summary = recalibrate_ratings(iterations=iterations)
+    click.echo(f"Refit {summary['users']} user and {summary['problems']} problem ratings "
+               f"from {summary['attempts']} attempts.")
+
+# Time a recalibration over simulated attempts in a scratch database
+@app.cli.command('bench-ratings')
+@click.option('--attempts', type=int, default=10000000)
+@click.option('--users', type=int, default=100000)
+@click.option('--problems', type=int, default=20000)
+def bench_ratings_command(attempts, users, problems):
+    result = run_rating_benchmark(attempts, users, problems)
+    click.echo(f"Recalibrated {result['attempts']} attempts in {result['seconds']:.1f}s; "
+               f"correlation with simulated ratings: users {result['user_correlation']:.3f}, "
+               f"problems {result['problem_correlation']:.3f}")
+
+# Rebuild the full-text search index from the searchable tables
+@app.cli.command('rebuild-search-index')
+@click.option('--chunk-size', type=int, default=5000, help='Rows read and indexed per batch.')
+def rebuild_search_index_command(chunk_size):
+    counts = rebuild_search_index(chunk_size)
+    click.echo('Indexed ' + ', '.join(f'{count} {kind}(s)' for kind, count in counts.items()) + '.')
+
+# Build a synthetic search index in a scratch database and time queries against it
+@app.cli.command('bench-search')
+@click.option('--documents', type=int, default=1000000)
+@click.option('--queries', type=int, default=500)
+def bench_search_command(documents, queries):
+    result = run_search_benchmark(app.config, documents, queries)
+    click.echo(f"{result['documents']} documents indexed in {result['build_seconds']:.1f}s "
+               f"({result['index_bytes'] / 1048576:.0f} MiB); query p50 {result['p50_ms']:.2f} ms, "
+               f"p95 {result['p95_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+
+# Bulk-load records from a JSON array file or an NDJSON (.ndjson/.jsonl) file
+@app.cli.command('ingest')
+@click.argument('kind', type=click.Choice(sorted(INGEST_SPECS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', type=int, default=None, help='Rows per insert/commit.')
+def ingest_command(kind, path, chunk_size):
+    with open(path, encoding='utf-8') as source:
+        if path.endswith(('.ndjson', '.jsonl')):
+            summary = ingest(kind, parse_ndjson(source), chunk_size=chunk_size)
+        else:
+            records = json.load(source)
+            if not isinstance(records, list):
+                records = [InvalidRecord('Expected a JSON array')]
+            summary = ingest(kind, records, chunk_size=chunk_size)
+    click.echo(f"Inserted {summary['inserted']} {kind}, rejected {summary['failed']}.")
+    for error in summary['errors']:
+        click.echo(f"  record {error['index']}: {'; '.join(error['errors'])}")
+
+# Measure Socket.IO emit throughput with rooms spread over N worker processes on an ipc:// bus
+@app.cli.command('bench-socketio')
+@click.option('--workers', default='1,2,4', help='Comma-separated worker counts to try.')
+@click.option('--rooms', type=int, default=64)
+@click.option('--clients-per-room', type=int, default=4)
+@click.option('--messages', type=int, default=20000, help='Emits per worker.')
+@click.option('--cross-fraction', type=float, default=0.05, help='Share of rooms with a member on another worker.')
+def bench_socketio_command(workers, rooms, clients_per_room, messages, cross_fraction):
+    worker_counts = [int(count) for count in workers.split(',')]
+    for row in run_load_test(worker_counts, rooms, clients_per_room, messages, cross_fraction):
+        click.echo(f"{row['workers']} worker(s): {row['emits_per_second']:.0f} emits/s, "
+                   f"scaling efficiency {row['scaling_efficiency']:.2f}, "
+                   f"{row['published']} published to the bus, {row['deliveries']} deliveries")
+
+# Concurrent read/write throughput of the default engine vs the tuned database profile
+@app.cli.command('bench-db')
+@click.option('--threads', type=int, default=8)
+@click.option('--seconds', type=float, default=5)
+@click.option('--write-ratio', type=float, default=0.2, help='Share of operations that insert.')
+def bench_db_command(threads, seconds, write_ratio):
+    for row in run_db_benchmark(app.config, threads, seconds, write_ratio):
+        click.echo(f"{row['profile']}: {row['reads_per_second']:.0f} reads/s, "
+                   f"{row['writes_per_second']:.0f} writes/s, p95 {row['p95_ms']:.1f} ms, {row['errors']} errors")
 
 # Run the application
 if __name__ == '__main__':
@@ -0,0 +1,511 @@
+from collections import OrderedDict, defaultdict
+from multiprocessing import get_context
+from urllib.parse import urlparse
+import abc
+import base64
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# Bus messages are JSON. Socket.IO payloads may carry bytes (whiteboard frames), which
+# travel as {"__bytes__": <base64>}. Payloads are never unpickled, so a forged
+# datagram can at worst inject an event, not run code in the worker.
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'{type(value).__name__} is not serializable on the Socket.IO bus')
+
+def _json_object(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+def encode_message(message):
+    return json.dumps(message, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+def decode_message(payload):
+    return json.loads(payload, object_hook=_json_object)
+
+# Per-user default for ipc:// URLs without a path
+def default_ipc_directory():
+    return os.path.join(tempfile.gettempdir(), f'socketio-bus-{os.getuid()}')
+
+# Create `path` with mode 0700, or adopt it if it already is a directory owned by this
+# user that nobody else can enter. Anyone able to write there could send bus messages.
+def private_directory(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'Socket.IO bus directory {path} must be a directory owned by '
+                              f'this user with mode 0700')
+    return path
+
+# Cross-process Socket.IO client manager that routes by room presence.
+# Every worker announces how many local members each named room has; emits go
+# straight to local clients and are only published to the workers that have
+# members in the target room, so a room whose clients all sit on one worker
+# (room affinity) never touches the bus. Presence is eventually consistent: a
+# client that joins on another worker starts receiving once its join is seen.
+# Subclasses provide the transport with _send(host_ids, message), _others() and _listen().
+class RoomBus(socketio.PubSubManager, abc.ABC):
+    name = 'roombus'
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._presence_lock = threading.Lock()
+        self.presence = defaultdict(dict)  # (namespace, room) -> {host_id: members}
+        self.hosts = set()
+        self.published = 0
+        self.local_only = 0
+        # Hooks for per-room state that must follow a room across workers (the whiteboard):
+        # emit_listener(event, data, namespace, room) sees emits relayed from other workers,
+        # state_provider(namespace, room) answers another worker's request_state, and
+        # state_listener(namespace, room, sid, state) receives the answer to ours
+        self.emit_listener = None
+        self.state_provider = None
+        self.state_listener = None
+
+    def initialize(self):
+        super().initialize()
+        if not self.write_only:
+            self._send(self._others(), {'method': 'hello', 'host_id': self.host_id})
+
+    # Deliver `message` to the given hosts, or to every host (this one included) when host_ids is None.
+    # Must not block on a slow peer: the listener thread sends replies.
+    @abc.abstractmethod
+    def _send(self, host_ids, message):
+        pass
+
+    # Host ids of the other workers on the channel
+    @abc.abstractmethod
+    def _others(self):
+        pass
+
+    # Yields the messages sent to this worker
+    @abc.abstractmethod
+    def _listen(self):
+        pass
+
+    def _publish(self, data):
+        self.published += 1
+        self._send(None, data)
+
+    def _is_local_sid(self, namespace, room):
+        return room in self.rooms.get(namespace, {}).get(None, {})
+
+    def _remote_hosts(self, namespace, room):
+        with self._presence_lock:
+            members = self.presence.get((namespace, room), {})
+            return [host_id for host_id, count in members.items() if count and host_id != self.host_id]
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, **kwargs):
+        namespace = namespace or '/'
+        if kwargs.get('ignore_queue') or callback is not None or room is None or not isinstance(room, str):
+            return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        remote = [] if self._is_local_sid(namespace, room) else self._remote_hosts(namespace, room)
+        socketio.BaseManager.emit(self, event, data, namespace, room=room, skip_sid=skip_sid)
+        if remote:
+            self.published += 1
+            self._send(remote, {'method': 'emit', 'event': event, 'data': data, 'namespace': namespace,
+                                'room': room, 'skip_sid': skip_sid, 'callback': None,
+                                'host_id': self.host_id})
+        else:
+            self.local_only += 1
+
+    def _local_count(self, namespace, room):
+        return len(self.rooms.get(namespace, {}).get(room, ()))
+
+    def _announce(self, namespace, room):
+        count = self._local_count(namespace, room)
+        with self._presence_lock:
+            if count:
+                self.presence[(namespace, room)][self.host_id] = count
+            else:
+                self._drop_presence(namespace, room, self.host_id)
+        if not self.write_only:
+            self._send(self._others(), {'method': 'presence', 'host_id': self.host_id,
+                                        'rooms': [(namespace, room, count)]})
+
+    # Callers hold _presence_lock
+    def _drop_presence(self, namespace, room, host_id):
+        members = self.presence.get((namespace, room))
+        if members is not None:
+            members.pop(host_id, None)
+            if not members:
+                del self.presence[(namespace, room)]
+
+    def enter_room(self, sid, namespace, room, eio_sid=None):
+        super().enter_room(sid, namespace, room, eio_sid=eio_sid)
+        if room is not None and room != sid:
+            self._announce(namespace, room)
+
+    def leave_room(self, sid, namespace, room):
+        super().leave_room(sid, namespace, room)
+        if room is not None and room != sid:
+            self._announce(namespace, room)
+
+    def local_members(self, room, namespace='/'):
+        return self._local_count(namespace, room)
+
+    # Ask the worker with the most members in `room` for its state on behalf of local client
+    # `sid`; the answer arrives through state_listener. False if no other worker is in the room.
+    def request_state(self, sid, room, namespace='/'):
+        with self._presence_lock:
+            members = self.presence.get((namespace, room), {})
+            remote = [(count, host_id) for host_id, count in members.items() if count and host_id != self.host_id]
+        if not remote:
+            return False
+        self._send([max(remote)[1]], {'method': 'state_request', 'host_id': self.host_id,
+                                      'namespace': namespace, 'room': room, 'sid': sid})
+        return True
+
+    def _handle_emit(self, message):
+        if self.emit_listener is not None and message.get('host_id') != self.host_id:
+            self.emit_listener(message['event'], message['data'], message.get('namespace') or '/',
+                               message.get('room'))
+        super()._handle_emit(message)
+
+    def room_size(self, room, namespace='/'):
+        with self._presence_lock:
+            return sum(self.presence.get((namespace, room), {}).values())
+
+    def room_hosts(self, room, namespace='/'):
+        with self._presence_lock:
+            return len(self.presence.get((namespace, room), {}))
+
+    def _local_rooms(self):
+        return [(namespace, room, len(members)) for namespace, rooms in list(self.rooms.items())
+                for room, members in list(rooms.items()) if room is not None and room not in rooms.get(None, {})]
+
+    def _handle_presence(self, message):
+        host_id = message['host_id']
+        with self._presence_lock:
+            if message.get('replace'):
+                for key in [key for key, members in self.presence.items() if host_id in members]:
+                    self._drop_presence(key[0], key[1], host_id)
+            for namespace, room, count in message['rooms']:
+                if count:
+                    self.presence[(namespace, room)][host_id] = count
+                else:
+                    self._drop_presence(namespace, room, host_id)
+
+    def forget_host(self, host_id):
+        with self._presence_lock:
+            self.hosts.discard(host_id)
+            for key in [key for key, members in self.presence.items() if host_id in members]:
+                self._drop_presence(key[0], key[1], host_id)
+
+    def _thread(self):
+        for message in self._listen():
+            try:
+                data = decode_message(message) if isinstance(message, bytes) else message
+            except ValueError:
+                logger.warning('Ignoring malformed bus message')
+                continue
+            if not isinstance(data, dict):
+                continue
+            method = data.get('method')
+            host_id = data.get('host_id')
+            if host_id and host_id != self.host_id:
+                self.hosts.add(host_id)
+            try:
+                if method == 'emit':
+                    self._handle_emit(data)
+                elif method == 'callback':
+                    self._handle_callback(data)
+                elif method == 'disconnect':
+                    self._handle_disconnect(data)
+                elif method == 'close_room':
+                    self._handle_close_room(data)
+                elif method == 'presence' and host_id != self.host_id:
+                    self._handle_presence(data)
+                elif method == 'hello' and host_id != self.host_id:
+                    # Tell the new worker which rooms we hold
+                    self._send([host_id], {'method': 'presence', 'host_id': self.host_id, 'replace': True,
+                                           'rooms': self._local_rooms()})
+                elif method == 'bye' and host_id != self.host_id:
+                    self.forget_host(host_id)
+                elif method == 'state_request' and host_id != self.host_id and self.state_provider:
+                    self._send([host_id], {'method': 'state', 'host_id': self.host_id,
+                                           'namespace': data['namespace'], 'room': data['room'], 'sid': data['sid'],
+                                           'state': self.state_provider(data['namespace'], data['room'])})
+                elif method == 'state' and self.state_listener:
+                    self.state_listener(data['namespace'], data['room'], data['sid'], data['state'])
+                elif method == 'stop':
+                    return
+            except Exception:
+                logger.exception('Failed to handle bus message %s', method)
+
+    def shutdown(self):
+        self._send(self._others(), {'method': 'bye', 'host_id': self.host_id})
+
+    def metrics(self):
+        with self._presence_lock:
+            rooms = len(self.presence)
+        return {
+            'socketio_bus_hosts': len(self.hosts) + 1,
+            'socketio_bus_rooms': rooms,
+            'socketio_bus_published_total': self.published,
+            'socketio_bus_local_only_total': self.local_only,
+        }
+
+# In-process stand-in: managers sharing a channel name exchange messages through queues.
+# Lets tests run several Socket.IO servers in one interpreter.
+_memory_hubs = defaultdict(dict)
+_memory_lock = threading.Lock()
+
+class MemoryBus(RoomBus):
+    name = 'memory'
+
+    def __init__(self, url='memory://', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=(urlparse(url).netloc or channel), write_only=write_only, logger=logger)
+        self._inbox = queue.Queue()
+        with _memory_lock:
+            _memory_hubs[self.channel][self.host_id] = self._inbox
+
+    def _send(self, host_ids, message):
+        payload = encode_message(message)
+        with _memory_lock:
+            hub = _memory_hubs[self.channel]
+            targets = list(hub.values()) if host_ids is None else [hub[h] for h in host_ids if h in hub]
+        for inbox in targets:
+            inbox.put(payload)
+
+    def _others(self):
+        with _memory_lock:
+            return [host_id for host_id in _memory_hubs[self.channel] if host_id != self.host_id]
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+    def shutdown(self):
+        super().shutdown()
+        with _memory_lock:
+            _memory_hubs[self.channel].pop(self.host_id, None)
+        self._inbox.put(encode_message({'method': 'stop'}))
+
+# Workers on one machine: each binds a Unix datagram socket named after its host id
+# in the ipc:// directory, and a publish is a sendto() per target socket. Sends go
+# through an outbox drained by a sender thread, so a worker whose receive queue is
+# full stalls only that thread, never a request or the listener. The directory and
+# its per-channel subdirectory must be private to the user running the workers.
+# Messages over chunk_size (a board state can be 1 MiB) travel as several fragment
+# datagrams, which stay under the default net.core.wmem_max, and are reassembled by
+# the receiver; fragments of messages that never complete are evicted after
+# max_partial newer ones.
+FRAGMENT = b'\x00'
+_fragment_header = struct.Struct('!c16sII')  # marker, message id, index, count
+
+class IPCBus(RoomBus):
+    name = 'ipc'
+    max_message = 4 * 1024 * 1024
+    chunk_size = 64 * 1024
+    max_partial = 64
+    send_timeout = 1.0
+    outbox_size = 10000
+
+    def __init__(self, url='ipc://', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        base = private_directory(urlparse(url).path or default_ipc_directory())
+        self.directory = private_directory(os.path.join(base, self.channel))
+        self.dropped = 0
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.max_message)
+        self._socket.settimeout(self.send_timeout)
+        self._path = None
+        if not write_only:
+            self._path = self._peer_path(self.host_id)
+            self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.max_message)
+            self._receiver.bind(self._path)
+        self._outbox = queue.Queue(maxsize=self.outbox_size)
+        self._sender = threading.Thread(target=self._drain_outbox, name='socketio-bus-sender', daemon=True)
+        self._sender.start()
+
+    def _peer_path(self, host_id):
+        return os.path.join(self.directory, host_id + '.sock')
+
+    def _hosts(self):
+        return [name[:-5] for name in os.listdir(self.directory) if name.endswith('.sock')]
+
+    def _others(self):
+        return [host_id for host_id in self._hosts() if host_id != self.host_id]
+
+    def _send(self, host_ids, message):
+        payload = encode_message(message)
+        if len(payload) > self.max_message:
+            self.dropped += 1
+            logger.warning('Dropping %d byte %s bus message', len(payload), message.get('method'))
+            return
+        try:
+            self._outbox.put_nowait((host_ids, self._datagrams(payload)))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Socket.IO bus outbox full, dropping %s message', message.get('method'))
+
+    def _datagrams(self, payload):
+        if len(payload) <= self.chunk_size:
+            return [payload]
+        message_id = uuid.uuid4().bytes
+        count = -(-len(payload) // self.chunk_size)
+        return [_fragment_header.pack(FRAGMENT, message_id, index, count) +
+                payload[index * self.chunk_size:(index + 1) * self.chunk_size] for index in range(count)]
+
+    def _drain_outbox(self):
+        while True:
+            host_ids, datagrams = self._outbox.get()
+            if datagrams is None:
+                return
+            for host_id in (self._hosts() if host_ids is None else host_ids):
+                try:
+                    for datagram in datagrams:
+                        self._socket.sendto(datagram, self._peer_path(host_id))
+                except (FileNotFoundError, ConnectionRefusedError):
+                    # The worker exited without saying goodbye
+                    self.forget_host(host_id)
+                    if host_id != self.host_id:
+                        try:
+                            os.remove(self._peer_path(host_id))
+                        except FileNotFoundError:
+                            pass
+                except OSError:
+                    self.dropped += 1
+                    logger.exception('Dropping %d byte bus message for %s', sum(map(len, datagrams)), host_id)
+
+    def _listen(self):
+        partial = OrderedDict()  # message id -> {index: fragment} received so far
+        while True:
+            datagram = self._receiver.recv(self.chunk_size + _fragment_header.size)
+            if not datagram.startswith(FRAGMENT):
+                yield datagram
+                continue
+            if len(datagram) < _fragment_header.size:
+                continue
+            _, message_id, index, count = _fragment_header.unpack_from(datagram)
+            fragments = partial.setdefault(message_id, {})
+            fragments[index] = datagram[_fragment_header.size:]
+            if len(fragments) == count:
+                del partial[message_id]
+                if sorted(fragments) == list(range(count)):
+                    yield b''.join(fragments[i] for i in range(count))
+            elif sum(map(len, fragments.values())) > self.max_message:
+                del partial[message_id]
+            elif len(partial) > self.max_partial:
+                partial.popitem(last=False)
+
+    def shutdown(self):
+        super().shutdown()
+        self._outbox.put((None, None))
+        self._sender.join()
+        if self._path:
+            # Wake the listener so it can exit, then take our socket off the directory
+            self._socket.sendto(encode_message({'method': 'stop'}), self._path)
+            os.remove(self._path)
+            self._path = None
+
+
+# Keyword arguments for SocketIO() from SOCKETIO_MESSAGE_QUEUE:
+# memory://<name> and ipc://[<directory>] use the managers above, any other URL
+# (redis://, amqp://, kafka://) is handed to Flask-SocketIO's own message_queue support.
+def socketio_options(config):
+    url = config.get('SOCKETIO_MESSAGE_QUEUE')
+    channel = config.get('SOCKETIO_CHANNEL', 'socketio')
+    if not url:
+        return {}
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return {'client_manager': MemoryBus(url, channel=channel)}
+    if scheme == 'ipc':
+        return {'client_manager': IPCBus(url, channel=channel)}
+    return {'message_queue': url, 'channel': channel}
+
+def room_size(manager, room, namespace='/'):
+    if isinstance(manager, RoomBus):
+        return manager.room_size(room, namespace)
+    return len(manager.rooms.get(namespace, {}).get(room, ()))
+
+def _load_worker(url, channel, index, workers, rooms, clients_per_room, messages, cross_fraction, barrier, results):
+    manager = IPCBus(url, channel=channel)
+    server = socketio.Server(client_manager=manager, async_mode='threading')
+    delivered = [0]
+
+    # Stand-in for the engine.io transport: encode the packet the way the server would
+    def deliver(eio_sid, event, data, namespace=None, id=None):
+        socketio.packet.Packet(socketio.packet.EVENT, namespace=namespace, data=[event, data], id=id).encode()
+        delivered[0] += 1
+
+    server._emit_internal = deliver
+    manager.initialize()
+    owned = [f'room-{r}' for r in range(rooms) if r % workers == index]
+    for room_number in range(rooms):
+        room = f'room-{room_number}'
+        members = clients_per_room if room in owned else 0
+        # A slice of rooms also has one member on the next worker, so their traffic crosses the bus
+        if workers > 1 and (room_number + 1) % workers == index and room_number < rooms * cross_fraction:
+            members += 1
+        for _ in range(members):
+            sid = manager.connect(uuid.uuid4().hex, '/')
+            manager.enter_room(sid, '/', room)
+    barrier.wait()
+    time.sleep(0.5)  # let presence settle
+    barrier.wait()
+
+    payload = b'x' * 64
+    started = time.perf_counter()
+    for i in range(messages):
+        manager.emit('draw_frame', payload, namespace='/', room=owned[i % len(owned)])
+    elapsed = time.perf_counter() - started
+    barrier.wait()
+    time.sleep(0.5)  # let remote deliveries drain
+    results.put({'worker': index, 'elapsed': elapsed, 'delivered': delivered[0], 'published': manager.published})
+    manager.shutdown()
+
+# Emit `messages` events per worker into rooms spread over `workers` processes on an
+# ipc:// bus and report aggregate emits per second for each worker count
+def run_load_test(worker_counts, rooms=64, clients_per_room=4, messages=20000, cross_fraction=0.05,
+                  url=None):
+    scratch = tempfile.mkdtemp(prefix='socketio-bench-') if url is None else None
+    url = url or 'ipc://' + scratch
+    context = get_context('spawn')
+    report = []
+    for workers in worker_counts:
+        channel = f'bench-{workers}-{os.getpid()}'
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [context.Process(target=_load_worker,
+                                     args=(url, channel, index, workers, rooms, clients_per_room, messages,
+                                           cross_fraction, barrier, results))
+                     for index in range(workers)]
+        for process in processes:
+            process.start()
+        stats = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = max(stat['elapsed'] for stat in stats)
+        report.append({
+            'workers': workers,
+            'emits_per_second': workers * messages / elapsed,
+            'deliveries': sum(stat['delivered'] for stat in stats),
+            'published': sum(stat['published'] for stat in stats),
+        })
+    if scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+    base = report[0]['emits_per_second'] / report[0]['workers'] if report else 0
+    for row in report:
+        row['scaling_efficiency'] = row['emits_per_second'] / (base * row['workers']) if base else 0
+    return report
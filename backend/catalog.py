@@ -0,0 +1,211 @@
+from backend import db
+from backend.models import Problem, Progress, UserStats
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+import random
+import threading
+import time
+
+# Process-local copy of the Problem table for recommendation sampling.
+# Problem ids are held in one sorted array; each difficulty keeps an array of
+# positions into it, and each cached user has a solved-set bitmap over those
+# positions plus their attempt counters. Problem writes invalidate the whole
+# catalog; committed Progress inserts update the cached user in place.
+class ProblemCatalog:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = array('q')
+        self._by_difficulty = {}
+        self._users = OrderedDict()
+        self._loading = {}
+        self._loaded_at = None
+        self._stale = True
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+            self._generation += 1
+
+    # Return the current (ids, by_difficulty) snapshot, reloading it first if stale.
+    # The Problem scan runs outside the lock so readers of a fresh catalog never wait on SQL.
+    def _ensure_loaded(self):
+        ttl = current_app.config.get('PROBLEM_CATALOG_TTL', 300)
+        with self._lock:
+            if not self._stale and time.monotonic() - self._loaded_at < ttl:
+                return self._ids, self._by_difficulty
+            generation = self._generation
+
+        ids = array('q')
+        by_difficulty = {}
+        rows = db.session.execute(select(Problem.id, Problem.difficulty).order_by(Problem.id))
+        for position, (problem_id, difficulty) in enumerate(rows):
+            ids.append(problem_id)
+            by_difficulty.setdefault(difficulty, array('l')).append(position)
+
+        with self._lock:
+            self._ids = ids
+            self._by_difficulty = by_difficulty
+            # Bitmap positions are only valid for the load they were built against
+            self._users.clear()
+            self._loaded_at = time.monotonic()
+            # A Problem write that landed during the scan forces another load next time
+            self._stale = self._generation != generation
+        return ids, by_difficulty
+
+    @staticmethod
+    def _position(ids, problem_id):
+        position = bisect_left(ids, problem_id)
+        if position < len(ids) and ids[position] == problem_id:
+            return position
+        return None
+
+    def _max_users(self):
+        max_bytes = current_app.config.get('PROBLEM_CATALOG_MAX_BYTES', 64 * 1024 * 1024)
+        bitmap_size = len(self._ids) // 8 + 1
+        return max(1, max_bytes // bitmap_size)
+
+    # [bitmap, total_problems, correct_answers] for the user against the `ids` snapshot.
+    # Misses are loaded outside the lock; the entry is cached only if the catalog was not
+    # reloaded and no attempt for the user committed while it was being read.
+    def _user_entry(self, user_id, ids):
+        with self._lock:
+            current = self._ids is ids
+            entry = self._users.get(user_id) if current else None
+            if entry is not None:
+                self._users.move_to_end(user_id)
+                return entry
+            owner = current and user_id not in self._loading
+            if owner:
+                self._loading[user_id] = False
+
+        try:
+            bitmap = bytearray(len(ids) // 8 + 1)
+            for (problem_id,) in db.session.execute(select(Progress.problem_id).where(Progress.user_id == user_id)):
+                position = self._position(ids, problem_id)
+                if position is not None:
+                    bitmap[position >> 3] |= 1 << (position & 7)
+            stats = UserStats.query.get(user_id)
+            entry = [bitmap, stats.total_problems if stats else 0, stats.correct_answers if stats else 0]
+        finally:
+            if owner:
+                with self._lock:
+                    dirty = self._loading.pop(user_id)
+        if owner and not dirty:
+            with self._lock:
+                if self._ids is ids:
+                    self._users[user_id] = entry
+                    while len(self._users) > self._max_users():
+                        self._users.popitem(last=False)
+        return entry
+
+    # Return (total_problems, correct_answers) for the user
+    def performance(self, user_id):
+        ids, _ = self._ensure_loaded()
+        _, total, correct = self._user_entry(user_id, ids)
+        return total, correct
+
+    # Return the id of a random problem of this difficulty the user has not attempted, or None.
+    # A cached bitmap only sees attempts committed through this process, so the pick is checked
+    # against Progress; if another worker already recorded it, the user's entry is reloaded once.
+    def sample_unsolved(self, user_id, difficulty):
+        ids, by_difficulty = self._ensure_loaded()
+        positions = by_difficulty.get(difficulty)
+        if not positions:
+            return None
+        problem_id = self._pick(ids, positions, self._user_entry(user_id, ids)[0])
+        if problem_id is None or not self._attempted(user_id, problem_id):
+            return problem_id
+        self.forget_user(user_id)
+        return self._pick(ids, positions, self._user_entry(user_id, ids)[0])
+
+    # Snapshots are replaced, never modified, and bitmaps only gain bits, so the scan runs
+    # without the lock; a bit set during the scan is caught by the Progress check
+    @staticmethod
+    def _pick(ids, positions, bitmap):
+        count = len(positions)
+        start = random.randrange(count)
+        for offset in range(count):
+            position = positions[(start + offset) % count]
+            if not bitmap[position >> 3] & (1 << (position & 7)):
+                return ids[position]
+        return None
+
+    @staticmethod
+    def _attempted(user_id, problem_id):
+        attempt = select(Progress.id).where(Progress.user_id == user_id, Progress.problem_id == problem_id).limit(1)
+        return db.session.execute(attempt).first() is not None
+
+    def record_attempt(self, user_id, problem_id, completed):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            position = self._position(self._ids, problem_id)
+            if position is not None:
+                entry[0][position >> 3] |= 1 << (position & 7)
+            entry[1] += 1
+            entry[2] += 1 if completed else 0
+
+    def forget_user(self, user_id):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            self._users.pop(user_id, None)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'problem_catalog_problems': len(self._ids),
+                'problem_catalog_cached_users': len(self._users),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._stale = True
+            self._generation += 1
+
+
+catalog = ProblemCatalog()
+
+
+@event.listens_for(Problem, 'after_insert')
+@event.listens_for(Problem, 'after_update')
+@event.listens_for(Problem, 'after_delete')
+def _problem_changed(mapper, connection, target):
+    catalog.invalidate()
+
+
+# Attempts are applied to the cache only once their transaction commits
+@event.listens_for(Progress, 'after_insert')
+def _progress_inserted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('catalog_attempts', []).append(
+            (target.user_id, target.problem_id, target.status == 'completed'))
+
+
+@event.listens_for(Progress, 'after_update')
+@event.listens_for(Progress, 'after_delete')
+def _progress_rewritten(mapper, connection, target):
+    catalog.forget_user(target.user_id)
+    for previous_user_id in inspect(target).attrs.user_id.history.deleted:
+        catalog.forget_user(previous_user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed_attempts(session):
+    for user_id, problem_id, completed in session.info.pop('catalog_attempts', ()):
+        catalog.record_attempt(user_id, problem_id, completed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_attempts(session, previous_transaction):
+    session.info.pop('catalog_attempts', None)
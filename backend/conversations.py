@@ -0,0 +1,157 @@
+from backend import db
+from backend.database import conflict_insert
+from backend.models import Conversation, ConversationParticipant, Message
+from datetime import datetime
+from sqlalchemy import and_, bindparam, event, or_, select
+from sqlalchemy.exc import IntegrityError
+
+PREVIEW_LENGTH = 200
+
+conversation_table = Conversation.__table__
+participant_table = ConversationParticipant.__table__
+message_table = Message.__table__
+
+def _pair(user_a, user_b):
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+# Id of the conversation between two users, created on first use, on the given connection.
+# Two first messages between the same pair can race to create it; uq_conversation_pair
+# lets one insert win and the other re-reads the winner's row.
+def conversation_for(connection, user_a, user_b):
+    low, high = _pair(user_a, user_b)
+    lookup = select(conversation_table.c.id).where(conversation_table.c.user_low_id == low,
+                                                   conversation_table.c.user_high_id == high)
+    conversation_id = connection.execute(lookup).scalar()
+    if conversation_id is not None:
+        return conversation_id
+    values = {'user_low_id': low, 'user_high_id': high, 'created_on': datetime.utcnow()}
+    insert = conflict_insert(connection, conversation_table)
+    if insert is not None:
+        result = connection.execute(insert.values(**values).on_conflict_do_nothing())
+        if result.rowcount:
+            return result.inserted_primary_key[0]
+    else:
+        savepoint = connection.begin_nested()
+        try:
+            conversation_id = connection.execute(conversation_table.insert().values(**values)).inserted_primary_key[0]
+        except IntegrityError:
+            savepoint.rollback()
+        else:
+            savepoint.commit()
+            return conversation_id
+    return connection.execute(lookup).scalar()
+
+# Make `message` (a row with id, sender_id, recipient_id, message_text and timestamp) the
+# latest of its conversation in both participants' inbox entries, adding `unread` to the
+# recipient's count. Runs in the transaction that wrote the message.
+def record_message(connection, conversation_id, message, unread=1):
+    latest = {
+        'last_message_id': message.id,
+        'last_sender_id': message.sender_id,
+        'last_message_preview': (message.message_text or '')[:PREVIEW_LENGTH],
+        'last_message_at': message.timestamp,
+    }
+    entries = {message.sender_id: (message.recipient_id, 0)}
+    if message.recipient_id != message.sender_id:
+        entries[message.recipient_id] = (message.sender_id, unread)
+    for user_id, (other_user_id, increment) in entries.items():
+        values = dict(conversation_id=conversation_id, user_id=user_id, other_user_id=other_user_id,
+                      unread_count=increment, **latest)
+        upsert = conflict_insert(connection, participant_table)
+        if upsert is not None:
+            upsert = upsert.values(**values)
+            connection.execute(upsert.on_conflict_do_update(
+                index_elements=[participant_table.c.conversation_id, participant_table.c.user_id],
+                set_=dict({name: getattr(upsert.excluded, name) for name in latest},
+                          unread_count=participant_table.c.unread_count + upsert.excluded.unread_count)))
+        elif not _update_participant(connection, conversation_id, user_id, increment, latest):
+            # Another transaction may create the entry between the update and the insert;
+            # uq_conversation_participant rejects the second insert and the update is retried
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(participant_table.insert().values(**values))
+            except IntegrityError:
+                savepoint.rollback()
+                _update_participant(connection, conversation_id, user_id, increment, latest)
+            else:
+                savepoint.commit()
+
+def _update_participant(connection, conversation_id, user_id, increment, latest):
+    result = connection.execute(
+        participant_table.update()
+        .where(participant_table.c.conversation_id == conversation_id, participant_table.c.user_id == user_id)
+        .values(unread_count=participant_table.c.unread_count + increment, **latest))
+    return result.rowcount > 0
+
+@event.listens_for(Message, 'before_insert')
+def _assign_conversation(mapper, connection, target):
+    if target.conversation_id is None:
+        target.conversation_id = conversation_for(connection, target.sender_id, target.recipient_id)
+
+@event.listens_for(Message, 'after_insert')
+def _message_inserted(mapper, connection, target):
+    record_message(connection, target.conversation_id, target)
+
+def mark_conversation_read(conversation_id, user_id):
+    result = db.session.execute(
+        participant_table.update()
+        .where(participant_table.c.conversation_id == conversation_id, participant_table.c.user_id == user_id)
+        .values(unread_count=0))
+    db.session.commit()
+    return result.rowcount > 0
+
+# Group messages written before conversations existed, `chunk_size` messages per
+# transaction, then point every touched inbox entry at its conversation's latest message.
+# Unread counts start at zero for history. Returns how many messages were assigned.
+def backfill_conversations(chunk_size=5000):
+    connection = db.session.connection()
+    assigned = 0
+    touched = set()
+    while True:
+        rows = connection.execute(
+            select(message_table.c.id, message_table.c.sender_id, message_table.c.recipient_id)
+            .where(message_table.c.conversation_id.is_(None))
+            .order_by(message_table.c.id).limit(chunk_size)).all()
+        if not rows:
+            break
+        pairs = {_pair(sender_id, recipient_id) for _, sender_id, recipient_id in rows}
+        conversations = _conversation_ids(connection, pairs)
+        missing = pairs.difference(conversations)
+        if missing:
+            now = datetime.utcnow()
+            connection.execute(conversation_table.insert(), [
+                {'user_low_id': low, 'user_high_id': high, 'created_on': now} for low, high in missing])
+            conversations.update(_conversation_ids(connection, missing))
+        connection.execute(
+            message_table.update().where(message_table.c.id == bindparam('message_id'))
+            .values(conversation_id=bindparam('conversation')),
+            [{'message_id': message_id, 'conversation': conversations[_pair(sender_id, recipient_id)]}
+             for message_id, sender_id, recipient_id in rows])
+        touched.update(conversations.values())
+        assigned += len(rows)
+        db.session.commit()
+        connection = db.session.connection()
+
+    # The latest message of each conversation comes off the (conversation_id, timestamp, id) index
+    for conversation_id in sorted(touched):
+        latest = connection.execute(
+            select(message_table.c.id, message_table.c.sender_id, message_table.c.recipient_id,
+                   message_table.c.message_text, message_table.c.timestamp)
+            .where(message_table.c.conversation_id == conversation_id)
+            .order_by(message_table.c.timestamp.desc(), message_table.c.id.desc()).limit(1)).first()
+        record_message(connection, conversation_id, latest, unread=0)
+    db.session.commit()
+    return assigned
+
+def _conversation_ids(connection, pairs):
+    conversations = {}
+    pairs = list(pairs)
+    # Bounded OR lists keep each lookup within the database's bound-parameter limit
+    for start in range(0, len(pairs), 400):
+        condition = or_(*[and_(conversation_table.c.user_low_id == low, conversation_table.c.user_high_id == high)
+                          for low, high in pairs[start:start + 400]])
+        for conversation_id, low, high in connection.execute(
+                select(conversation_table.c.id, conversation_table.c.user_low_id, conversation_table.c.user_high_id)
+                .where(condition)):
+            conversations[(low, high)] = conversation_id
+    return conversations
@@ -0,0 +1,266 @@
+from flask import current_app, g, has_app_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from greenlet import getcurrent as _ident_func
+except ImportError:
+    from threading import get_ident as _ident_func
+
+def _is_memory_sqlite(sa_url):
+    return sa_url.drivername.startswith('sqlite') and sa_url.database in (None, '', ':memory:')
+
+# INSERT statement for `table` that accepts ON CONFLICT clauses, or None on databases without them
+def conflict_insert(connection, table):
+    if connection.dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return None
+
+# Pool and driver options for the database performance profile (DB_TUNING).
+# File SQLite gets a real connection pool instead of a connection per checkout, and
+# a busy timeout so writers queue instead of failing with "database is locked";
+# server databases get a sized pool with pre-ping and recycling.
+def engine_profile(config, sa_url, options):
+    if not config.get('DB_TUNING', True) or _is_memory_sqlite(sa_url):
+        return options
+    options.update({
+        'poolclass': QueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+    })
+    if sa_url.drivername.startswith('sqlite'):
+        connect_args = options.setdefault('connect_args', {})
+        connect_args['check_same_thread'] = False
+        connect_args['timeout'] = config.get('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000
+        options['sqlite_pragmas'] = sqlite_pragmas(config)
+    else:
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = config.get('DB_POOL_RECYCLE', 1800)
+    return options
+
+def sqlite_pragmas(config):
+    return {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'mmap_size': config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        'busy_timeout': config.get('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        'cache_size': config.get('SQLITE_CACHE_SIZE', -64000),
+        'temp_store': 'MEMORY',
+    }
+
+def _listen_pragmas(engine, pragmas, read_only=False):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+    event.listen(engine, 'connect', set_pragmas)
+
+def build_engine(sa_url, options, read_only=False):
+    options = dict(options)
+    pragmas = options.pop('sqlite_pragmas', None)
+    engine = create_engine(sa_url, **options)
+    if pragmas:
+        _listen_pragmas(engine, pragmas, read_only)
+    return engine
+
+# Flask-SQLAlchemy with the engine_profile() applied to every engine it creates
+class TunedSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        return sa_url, engine_profile(app.config, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return build_engine(sa_url, engine_opts)
+
+    # Same option resolution as Flask-SQLAlchemy's own engines
+    def engine_options(self, app, sa_url):
+        options = self.apply_pool_defaults(app, {})
+        sa_url, options = self.apply_driver_hacks(app, sa_url, options)
+        options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        return sa_url, options
+
+# Sessions for request-path reads, on their own pool (and, for SQLite, their own
+# query_only connections) so readers never queue behind writers for a connection;
+# with WAL they do not wait on writer locks either.
+# With SQLALCHEMY_REPLICA_URIS set, each request's reads go to the next replica in
+# turn. A user who just wrote something reads from the primary (db.session) for
+# READ_YOUR_WRITES_SECONDS so replica lag never hides their own change; the window
+# is tracked per process. An in-memory SQLite database only exists on the write
+# connection, so reads fall back to db.session there.
+class ReadSessions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._turn = itertools.count()
+        self._sticky = {}
+        self.db = None
+
+    def init_app(self, app, db):
+        self.db = db
+        app.teardown_request(self.remove)
+        app.teardown_appcontext(self.remove)
+        app.after_request(self._remember_write)
+
+    def _uris(self, app):
+        return (app.config.get('SQLALCHEMY_REPLICA_URIS') or [app.config.get('SQLALCHEMY_READ_URI')
+                                                                or app.config['SQLALCHEMY_DATABASE_URI']])
+
+    def _scoped_session(self, app, uri):
+        with self._lock:
+            session = self._sessions.get(uri)
+            if session is None:
+                sa_url, options = self.db.engine_options(app, make_url(uri))
+                engine = build_engine(sa_url, options, read_only=True)
+                session = self._sessions[uri] = orm.scoped_session(
+                    orm.sessionmaker(bind=engine, autoflush=False, query_cls=self.db.Query),
+                    scopefunc=_ident_func)
+            return session
+
+    @staticmethod
+    def _user_id():
+        try:
+            identity = get_jwt_identity()
+        except RuntimeError:
+            return None  # no verified token in this context
+        return identity.get('user_id') if isinstance(identity, dict) else None
+
+    def _is_sticky(self, user_id):
+        deadline = self._sticky.get(user_id)
+        return deadline is not None and deadline > time.monotonic()
+
+    # Start the read-your-writes window after a successful write by a signed-in user
+    def _remember_write(self, response):
+        if request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400:
+            return response
+        user_id = self._user_id()
+        if user_id is not None:
+            now = time.monotonic()
+            with self._lock:
+                if len(self._sticky) > 10000:
+                    self._sticky = {key: deadline for key, deadline in self._sticky.items() if deadline > now}
+                self._sticky[user_id] = now + current_app.config.get('READ_YOUR_WRITES_SECONDS', 5)
+        return response
+
+    # The read session for this request; picked once so a request sees a single replica
+    def session(self):
+        session = g.get('read_session')
+        if session is not None:
+            return session
+        app = current_app._get_current_object()
+        user_id = self._user_id()
+        uris = self._uris(app)
+        uri = uris[next(self._turn) % len(uris)]
+        if (user_id is not None and self._is_sticky(user_id)) or _is_memory_sqlite(make_url(uri)):
+            session = self.db.session
+        else:
+            session = self._scoped_session(app, uri)
+        g.read_session = session
+        return session
+
+    def query(self, *entities):
+        return self.session().query(*entities)
+
+    # Forget every read-your-writes window
+    def clear(self):
+        with self._lock:
+            self._sticky.clear()
+
+    def remove(self, exception=None):
+        if has_app_context():
+            g.pop('read_session', None)
+        for session in list(self._sessions.values()):
+            session.remove()
+
+reads = ReadSessions()
+
+def _bench_worker(write_engine, read_engine, tables, deadline, write_ratio, counts, latencies, lock):
+    messages = tables['message']
+    rng = random.Random()
+    local = {'reads': 0, 'writes': 0, 'errors': 0}
+    samples = []
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                with write_engine.begin() as connection:
+                    connection.execute(messages.insert().values(
+                        sender_id=rng.randint(1, 100), recipient_id=rng.randint(1, 100), message_text='benchmark'))
+                local['writes'] += 1
+            else:
+                with read_engine.connect() as connection:
+                    connection.execute(messages.select()
+                                       .where(messages.c.recipient_id == rng.randint(1, 100))
+                                       .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+                                       .limit(50)).fetchall()
+                local['reads'] += 1
+            samples.append(time.perf_counter() - started)
+        except Exception:
+            local['errors'] += 1
+    with lock:
+        for name, value in local.items():
+            counts[name] += value
+        latencies.extend(samples)
+
+# Concurrent read/write throughput on a scratch SQLite file: the default engine
+# (one connection per checkout, rollback journal) against the tuned profile with
+# separate read and write pools
+def run_db_benchmark(config, threads=8, seconds=5, write_ratio=0.2, seed_rows=20000):
+    from backend import db
+    report = []
+    for tuned in (False, True):
+        directory = tempfile.mkdtemp(prefix='db-bench-')
+        sa_url = make_url('sqlite:///' + os.path.join(directory, 'bench.db'))
+        if tuned:
+            options = engine_profile(config, sa_url, {})
+            write_engine = build_engine(sa_url, options)
+            read_engine = build_engine(sa_url, options, read_only=True)
+        else:
+            write_engine = read_engine = create_engine(sa_url)
+        db.metadata.create_all(write_engine)
+        tables = db.metadata.tables
+        with write_engine.begin() as connection:
+            connection.execute(tables['message'].insert(), [
+                {'sender_id': i % 100 + 1, 'recipient_id': (i * 7) % 100 + 1, 'message_text': 'seed'}
+                for i in range(seed_rows)])
+
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        latencies = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+        workers = [threading.Thread(target=_bench_worker, args=(write_engine, read_engine, tables, deadline,
+                                                                write_ratio, counts, latencies, lock))
+                   for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        write_engine.dispose()
+        read_engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+        latencies.sort()
+        report.append({
+            'profile': 'tuned' if tuned else 'default',
+            'reads_per_second': counts['reads'] / seconds,
+            'writes_per_second': counts['writes'] / seconds,
+            'errors': counts['errors'],
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+        })
+    return report
@@ -0,0 +1,140 @@
+from backend import db
+from backend.database import reads
+from backend.models import Comment, ForumPost, Report, Vote
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, event, func, inspect, select
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+post_table = ForumPost.__table__
+comment_table = Comment.__table__
+
+# Report counts for a page of comments, in one grouped query instead of touching
+# the lazy `reports` relationship once per row
+def report_counts(column, ids):
+    return dict(reads.query(column, func.count(Report.id)).filter(column.in_(ids)).group_by(column))
+
+# Computed fields for keyset_page(); scores are stored on the rows themselves
+COMMENT_AGGREGATES = {
+    'report_count': lambda ids: report_counts(Report.comment_id, ids),
+}
+
+
+# Add a vote delta to a post's or comment's score on the given connection.
+# Runs inside the flush that wrote the Vote row, so both commit or roll back together.
+def apply_vote_delta(connection, table, row_id, score_delta, count_delta):
+    if row_id is None or (not score_delta and not count_delta):
+        return
+    connection.execute(
+        table.update()
+        .where(table.c.id == row_id)
+        .values(score=table.c.score + score_delta, vote_count=table.c.vote_count + count_delta)
+    )
+
+
+def _apply_vote(connection, post_id, comment_id, value, sign):
+    apply_vote_delta(connection, post_table, post_id, sign * value, sign)
+    apply_vote_delta(connection, comment_table, comment_id, sign * value, sign)
+
+
+@event.listens_for(Vote, 'after_insert')
+def _vote_inserted(mapper, connection, target):
+    _apply_vote(connection, target.post_id, target.comment_id, target.value, 1)
+
+
+@event.listens_for(Vote, 'after_delete')
+def _vote_deleted(mapper, connection, target):
+    _apply_vote(connection, target.post_id, target.comment_id, target.value, -1)
+
+
+@event.listens_for(Vote, 'after_update')
+def _vote_updated(mapper, connection, target):
+    state = inspect(target)
+    histories = [state.attrs[name].history for name in ('post_id', 'comment_id', 'value')]
+    if not any(history.has_changes() for history in histories):
+        return
+    old_post_id, old_comment_id, old_value = [history.deleted[0] if history.deleted else current
+                                              for history, current in zip(histories, (target.post_id,
+                                                                                      target.comment_id,
+                                                                                      target.value))]
+    _apply_vote(connection, old_post_id, old_comment_id, old_value, -1)
+    _apply_vote(connection, target.post_id, target.comment_id, target.value, 1)
+
+
+# Recount score/vote_count from the Vote table, e.g. after importing votes in bulk
+def rebuild_vote_scores():
+    for table, column in ((post_table, Vote.post_id), (comment_table, Vote.comment_id)):
+        score = select(func.coalesce(func.sum(Vote.value), 0)).where(column == table.c.id).scalar_subquery()
+        count = select(func.count(Vote.id)).where(column == table.c.id).scalar_subquery()
+        db.session.execute(table.update().values(score=score, vote_count=count))
+    db.session.commit()
+
+
+# Gravity-decayed score: newer items need fewer votes to rank
+def hot_score(score, created, now, gravity):
+    age_hours = max((now - created).total_seconds() / 3600, 0) if created else 0
+    return score / (age_hours + 2) ** gravity
+
+
+# Refresh hot_score for items newer than HOT_WINDOW_DAYS; older items drop to 0
+def recompute_hot_scores(config, now=None):
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=config.get('HOT_WINDOW_DAYS', 7))
+    gravity = config.get('HOT_GRAVITY', 1.8)
+    updated = 0
+    for table in (post_table, comment_table):
+        rows = db.session.execute(
+            select(table.c.id, table.c.score, table.c.timestamp).where(table.c.timestamp >= cutoff)).all()
+        if rows:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(hot_score=bindparam('hot')),
+                [{'row_id': row_id, 'hot': hot_score(score, created, now, gravity)}
+                 for row_id, score, created in rows])
+        db.session.execute(
+            table.update().where(table.c.timestamp < cutoff, table.c.hot_score != 0).values(hot_score=0))
+        updated += len(rows)
+    db.session.commit()
+    return updated
+
+
+# Background thread that runs recompute_hot_scores() every HOT_RECOMPUTE_SECONDS.
+# init_app only reads the settings; the app calls start() when it begins serving,
+# unless HOT_RANKER_ENABLED is off or the interval is 0.
+class HotRanker:
+    def __init__(self):
+        self._stopping = threading.Event()
+        self._thread = None
+        self.app = None
+        self.interval = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('HOT_RECOMPUTE_SECONDS', 300)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('HOT_RANKER_ENABLED', True) and bool(self.interval)
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='hot-ranker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    recompute_hot_scores(self.app.config)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Hot score recompute failed')
+
+    def stop(self):
+        self._stopping.set()
+        self._thread = None
+
+
+hot_ranker = HotRanker()
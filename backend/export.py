@@ -0,0 +1,83 @@
+from backend.database import reads
+from backend.models import Comment, Message, Progress
+from datetime import datetime
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy import or_
+import json
+import zlib
+
+# Exportable histories: model, exported columns, and the per-user filter
+EXPORTS = {
+    'progress': (Progress, ('id', 'user_id', 'problem_id', 'status', 'timestamp'),
+                 lambda user_id: Progress.user_id == user_id),
+    'messages': (Message, ('id', 'sender_id', 'recipient_id', 'message_text', 'timestamp'),
+                 lambda user_id: or_(Message.sender_id == user_id, Message.recipient_id == user_id)),
+    'comments': (Comment, ('id', 'discussion_id', 'user_id', 'comment_text', 'timestamp'),
+                 lambda user_id: Comment.user_id == user_id),
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+BUFFER_SIZE = 64 * 1024
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _ndjson(rows, fields):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), default=_json_default) + '\n'
+
+# A JSON array written element by element, so it never exists in memory as a whole
+def _json_array(rows, fields):
+    separator = '['
+    for row in rows:
+        yield separator + json.dumps(dict(zip(fields, row)), default=_json_default)
+        separator = ',\n'
+    yield '[]' if separator == '[' else ']'
+
+# Coalesce small chunks into buffers of roughly BUFFER_SIZE bytes
+def _buffered(chunks):
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def _gzipped(blocks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def wants_gzip():
+    return request.args.get('gzip') == '1' or 'gzip' in request.headers.get('Accept-Encoding', '')
+
+# Stream a history as NDJSON (or a JSON array), reading it with a server-side cursor.
+# Memory use is bounded by the yield_per batch and the output buffer, not the row count.
+def export_response(resource, user_id=None, fmt='ndjson', gzip=False):
+    model, fields, user_filter = EXPORTS[resource]
+    query = reads.query(*[getattr(model, name) for name in fields])
+    if user_id is not None:
+        query = query.filter(user_filter(user_id))
+    rows = query.order_by(model.id).yield_per(current_app.config.get('EXPORT_CHUNK_SIZE', 1000))
+
+    body = _buffered(_ndjson(rows, fields) if fmt == 'ndjson' else _json_array(rows, fields))
+    headers = {'Content-Disposition': f'attachment; filename={resource}.{fmt}', 'Vary': 'Accept-Encoding'}
+    if gzip:
+        body = _gzipped(body, current_app.config.get('EXPORT_GZIP_LEVEL', 6))
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype=FORMATS[fmt], headers=headers)
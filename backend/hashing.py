@@ -0,0 +1,111 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import bcrypt
+import os
+import sys
+import threading
+import time
+
+class HasherSaturated(Exception):
+    pass
+
+# Module-level so they can be shipped to a process pool
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check_password(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+# Under eventlet/gevent the pool's threads are green and bcrypt would block the hub
+def _green_threads():
+    eventlet = sys.modules.get('eventlet.patcher')
+    if eventlet is not None and eventlet.is_monkey_patched('thread'):
+        return True
+    gevent = sys.modules.get('gevent.monkey')
+    return gevent is not None and gevent.is_module_patched('threading')
+
+# Runs bcrypt off the request thread on a bounded worker pool.
+# At most PASSWORD_HASH_MAX_PENDING hashes may be queued or running; beyond that
+# callers get HasherSaturated straight away instead of piling up behind the pool.
+# A hash that outlives PASSWORD_HASH_TIMEOUT also raises HasherSaturated, but keeps its
+# slot until the worker actually finishes it. PASSWORD_HASH_EXECUTOR='auto' picks the
+# process pool when eventlet/gevent has patched threading, the thread pool otherwise.
+class PasswordHasher:
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def init_app(self, app):
+        self.executor_kind = app.config.get('PASSWORD_HASH_EXECUTOR', 'auto')
+        if self.executor_kind == 'auto':
+            self.executor_kind = 'process' if _green_threads() else 'thread'
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING') or self.workers * 4
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            executor_class = ProcessPoolExecutor if self.executor_kind == 'process' else ThreadPoolExecutor
+            self._executor = executor_class(max_workers=self.workers)
+        return self._executor
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.in_flight >= self.max_pending:
+                self.rejected += 1
+                raise HasherSaturated()
+            self.in_flight += 1
+            executor = self._pool()
+        started = time.monotonic()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            with self._lock:
+                self.in_flight -= 1
+            raise
+        future.add_done_callback(lambda _: self._finished(started))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.timed_out += 1
+            raise HasherSaturated() from None
+
+    # Runs when the worker is done, so an abandoned hash holds its slot until then
+    def _finished(self, started):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def generate_password_hash(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        return self._run(_check_password, pw_hash, password)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'password_hash_workers': self.workers,
+                'password_hash_in_flight': self.in_flight,
+                'password_hash_utilization': min(self.in_flight, self.workers) / self.workers,
+                'password_hash_rejected_total': self.rejected,
+                'password_hash_timeouts_total': self.timed_out,
+                'password_hash_latency_seconds_count': self.completed,
+                'password_hash_latency_seconds_sum': self.latency_total,
+                'password_hash_latency_seconds_max': self.latency_max,
+            }
+
+password_hasher = PasswordHasher()
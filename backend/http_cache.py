@@ -0,0 +1,185 @@
+from backend.models import DiscussionPost, DiscussionTopic, Hint
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+from flask import current_app, make_response, request
+from functools import wraps
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+import hashlib
+import threading
+import time
+
+# Cached resources: model -> (resource name, attribute that scopes it, or None)
+RESOURCES = {
+    DiscussionTopic: ('discussion_topics', None),
+    Hint: ('hints', 'problem_id'),
+    DiscussionPost: ('discussion_posts', 'topic_id'),
+}
+
+# Response cache for read-mostly list endpoints.
+# Each resource (e.g. the hints of one problem) has a version counter that is bumped
+# once a transaction touching it commits. Cached entries hold the serialized body,
+# a strong ETag derived from it and the resource's Last-Modified, and are served
+# while their version is current, so an unchanged read costs neither a query nor
+# serialization, and a matching If-None-Match / If-Modified-Since gets a 304.
+# Counters are per process; HTTP_CACHE_TTL bounds how long another worker's write
+# can go unseen. Entries are evicted least recently used beyond HTTP_CACHE_MAX_BYTES.
+class ResponseCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._modified = {}
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._started = datetime.now(timezone.utc).replace(microsecond=0)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._modified[key] = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def _state(self, key):
+        with self._lock:
+            return self._versions.get(key, 0), self._modified.get(key, self._started)
+
+    def _lookup(self, path, version):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry['version'] != version or entry['expires'] <= time.monotonic():
+                return None
+            self._entries.move_to_end(path)
+            return entry
+
+    def _store(self, path, entry):
+        max_bytes = current_app.config.get('HTTP_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        if len(entry['body']) > max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._bytes -= len(previous['body'])
+            self._entries[path] = entry
+            self._bytes += len(entry['body'])
+            while self._bytes > max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted['body'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @staticmethod
+    def _is_fresh(entry):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return entry['etag'] in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return entry['last_modified'] <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _respond(self, entry):
+        if self._is_fresh(entry):
+            self.not_modified += 1
+            response = make_response('', 304)
+        else:
+            response = make_response(entry['body'], 200)
+            response.mimetype = 'application/json'
+            for name, value in entry['headers'].items():
+                response.headers[name] = value
+        response.headers['ETag'] = entry['etag']
+        response.headers['Last-Modified'] = format_datetime(entry['last_modified'], usegmt=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    # Decorator for a GET view; `key` maps the view's arguments to its resource key
+    def cached(self, key):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not current_app.config.get('HTTP_CACHE_ENABLED', True):
+                    return view(*args, **kwargs)
+                resource = key(**kwargs)
+                version, last_modified = self._state(resource)
+                path = request.full_path
+                entry = self._lookup(path, version)
+                if entry is not None:
+                    self.hits += 1
+                    return self._respond(entry)
+
+                self.misses += 1
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = {
+                    'version': version,
+                    'body': body,
+                    'etag': '"' + hashlib.sha1(body).hexdigest() + '"',
+                    'last_modified': last_modified,
+                    'headers': {name: value for name, value in response.headers.items()
+                                if name.startswith('X-')},
+                    'expires': time.monotonic() + current_app.config.get('HTTP_CACHE_TTL', 30),
+                }
+                self._store(path, entry)
+                return self._respond(entry)
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'http_cache_entries': len(self._entries),
+                'http_cache_bytes': self._bytes,
+                'http_cache_hits_total': self.hits,
+                'http_cache_misses_total': self.misses,
+                'http_cache_not_modified_total': self.not_modified,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def resource_keys(model, target):
+    name, scope = RESOURCES[model]
+    if scope is None:
+        return [(name,)]
+    keys = [(name, getattr(target, scope))]
+    # An update that moved the row also changes the resource it left
+    keys += [(name, previous) for previous in inspect(target).attrs[scope].history.deleted]
+    return keys
+
+
+# Versions are bumped only once the transaction commits
+def _resource_changed(mapper, connection, target):
+    session = object_session(target)
+    keys = resource_keys(mapper.class_, target)
+    if session is None:
+        for key in keys:
+            response_cache.bump(key)
+    else:
+        session.info.setdefault('changed_resources', set()).update(keys)
+
+
+for _model in RESOURCES:
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _resource_changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_committed_resources(session):
+    for key in session.info.pop('changed_resources', ()):
+        response_cache.bump(key)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_resources(session, previous_transaction):
+    session.info.pop('changed_resources', None)
@@ -0,0 +1,67 @@
+from backend.models import User
+from collections import OrderedDict
+from flask import current_app
+import threading
+import time
+
+STAFF_ROLES = ('teacher', 'admin')
+
+# Short-TTL LRU of the user fields that JWT claims carry, keyed by user id.
+# Lets token checks and read-mostly handlers skip the per-request User lookup;
+# update_profile invalidates the entry, and the TTL bounds staleness across processes.
+class UserCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        user = User.query.get(user_id)
+        snapshot = {
+            'user_id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'token_version': user.token_version or 0,
+            'role': user.role
+        } if user else None
+
+        with self._lock:
+            self._entries[user_id] = (now + current_app.config.get('USER_CACHE_TTL', 30), snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > current_app.config.get('USER_CACHE_SIZE', 10000):
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+user_cache = UserCache()
+
+# JWT identity for a user; the claims double as the cached profile
+def identity_for(user):
+    return {'user_id': user.id, 'username': user.username, 'email': user.email,
+            'token_version': user.token_version or 0}
+
+# True when the token's claims predate the user's latest profile change (or the user is gone)
+def is_stale(identity):
+    if not isinstance(identity, dict) or 'user_id' not in identity:
+        return True
+    current = user_cache.get(identity['user_id'])
+    return current is None or current['token_version'] != identity.get('token_version', 0)
+
+# True for teachers and admins. The role is read through the user cache rather than
+# the token, so a demotion takes effect within USER_CACHE_TTL.
+def is_staff(identity):
+    current = user_cache.get(identity['user_id'])
+    return current is not None and current['role'] in STAFF_ROLES
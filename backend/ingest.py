@@ -0,0 +1,199 @@
+from backend import db
+from backend.catalog import catalog
+from backend.http_cache import response_cache
+from backend.models import DIFFICULTY_RATINGS, Hint, Problem, Progress, Tutorial, User
+from backend.ratings import apply_attempts
+from backend.search import SOURCES as SEARCH_SOURCES, index_new_rows
+from backend.stats import COMPLETED, apply_stats_delta
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+import json
+
+# Bulk-loadable models: required fields, optional fields, and foreign keys checked per chunk.
+# A field type may also be a tuple of the allowed string values.
+SPECS = {
+    'problems': (Problem, {'question': str, 'difficulty': tuple(DIFFICULTY_RATINGS)}, {'id': int, 'feedback': str},
+                 {}),
+    'hints': (Hint, {'problem_id': int, 'hint_text': str}, {'timestamp': datetime}, {'problem_id': Problem}),
+    'tutorials': (Tutorial, {'title': str, 'content': str}, {'problem_id': int},
+                  {'problem_id': Problem}),
+    'progress': (Progress, {'user_id': int, 'problem_id': int, 'status': str}, {'timestamp': datetime},
+                 {'user_id': User, 'problem_id': Problem}),
+}
+
+# A record that could not even be parsed (bad NDJSON line, non-object array item)
+class InvalidRecord:
+    def __init__(self, message):
+        self.message = message
+
+def parse_ndjson(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield InvalidRecord(f'Invalid JSON: {error}')
+
+def _check_value(model, name, expected, value):
+    if expected is int:
+        if not isinstance(value, int) or isinstance(value, bool):
+            return f'{name} must be an integer'
+    elif expected is datetime:
+        try:
+            return datetime.fromisoformat(value) if isinstance(value, str) else f'{name} must be an ISO timestamp'
+        except ValueError:
+            return f'{name} must be an ISO timestamp'
+    elif isinstance(expected, tuple):
+        if value not in expected:
+            return f'{name} must be one of {", ".join(expected)}'
+    elif not isinstance(value, str) or not value:
+        return f'{name} must be a non-empty string'
+    else:
+        length = getattr(model.__table__.c[name].type, 'length', None)
+        if length and len(value) > length:
+            return f'{name} is longer than {length} characters'
+    return None
+
+# Return (mapping, errors) for one input record
+def validate(kind, record):
+    model, required, optional, _ = SPECS[kind]
+    if isinstance(record, InvalidRecord):
+        return None, [record.message]
+    if not isinstance(record, dict):
+        return None, ['Record must be a JSON object']
+
+    errors = [f'Unknown field {name}' for name in record if name not in required and name not in optional]
+    errors += [f'Missing {name}' for name in required if record.get(name) is None]
+    mapping = {}
+    for name, expected in {**required, **optional}.items():
+        if record.get(name) is None:
+            continue
+        problem = _check_value(model, name, expected, record[name])
+        if isinstance(problem, datetime):
+            mapping[name] = problem
+        elif problem:
+            errors.append(problem)
+        else:
+            mapping[name] = record[name]
+    return mapping, errors
+
+class _Summary:
+    def __init__(self, max_errors):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def reject(self, index, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'index': index, 'errors': errors})
+
+    def as_dict(self):
+        return {'inserted': self.inserted, 'failed': self.failed, 'errors': self.errors}
+
+# Drop rows whose foreign keys point at missing rows, with one IN query per key per chunk
+def _check_references(kind, chunk, summary):
+    references = SPECS[kind][3]
+    missing = {}
+    for name, target in references.items():
+        wanted = {mapping[name] for _, mapping in chunk if name in mapping}
+        if wanted:
+            found = set(db.session.execute(select(target.id).where(target.id.in_(wanted))).scalars())
+            missing[name] = wanted - found
+    valid = []
+    for index, mapping in chunk:
+        errors = [f'{name} {mapping[name]} does not exist' for name in missing if mapping.get(name) in missing[name]]
+        if errors:
+            summary.reject(index, errors)
+        else:
+            valid.append((index, mapping))
+    return valid
+
+# bulk_insert_mappings bypasses mapper events, so apply the UserStats deltas for the chunk
+# here, then rate its attempts in input order in one grouped pass
+def _apply_progress_stats(mappings):
+    connection = db.session.connection()
+    deltas = defaultdict(lambda: [0, 0])
+    attempts = []
+    for mapping in mappings:
+        solved = mapping['status'] == COMPLETED
+        attempts.append((mapping['user_id'], mapping['problem_id'], solved))
+        delta = deltas[mapping['user_id']]
+        delta[0] += 1
+        delta[1] += 1 if solved else 0
+    for user_id, (total, correct) in deltas.items():
+        apply_stats_delta(connection, user_id, total, correct)
+    apply_attempts(connection, attempts)
+
+def _insert(kind, mappings):
+    model = SPECS[kind][0]
+    searchable = model in SEARCH_SOURCES
+    if searchable:
+        last_id = db.session.execute(select(func.max(model.id))).scalar()
+    db.session.bulk_insert_mappings(model, mappings)
+    if kind == 'progress':
+        _apply_progress_stats(mappings)
+    if searchable:
+        # bulk_insert_mappings also skips the listeners that keep the search index in step
+        index_new_rows(model, last_id, [mapping['id'] for mapping in mappings if 'id' in mapping])
+    db.session.commit()
+
+def _after_commit(kind, mappings):
+    if kind == 'problems':
+        catalog.invalidate()
+    elif kind == 'progress':
+        for user_id in {mapping['user_id'] for mapping in mappings}:
+            catalog.forget_user(user_id)
+    elif kind == 'hints':
+        # bulk_insert_mappings skips the mapper events that bump cached hint lists
+        for problem_id in {mapping['problem_id'] for mapping in mappings}:
+            response_cache.bump(('hints', problem_id))
+
+def _flush(kind, chunk, summary):
+    chunk = _check_references(kind, chunk, summary)
+    if not chunk:
+        return
+    mappings = [mapping for _, mapping in chunk]
+    try:
+        _insert(kind, mappings)
+        summary.inserted += len(mappings)
+    except IntegrityError:
+        # Something in the chunk conflicts (e.g. a duplicate id); retry row by row to isolate it
+        db.session.rollback()
+        mappings = []
+        for index, mapping in chunk:
+            try:
+                _insert(kind, [mapping])
+                summary.inserted += 1
+                mappings.append(mapping)
+            except IntegrityError as error:
+                db.session.rollback()
+                summary.reject(index, [str(error.orig)])
+    _after_commit(kind, mappings)
+
+# Validate and insert records in chunks of `chunk_size` (at most INGEST_MAX_CHUNK_SIZE),
+# committing each chunk. Invalid rows are reported by their position in the input and skipped.
+def ingest(kind, records, chunk_size=None):
+    chunk_size = chunk_size or current_app.config.get('INGEST_CHUNK_SIZE', 1000)
+    chunk_size = max(1, min(chunk_size, current_app.config.get('INGEST_MAX_CHUNK_SIZE', 10000)))
+    summary = _Summary(current_app.config.get('INGEST_MAX_ERRORS', 1000))
+    chunk = []
+    for index, record in enumerate(records):
+        mapping, errors = validate(kind, record)
+        if errors:
+            summary.reject(index, errors)
+            continue
+        chunk.append((index, mapping))
+        if len(chunk) >= chunk_size:
+            _flush(kind, chunk, summary)
+            chunk = []
+    if chunk:
+        _flush(kind, chunk, summary)
+    return summary.as_dict()
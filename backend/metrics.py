@@ -0,0 +1,195 @@
+from collections import Counter, defaultdict
+from flask import current_app, g, has_app_context, has_request_context, request
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import re
+import threading
+import time
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Runs of bound parameters (expanded IN lists) and literals collapse to one placeholder
+_PLACEHOLDERS = re.compile(r"(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))+|\b\d+\b|'[^']*'")
+
+class RepeatedQueryError(RuntimeError):
+    pass
+
+def statement_shape(statement):
+    return _PLACEHOLDERS.sub('?', ' '.join(statement.split()))
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+# Cumulative histogram in the Prometheus text format, one series per label set
+class Histogram:
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = buckets
+        self._series = {}
+
+    # Callers hold the registry lock
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += 1
+        series[2] += value
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, value_sum) in self._series.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{_labels(labels + (("le", bound),))}}} {count}')
+            lines.append(f'{self.name}_bucket{{{_labels(labels + (("le", "+Inf"),))}}} {total}')
+            lines.append(f'{self.name}_sum{{{_labels(labels)}}} {value_sum}')
+            lines.append(f'{self.name}_count{{{_labels(labels)}}} {total}')
+        return lines
+
+# Events per second over a sliding window of one-second slots
+class EventRate:
+    def __init__(self, window=60):
+        self.window = window
+        self.total = 0
+        self._slots = defaultdict(int)
+
+    # Callers hold the registry lock
+    def mark(self, now):
+        second = int(now)
+        self.total += 1
+        self._slots[second] += 1
+        if len(self._slots) > self.window * 2:
+            for stale in [slot for slot in self._slots if slot <= second - self.window]:
+                del self._slots[stale]
+
+    def rate(self, now):
+        second = int(now)
+        return sum(count for slot, count in self._slots.items() if slot > second - self.window) / self.window
+
+# Per-request wall time, SQL statement count and SQL time (from engine cursor events),
+# response size and Socket.IO event rates, kept in memory and rendered at /metrics.
+# Statements slower than SLOW_QUERY_MS and requests slower than SLOW_REQUEST_MS are logged.
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.app = None
+        self.durations = Histogram('http_request_duration_seconds', DURATION_BUCKETS)
+        self.statements = Histogram('http_request_sql_statements', COUNT_BUCKETS)
+        self.sql_time = Histogram('http_request_sql_seconds', DURATION_BUCKETS)
+        self.sizes = Histogram('http_response_size_bytes', SIZE_BUCKETS)
+        self.socket_handlers = Histogram('socketio_handler_duration_seconds', DURATION_BUCKETS)
+        self.socket_rates = defaultdict(EventRate)
+        self.status_counts = defaultdict(int)
+        self.slow_queries = 0
+        self.slow_requests = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_MS', 200) / 1000
+        self.slow_request_seconds = app.config.get('SLOW_REQUEST_MS', 1000) / 1000
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(Engine, 'handle_error', self._handle_error)
+
+    def _start_request(self):
+        # N+1 guard: QUERY_SHAPE_LIMIT SELECTs of one shape per request, 10 under app.testing, 0 = off
+        shape_limit = current_app.config.get('QUERY_SHAPE_LIMIT')
+        if shape_limit is None and current_app.testing:
+            shape_limit = 10
+        g.request_metrics = {'started': time.perf_counter(), 'statements': 0, 'sql_seconds': 0.0,
+                             'shapes': Counter(), 'shape_limit': shape_limit}
+
+    def _finish_request(self, response):
+        stats = g.pop('request_metrics', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats['started']
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        labels = (('method', request.method), ('route', route))
+        with self._lock:
+            self.durations.observe(labels, elapsed)
+            self.statements.observe(labels, stats['statements'])
+            self.sql_time.observe(labels, stats['sql_seconds'])
+            # Streamed responses (exports) have no length up front
+            if response.content_length is not None:
+                self.sizes.observe(labels, response.content_length)
+            self.status_counts[labels + (('status', response.status_code),)] += 1
+            if elapsed >= self.slow_request_seconds:
+                self.slow_requests += 1
+        if elapsed >= self.slow_request_seconds:
+            self.app.logger.warning('Slow request %s %s: %.3fs, %d SQL statements in %.3fs',
+                                    request.method, route, elapsed, stats['statements'], stats['sql_seconds'])
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append((context, time.perf_counter()))
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()[1]
+        in_request = has_request_context() and has_app_context()
+        stats = g.get('request_metrics') if in_request else None
+        if stats is not None:
+            stats['statements'] += 1
+            stats['sql_seconds'] += elapsed
+            if stats['shape_limit'] and statement.lstrip()[:6].upper() == 'SELECT':
+                shape = statement_shape(statement)
+                stats['shapes'][shape] += 1
+                if stats['shapes'][shape] > stats['shape_limit']:
+                    raise RepeatedQueryError(f'{stats["shapes"][shape]} queries of one shape in '
+                                             f'{request.method} {request.path}: {shape[:300]}')
+        if elapsed >= self.slow_query_seconds:
+            with self._lock:
+                self.slow_queries += 1
+            self.app.logger.warning('Slow query (%.3fs) in %s: %s', elapsed,
+                                    request.url_rule.rule if in_request and request.url_rule else 'background',
+                                    ' '.join(statement.split())[:500])
+
+    # A statement that fails in the driver never reaches after_cursor_execute; drop its
+    # start time so the next statement on this connection is not timed against it.
+    # Errors raised after that (e.g. RepeatedQueryError) find their entry already gone.
+    def _handle_error(self, context):
+        if context.connection is None:
+            return
+        started = context.connection.info.get('query_started')
+        if started and started[-1][0] is context.execution_context:
+            started.pop()
+
+    # Decorator for Socket.IO handlers: event rate and handler time per event name
+    def socket_event(self, name):
+        def decorator(handler):
+            @wraps(handler)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    with self._lock:
+                        self.socket_rates[name].mark(time.time())
+                        self.socket_handlers.observe((('event', name),), elapsed)
+            return wrapper
+        return decorator
+
+    def render(self):
+        now = time.time()
+        with self._lock:
+            lines = [f'http_requests_total{{{_labels(labels)}}} {count}'
+                     for labels, count in self.status_counts.items()]
+            for histogram in (self.durations, self.statements, self.sql_time, self.sizes, self.socket_handlers):
+                lines += histogram.render()
+            for name, rate in self.socket_rates.items():
+                lines.append(f'socketio_events_total{{event="{name}"}} {rate.total}')
+                lines.append(f'socketio_events_per_second{{event="{name}"}} {rate.rate(now):.3f}')
+            lines.append(f'sql_slow_queries_total {self.slow_queries}')
+            lines.append(f'http_slow_requests_total {self.slow_requests}')
+            return lines
+
+request_metrics = RequestMetrics()
@@ -7,6 +7,8 @@ class User(db.Model):
     email = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
     registered_on = db.Column(db.DateTime, default=datetime.utcnow)
+    token_version = db.Column(db.Integer, nullable=False, default=0)  # Bumped on profile changes to expire old JWT claims
+    role = db.Column(db.String(20), nullable=False, default='student')  # 'student', 'teacher' or 'admin'
     progress = db.relationship('Progress', backref='user', lazy=True)
     feedback = db.relationship('Feedback', backref='user', lazy=True)
     badges = db.relationship('Badge', backref='user', lazy=True)
@@ -15,19 +17,45 @@ class User(db.Model):
     comments = db.relationship('Comment', backref='user', lazy=True)
     votes = db.relationship('Vote', backref='user', lazy=True)
     reports = db.relationship('Report', backref='user', lazy=True)
+    stats = db.relationship('UserStats', backref='user', uselist=False, lazy=True)
 
 class Progress(db.Model):
+    __table_args__ = (
+        db.Index('ix_progress_user_problem', 'user_id', 'problem_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     problem_id = db.Column(db.Integer, db.ForeignKey('problem.id'), nullable=False)
     status = db.Column(db.String(50), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+# Per-user attempt counters, kept in step with Progress by backend.stats
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_problems = db.Column(db.Integer, nullable=False, default=0)
+    correct_answers = db.Column(db.Integer, nullable=False, default=0)
+    rating = db.Column(db.Float, nullable=False, default=0.0)  # Skill on the logit scale (backend/ratings.py)
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0)  # Kept by backend/notifications.py
+    updated_on = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Starting problem rating on the logit scale, from the authored difficulty
+DIFFICULTY_RATINGS = {'easy': -1.0, 'medium': 0.0, 'hard': 1.0}
+
+def initial_rating(context):
+    return DIFFICULTY_RATINGS.get(context.get_current_parameters().get('difficulty'), 0.0)
+
 class Problem(db.Model):
+    __table_args__ = (
+        db.Index('ix_problem_difficulty_id', 'difficulty', 'id'),
+        db.Index('ix_problem_rating', 'rating', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     question = db.Column(db.String(1000), nullable=False)
+    answer = db.Column(db.String(1000))
     difficulty = db.Column(db.String(50), nullable=False)
     feedback = db.Column(db.String(1000))
+    rating = db.Column(db.Float, nullable=False, default=initial_rating)
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
     hints = db.relationship('Hint', backref='problem', lazy=True)
 
 class Feedback(db.Model):
@@ -44,11 +72,15 @@ class Badge(db.Model):
     date_awarded = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Notification(db.Model):
+    __table_args__ = (
+        db.Index('ix_notification_user_date', 'user_id', 'date_sent', 'id'),
+        db.Index('ix_notification_user_unread', 'user_id', 'is_read', 'date_sent', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     message = db.Column(db.String(500), nullable=False)
     date_sent = db.Column(db.DateTime, default=datetime.utcnow)
-    is_read = db.Column(db.Boolean, default=False)
+    is_read = db.Column(db.Boolean, nullable=False, default=False)
 
 class Tutorial(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,37 +90,69 @@ class Tutorial(db.Model):
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
 
 class LearningPath(db.Model):
+    __table_args__ = (
+        db.Index('ix_learning_path_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     path_description = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Hint(db.Model):
+    __table_args__ = (
+        db.Index('ix_hint_problem_timestamp', 'problem_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     problem_id = db.Column(db.Integer, db.ForeignKey('problem.id'), nullable=False)
     hint_text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Comment(db.Model):
+    __table_args__ = (
+        db.Index('ix_comment_discussion_timestamp', 'discussion_id', 'timestamp', 'id'),
+        db.Index('ix_comment_discussion_score', 'discussion_id', 'score', 'id'),
+        db.Index('ix_comment_discussion_hot', 'discussion_id', 'hot_score', 'id'),
+        db.Index('ix_comment_timestamp', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     discussion_id = db.Column(db.Integer, nullable=False)  # Reference to discussion (optional, could link to another model)
+    post_id = db.Column(db.Integer, db.ForeignKey('forum_post.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     comment_text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Maintained from Vote writes (backend/engagement.py); hot_score is recomputed periodically
+    score = db.Column(db.Integer, nullable=False, default=0)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)
+    hot_score = db.Column(db.Float, nullable=False, default=0)
     votes = db.relationship('Vote', backref='comment', lazy=True)
     reports = db.relationship('Report', backref='comment', lazy=True)
 
 class ForumPost(db.Model):
+    __table_args__ = (
+        db.Index('ix_forum_post_score', 'score', 'id'),
+        db.Index('ix_forum_post_hot', 'hot_score', 'id'),
+        db.Index('ix_forum_post_timestamp', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    score = db.Column(db.Integer, nullable=False, default=0)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)
+    hot_score = db.Column(db.Float, nullable=False, default=0)
     comments = db.relationship('Comment', backref='post', lazy=True)
     votes = db.relationship('Vote', backref='post', lazy=True)
     reports = db.relationship('Report', backref='post', lazy=True)
 
 class Vote(db.Model):
+    # One vote per user per post or comment; the indexes also cover score rebuilds
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_vote_user_post'),
+        db.UniqueConstraint('user_id', 'comment_id', name='uq_vote_user_comment'),
+        db.Index('ix_vote_comment_value', 'comment_id', 'value'),
+        db.Index('ix_vote_post_value', 'post_id', 'value'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('forum_post.id'))
@@ -97,9 +161,89 @@ class Vote(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Report(db.Model):
+    __table_args__ = (
+        db.Index('ix_report_comment', 'comment_id'),
+        db.Index('ix_report_post', 'post_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('forum_post.id'))
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     reason = db.Column(db.String(500), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Follow(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('follower_id', 'followed_id', name='uq_follow_pair'),
+        db.Index('ix_follow_followed', 'followed_id', 'follower_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+# A private thread between two users, stored with the lower user id first
+class Conversation(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversation_pair'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_on = db.Column(db.DateTime, default=datetime.utcnow)
+
+# One row per user per conversation: the inbox entry, kept in step with Message by backend/conversations.py
+class ConversationParticipant(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'user_id', name='uq_conversation_participant'),
+        db.Index('ix_conversation_participant_inbox', 'user_id', 'last_message_at', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    other_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer)
+    last_sender_id = db.Column(db.Integer)
+    last_message_preview = db.Column(db.String(200))
+    last_message_at = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+
+class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_sender_timestamp', 'sender_id', 'timestamp', 'id'),
+        db.Index('ix_message_recipient_timestamp', 'recipient_id', 'timestamp', 'id'),
+        db.Index('ix_message_conversation_timestamp', 'conversation_id', 'timestamp', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Assigned on insert; rows older than conversations get it from `flask backfill-conversations`
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
+    message_text = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Discussion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DiscussionTopic(db.Model):
+    __table_args__ = (
+        db.Index('ix_discussion_topic_timestamp', 'timestamp', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    topic_title = db.Column(db.String(200), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    posts = db.relationship('DiscussionPost', backref='topic', lazy=True)
+
+class DiscussionPost(db.Model):
+    __table_args__ = (
+        db.Index('ix_discussion_post_topic_timestamp', 'topic_id', 'timestamp', 'id'),
+        db.Index('ix_discussion_post_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    topic_id = db.Column(db.Integer, db.ForeignKey('discussion_topic.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
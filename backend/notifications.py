@@ -0,0 +1,209 @@
+from backend import db
+from backend.bus import room_size
+from backend.database import reads
+from backend.models import Follow, ForumPost, Notification, User, UserStats
+from backend.presence import PRIVATE_ROOM_PREFIX
+from datetime import datetime
+from sqlalchemy import case, event, func, inspect, select
+from sqlalchemy.orm import Session, object_session
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+notification_table = Notification.__table__
+stats_table = UserStats.__table__
+
+# Socket.IO room each authenticated connection joins, so a user's live notifications
+# reach every tab and worker they are connected on. Only on_connect joins it, after
+# verifying the token; valid_room() refuses the prefix for client joins.
+def user_room(user_id):
+    return f'{PRIVATE_ROOM_PREFIX}{user_id}'
+
+# Add `delta` to the unread counters of `user_ids` on the given connection, creating
+# missing UserStats rows. Runs in the transaction that wrote the notifications.
+def apply_unread_delta(connection, user_ids, delta):
+    user_ids = list(user_ids)
+    if not user_ids or not delta:
+        return
+    result = connection.execute(
+        stats_table.update()
+        .where(stats_table.c.user_id.in_(user_ids))
+        .values(unread_notifications=stats_table.c.unread_notifications + delta))
+    if result.rowcount < len(user_ids):
+        existing = set(connection.execute(
+            select(stats_table.c.user_id).where(stats_table.c.user_id.in_(user_ids))).scalars())
+        connection.execute(stats_table.insert(), [
+            {'user_id': user_id, 'total_problems': 0, 'correct_answers': 0, 'unread_notifications': delta,
+             'updated_on': datetime.utcnow()}
+            for user_id in user_ids if user_id not in existing])
+
+# Notifications written through the ORM keep the counter in step like Progress does for stats;
+# fan-out writes with Core and applies the delta itself
+@event.listens_for(Notification, 'after_insert')
+def _notification_inserted(mapper, connection, target):
+    if not target.is_read:
+        apply_unread_delta(connection, [target.user_id], 1)
+
+@event.listens_for(Notification, 'after_update')
+def _notification_updated(mapper, connection, target):
+    state = inspect(target)
+    user_history = state.attrs.user_id.history
+    read_history = state.attrs.is_read.history
+    if not user_history.has_changes() and not read_history.has_changes():
+        return
+    old_user_id = user_history.deleted[0] if user_history.deleted else target.user_id
+    was_read = read_history.deleted[0] if read_history.deleted else target.is_read
+    if not was_read:
+        apply_unread_delta(connection, [old_user_id], -1)
+    if not target.is_read:
+        apply_unread_delta(connection, [target.user_id], 1)
+
+@event.listens_for(Notification, 'after_delete')
+def _notification_deleted(mapper, connection, target):
+    if not target.is_read:
+        apply_unread_delta(connection, [target.user_id], -1)
+
+def unread_count(user_id):
+    return reads.session().execute(select(stats_table.c.unread_notifications)
+                                   .where(stats_table.c.user_id == user_id)).scalar() or 0
+
+# Mark every unread notification of a user read with one UPDATE over the
+# (user_id, is_read) index, and take that many off the counter (never below zero,
+# so a fan-out committing concurrently keeps its increment); returns how many changed
+def mark_all_read(user_id):
+    result = db.session.execute(
+        notification_table.update()
+        .where(notification_table.c.user_id == user_id, notification_table.c.is_read.is_(False))
+        .values(is_read=True))
+    if result.rowcount:
+        unread = stats_table.c.unread_notifications
+        db.session.execute(stats_table.update().where(stats_table.c.user_id == user_id).values(
+            unread_notifications=case((unread > result.rowcount, unread - result.rowcount), else_=0)))
+    db.session.commit()
+    return result.rowcount
+
+# Recount unread notifications, e.g. after editing notifications outside the ORM
+def rebuild_unread_counts():
+    unread = select(func.count(Notification.id)).where(
+        Notification.user_id == stats_table.c.user_id, Notification.is_read.is_(False)).scalar_subquery()
+    db.session.execute(stats_table.update().values(unread_notifications=unread))
+    missing = db.session.execute(
+        select(Notification.user_id, func.count(Notification.id))
+        .where(Notification.is_read.is_(False), Notification.user_id.notin_(select(stats_table.c.user_id)))
+        .group_by(Notification.user_id)).all()
+    if missing:
+        db.session.execute(stats_table.insert(), [
+            {'user_id': user_id, 'total_problems': 0, 'correct_answers': 0, 'unread_notifications': count,
+             'updated_on': datetime.utcnow()} for user_id, count in missing])
+    db.session.commit()
+
+# Fan-out on write for new forum posts. The posting transaction only records the post;
+# once it commits, a background worker pages through the author's followers over the
+# (followed_id, follower_id) index and, NOTIFY_CHUNK_SIZE followers at a time, bulk-inserts
+# their notifications, bumps their unread counters and commits, then pushes the
+# notification to followers who are online. A post to 10k followers is ten small
+# transactions off the request path instead of 10k ORM inserts inside it.
+# init_app only reads the settings; the worker starts with the first request or job.
+class NotificationFanout:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self.delivered = 0
+        self.pushed = 0
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.chunk_size = app.config.get('NOTIFY_CHUNK_SIZE', 1000)
+
+    def start(self):
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='notification-fanout', daemon=True)
+                self._worker.start()
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('NOTIFY_FANOUT_ENABLED', True)
+
+    def enqueue(self, job):
+        self.start()
+        self._queue.put(job)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                with self.app.app_context():
+                    try:
+                        self.fan_out(**job)
+                    except Exception:
+                        db.session.rollback()
+                        logger.exception('Notification fan-out for user %s failed', job['author_id'])
+            finally:
+                self._queue.task_done()
+
+    def fan_out(self, author_id, title):
+        username = db.session.execute(select(User.username).where(User.id == author_id)).scalar()
+        message = f'{username or "Someone"} posted: {title}'[:500]
+        last_follower = 0
+        while True:
+            connection = db.session.connection()
+            followers = connection.execute(
+                select(Follow.follower_id)
+                .where(Follow.followed_id == author_id, Follow.follower_id > last_follower)
+                .order_by(Follow.follower_id).limit(self.chunk_size)).scalars().all()
+            if not followers:
+                return
+            date_sent = datetime.utcnow()
+            connection.execute(notification_table.insert(), [
+                {'user_id': follower_id, 'message': message, 'date_sent': date_sent, 'is_read': False}
+                for follower_id in followers])
+            apply_unread_delta(connection, followers, 1)
+            db.session.commit()
+            self.delivered += len(followers)
+            self._push(followers, {'message': message, 'date_sent': date_sent.isoformat()})
+            last_follower = followers[-1]
+
+    # Only users with a connected socket get an emit; the rest read it from /notifications
+    def _push(self, user_ids, payload):
+        manager = self.socketio.server.manager
+        for user_id in user_ids:
+            room = user_room(user_id)
+            if room_size(manager, room):
+                self.socketio.emit('notification', payload, to=room)
+                self.pushed += 1
+
+    # Block until every queued fan-out has finished
+    def flush(self):
+        self._queue.join()
+
+    def metrics(self):
+        return {
+            'notification_fanout_queue': self._queue.qsize(),
+            'notifications_delivered_total': self.delivered,
+            'notifications_pushed_total': self.pushed,
+        }
+
+notifier = NotificationFanout()
+
+# New posts are remembered on the session and handed to the worker only once they commit
+@event.listens_for(ForumPost, 'after_insert')
+def _post_inserted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and notifier.enabled:
+        session.info.setdefault('new_posts', []).append({'author_id': target.user_id, 'title': target.title})
+
+@event.listens_for(Session, 'after_commit')
+def _fan_out_committed_posts(session):
+    for post in session.info.pop('new_posts', ()):
+        notifier.enqueue(post)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_posts(session, previous_transaction):
+    session.info.pop('new_posts', None)
@@ -0,0 +1,79 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import and_, or_
+
+class PaginationError(ValueError):
+    pass
+
+# Cursors are opaque to clients: base64 of "<iso timestamp>|<id>" for the last row served
+def encode_cursor(timestamp, row_id):
+    return urlsafe_b64encode(f'{timestamp.isoformat()}|{row_id}'.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeError):
+        raise PaginationError('Invalid cursor')
+
+def parse_limit():
+    default = current_app.config.get('PAGE_SIZE_DEFAULT', 50)
+    maximum = current_app.config.get('PAGE_SIZE_MAX', 200)
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        raise PaginationError('Invalid limit')
+    if limit < 1:
+        raise PaginationError('Invalid limit')
+    return min(limit, maximum)
+
+# Requested subset of the serializable fields, in their declared order
+def parse_fields(allowed_fields):
+    requested = request.args.get('fields')
+    if not requested:
+        return list(allowed_fields)
+    names = {name.strip() for name in requested.split(',') if name.strip()}
+    unknown = names.difference(allowed_fields)
+    if unknown:
+        raise PaginationError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    return [name for name in allowed_fields if name in names]
+
+# Serve one page of `query` ordered by (timestamp, id), selecting only the requested columns.
+# `computed` maps extra field names to functions taking the page's ids and returning
+# {id: value}, so per-row aggregates cost one query per page rather than per row.
+# `order_by` names the timestamp column; `descending` serves the newest rows first.
+# Returns the row dicts and the cursor for the next page (None on the last page).
+def keyset_page(query, model, allowed_fields, after_param='after', computed=None, order_by='timestamp',
+                descending=False):
+    computed = computed or {}
+    limit = parse_limit()
+    fields = parse_fields(tuple(allowed_fields) + tuple(computed))
+    columns = [name for name in fields if name not in computed]
+    timestamp_column = getattr(model, order_by)
+    query = query.with_entities(*[getattr(model, name) for name in columns], timestamp_column, model.id)
+
+    cursor = request.args.get(after_param)
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        if descending:
+            query = query.filter(or_(timestamp_column < timestamp,
+                                     and_(timestamp_column == timestamp, model.id < row_id)))
+        else:
+            query = query.filter(or_(timestamp_column > timestamp,
+                                     and_(timestamp_column == timestamp, model.id > row_id)))
+
+    order = (timestamp_column.desc(), model.id.desc()) if descending else (timestamp_column, model.id)
+    rows = query.order_by(*order).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1][-2], rows[limit - 1][-1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    items = [dict(zip(columns, row)) for row in rows]
+    ids = [row[-1] for row in rows]
+    for name in fields:
+        if name in computed:
+            values = computed[name](ids) if ids else {}
+            for item, row_id in zip(items, ids):
+                item[name] = values.get(row_id, 0)
+    # Keep the requested field order
+    items = [{name: item[name] for name in fields} for item in items]
+    return items, next_cursor
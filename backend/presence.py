@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+
+ROOM_NAME = re.compile(r'^[\w\-.:]{1,64}$')
+# Rooms the server joins on a client's behalf (per-user notifications); clients cannot name them
+PRIVATE_ROOM_PREFIX = 'user:'
+
+# Socket.IO events that are rate limited; everything else is unmetered
+LIMITED_EVENTS = ('message', 'draw')
+
+def valid_room(data):
+    room = data.get('room') if isinstance(data, dict) else None
+    if not isinstance(room, str) or not ROOM_NAME.match(room) or room.startswith(PRIVATE_ROOM_PREFIX):
+        return None
+    return room
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def allow(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# In-memory index of who is in which room on this worker: room -> {sid: username}
+# and sid -> {rooms}, both updated in O(1) per join/leave. Also holds token buckets
+# per (sid, event) and (room, event) so one client, or one busy room, cannot flood
+# the server with chat or draw events. Buckets go away with the sid or the room.
+class PresenceRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._sids = {}
+        self._sid_buckets = {}
+        self._room_buckets = {}
+        self.limits = {}
+        self.max_rooms_per_sid = 20
+        self.dropped = dict.fromkeys(LIMITED_EVENTS, 0)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._sids.clear()
+            self._sid_buckets.clear()
+            self._room_buckets.clear()
+            self.dropped = dict.fromkeys(LIMITED_EVENTS, 0)
+
+    def init_app(self, app):
+        burst = app.config.get('SOCKET_BURST_SECONDS', 2)
+        # event -> (per-sid rate, per-room rate) in events per second
+        rates = {
+            'message': (app.config.get('SOCKET_SID_MESSAGE_RATE', 5), app.config.get('SOCKET_ROOM_MESSAGE_RATE', 50)),
+            'draw': (app.config.get('SOCKET_SID_DRAW_RATE', 120), app.config.get('SOCKET_ROOM_DRAW_RATE', 1000)),
+        }
+        self.limits = {event: ((sid_rate, sid_rate * burst), (room_rate, room_rate * burst))
+                       for event, (sid_rate, room_rate) in rates.items()}
+        self.max_rooms_per_sid = app.config.get('SOCKET_MAX_ROOMS_PER_SID', 20)
+
+    # Returns False when the sid is already in too many rooms
+    def join(self, sid, room, username=None):
+        with self._lock:
+            rooms = self._sids.setdefault(sid, set())
+            if room not in rooms and len(rooms) >= self.max_rooms_per_sid:
+                return False
+            rooms.add(room)
+            self._rooms.setdefault(room, {})[sid] = username
+            return True
+
+    # Returns False when the sid was not in the room
+    def leave(self, sid, room):
+        with self._lock:
+            return self._leave(sid, room)
+
+    # Callers hold _lock
+    def _leave(self, sid, room):
+        members = self._rooms.get(room)
+        if members is None or sid not in members:
+            return False
+        del members[sid]
+        if not members:
+            del self._rooms[room]
+            for event in LIMITED_EVENTS:
+                self._room_buckets.pop((room, event), None)
+        rooms = self._sids.get(sid)
+        if rooms is not None:
+            rooms.discard(room)
+        return True
+
+    # Drop every trace of a disconnected sid; returns the rooms it was in
+    def disconnect(self, sid):
+        with self._lock:
+            rooms = set(self._sids.get(sid, ()))
+            for room in rooms:
+                self._leave(sid, room)
+            self._sids.pop(sid, None)
+            for event in LIMITED_EVENTS:
+                self._sid_buckets.pop((sid, event), None)
+            return rooms
+
+    def is_member(self, sid, room):
+        with self._lock:
+            return sid in self._rooms.get(room, ())
+
+    def members(self, room):
+        with self._lock:
+            return dict(self._rooms.get(room, {}))
+
+    def rooms_of(self, sid):
+        with self._lock:
+            return set(self._sids.get(sid, ()))
+
+    # Take a token from the sid's bucket, then the room's; False means drop the event
+    def allow(self, sid, room, event):
+        limits = self.limits.get(event)
+        if limits is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            sid_bucket = self._sid_buckets.get((sid, event))
+            if sid_bucket is None:
+                sid_bucket = self._sid_buckets[(sid, event)] = TokenBucket(*limits[0])
+            room_bucket = self._room_buckets.get((room, event))
+            if room_bucket is None:
+                room_bucket = self._room_buckets[(room, event)] = TokenBucket(*limits[1])
+            if sid_bucket.allow(now) and room_bucket.allow(now):
+                return True
+            self.dropped[event] += 1
+            return False
+
+    def metrics(self):
+        with self._lock:
+            values = {'socketio_rooms': len(self._rooms), 'socketio_sessions': len(self._sids)}
+            for event, dropped in self.dropped.items():
+                values[f'socketio_{event}_rate_limited_total'] = dropped
+            return values
+
+presence = PresenceRegistry()
@@ -0,0 +1,415 @@
+from backend import db
+from backend.models import DIFFICULTY_RATINGS, Problem, Progress, User, UserStats
+from backend.stats import COMPLETED
+from datetime import datetime
+from flask import current_app, has_app_context
+from itertools import chain
+from sqlalchemy import and_, bindparam, create_engine, event, exists, func, or_, select
+import math
+import numpy as np
+import os
+import random
+import shutil
+import tempfile
+import time
+
+stats_table = UserStats.__table__
+problem_table = Problem.__table__
+
+# 1PL item response model: a user with skill `theta` solves a problem of difficulty
+# `b` with probability 1 / (1 + e^-(theta - b)). Each attempt moves both ratings by
+# K * (outcome - expected), Elo style, with K shrinking as either side collects attempts.
+def _setting(name, default):
+    return current_app.config.get(name, default) if has_app_context() else default
+
+def expected_score(theta, difficulty):
+    return 1 / (1 + math.exp(difficulty - theta))
+
+def k_factor(attempts):
+    return max(_setting('RATING_K_MIN', 0.05), _setting('RATING_K', 0.4) / math.sqrt(1 + attempts))
+
+# Rate one attempt on the given connection, inside the flush that wrote the Progress row.
+# Two primary-key reads and two updates regardless of history length.
+def apply_attempt(connection, user_id, problem_id, solved):
+    problem = connection.execute(select(problem_table.c.rating, problem_table.c.attempt_count)
+                                 .where(problem_table.c.id == problem_id)).first()
+    if problem is None:
+        return
+    user = connection.execute(select(stats_table.c.rating, stats_table.c.total_problems)
+                              .where(stats_table.c.user_id == user_id)).first()
+    theta, user_attempts = user if user is not None else (0.0, 0)
+    surprise = (1 if solved else 0) - expected_score(theta, problem.rating)
+
+    theta += k_factor(user_attempts) * surprise
+    result = connection.execute(stats_table.update().where(stats_table.c.user_id == user_id)
+                                .values(rating=theta))
+    if result.rowcount == 0:
+        connection.execute(stats_table.insert().values(user_id=user_id, total_problems=0, correct_answers=0,
+                                                       rating=theta, updated_on=datetime.utcnow()))
+    connection.execute(problem_table.update().where(problem_table.c.id == problem_id).values(
+        rating=problem.rating - k_factor(problem.attempt_count) * surprise,
+        attempt_count=problem_table.c.attempt_count + 1))
+
+# Rate a batch of (user_id, problem_id, solved) attempts in order, for loaders that bypass
+# the mapper events. The users' UserStats rows must already count the batch, as they do once
+# the stats deltas are applied, so every step uses the K factors apply_attempt would.
+# Two reads and two executemany updates per batch.
+def apply_attempts(connection, attempts):
+    if not attempts:
+        return
+    users = {row.user_id: [row.rating, row.total_problems] for row in connection.execute(
+        select(stats_table.c.user_id, stats_table.c.rating, stats_table.c.total_problems)
+        .where(stats_table.c.user_id.in_({user_id for user_id, _, _ in attempts})))}
+    problems = {row.id: [row.rating, row.attempt_count, 0] for row in connection.execute(
+        select(problem_table.c.id, problem_table.c.rating, problem_table.c.attempt_count)
+        .where(problem_table.c.id.in_({problem_id for _, problem_id, _ in attempts})))}
+    # Rewind each user's counter to before the batch; it advances with every attempt below
+    for user_id, _, _ in attempts:
+        if user_id in users:
+            users[user_id][1] -= 1
+    rated = set()
+    for user_id, problem_id, solved in attempts:
+        user = users.get(user_id)
+        if user is None:
+            continue
+        user[1] += 1
+        problem = problems.get(problem_id)
+        if problem is None:
+            continue
+        surprise = (1 if solved else 0) - expected_score(user[0], problem[0])
+        user[0] += k_factor(user[1]) * surprise
+        problem[0] -= k_factor(problem[1] + problem[2]) * surprise
+        problem[2] += 1
+        rated.add(user_id)
+
+    connection.execute(stats_table.update().where(stats_table.c.user_id == bindparam('row_id'))
+                       .values(rating=bindparam('new_rating')),
+                       [{'row_id': user_id, 'new_rating': users[user_id][0]} for user_id in rated])
+    connection.execute(problem_table.update().where(problem_table.c.id == bindparam('row_id'))
+                       .values(rating=bindparam('new_rating'),
+                               attempt_count=problem_table.c.attempt_count + bindparam('attempts')),
+                       [{'row_id': problem_id, 'new_rating': rating, 'attempts': count}
+                        for problem_id, (rating, _, count) in problems.items() if count])
+
+
+# Edits and deletions of attempts are left to the next recalibration
+@event.listens_for(Progress, 'after_insert')
+def _progress_inserted(mapper, connection, target):
+    apply_attempt(connection, target.user_id, target.problem_id, target.status == COMPLETED)
+
+
+def target_rating(theta):
+    success = _setting('RATING_TARGET_SUCCESS', 0.7)
+    return theta - math.log(success / (1 - success))
+
+# An unattempted problem whose rating is close to the one the user should solve
+# RATING_TARGET_SUCCESS of the time. Seeks to a random point in a window around that
+# rating on the (rating, id) index, doubling the window up to RATING_MAX_WINDOW and
+# finally dropping it; the anti-join probes Progress (user_id, problem_id).
+def recommend_by_rating(user_id):
+    stats = UserStats.query.get(user_id)
+    target = target_rating(stats.rating if stats else 0.0)
+    attempted = exists().where(and_(Progress.user_id == user_id, Progress.problem_id == Problem.id))
+    unsolved = Problem.query.filter(~attempted)
+
+    width = _setting('RATING_WINDOW', 0.25)
+    while width <= _setting('RATING_MAX_WINDOW', 4.0):
+        window = unsolved.filter(Problem.rating.between(target - width, target + width))
+        pivot = random.uniform(target - width, target + width)
+        problem = (window.filter(Problem.rating >= pivot).order_by(Problem.rating, Problem.id).first()
+                   or window.filter(Problem.rating < pivot).order_by(Problem.rating.desc(), Problem.id).first())
+        if problem is not None:
+            return problem
+        width *= 2
+    return (unsolved.filter(Problem.rating >= target).order_by(Problem.rating, Problem.id).first()
+            or unsolved.filter(Problem.rating < target).order_by(Problem.rating.desc(), Problem.id).first())
+
+
+# Nearest unattempted (and, with `taken`, unassigned) candidate to `target`, walking
+# outwards from its position in the rating-sorted candidate list
+def _nearest(candidates, ratings, target, attempted, taken):
+    right = int(np.searchsorted(ratings, target))
+    left = right - 1
+    while left >= 0 or right < len(candidates):
+        if right >= len(candidates) or (left >= 0 and target - ratings[left] <= ratings[right] - target):
+            index, left = left, left - 1
+        else:
+            index, right = right, right + 1
+        problem_id = candidates[index][0]
+        if problem_id not in attempted and problem_id not in taken:
+            return index
+    return None
+
+# Ratings within `width` of any of the targets, as a few merged ranges
+def _windows(targets, width):
+    merged = []
+    for target in sorted(targets):
+        if merged and target - width <= merged[-1][1]:
+            merged[-1][1] = target + width
+        else:
+            merged.append([target - width, target + width])
+    return or_(*[Problem.rating.between(low, high) for low, high in merged])
+
+# Give each pending user the nearest candidate they have not attempted (and, with
+# `unique`, nobody else has been given). With `width`, candidates further than that
+# from a user's target are out of reach. Fills `chosen`; returns the users left over.
+def _assign(candidates, ratings, targets, pending, attempted, chosen, unique, width=None):
+    unserved = []
+    taken = set(chosen.values()) if unique else ()
+    for user_id in pending:
+        index = _nearest(candidates, ratings, targets[user_id], attempted[user_id], taken)
+        if index is None or (width is not None and abs(ratings[index] - targets[user_id]) > width):
+            unserved.append(user_id)
+            continue
+        chosen[user_id] = candidates[index][0]
+        if unique:
+            taken.add(candidates[index][0])
+    return unserved
+
+def _ordered(rows):
+    rows = sorted(rows, key=lambda row: (row[1], row[0]))
+    return rows, np.array([rating for _, rating in rows], dtype=np.float64)
+
+# The users' attempts at problems matching `condition`, in one join: {user_id: {problem_id}}
+def _attempted(connection, user_ids, condition=None):
+    attempted = {user_id: set() for user_id in user_ids}
+    query = select(Progress.user_id, Progress.problem_id).where(Progress.user_id.in_(user_ids))
+    if condition is not None:
+        query = query.join(Problem, Problem.id == Progress.problem_id).where(condition)
+    for user_id, problem_id in connection.execute(query):
+        attempted[user_id].add(problem_id)
+    return attempted
+
+# First-choice-then-fallback difficulty bands, one statement per band and round: for
+# every user in the band, a correlated subquery seeks the (difficulty, id) index from a
+# per-user pivot to the first problem they have not attempted (wrapping around once),
+# as pick_unsolved_problem() does for one user. Pivots are spread by user id and a
+# per-request salt, so users in one band get different problems. With `unique`, users
+# who drew an already given problem go again with those problems excluded.
+def _assign_by_band(connection, user_ids, bands, unique):
+    bounds = {difficulty: (low, high) for difficulty, low, high in connection.execute(
+        select(Problem.difficulty, func.min(Problem.id), func.max(Problem.id)).group_by(Problem.difficulty))}
+    salt = random.randrange(1 << 20)
+    chosen = {}
+    pending = {user_id: 0 for user_id in user_ids}  # user -> index into their bands
+    while pending:
+        taken = set(chosen.values()) if unique else set()
+        by_band = {}
+        for user_id, choice in pending.items():
+            by_band.setdefault(bands[user_id][choice], []).append(user_id)
+        drawn = {}
+        for band, members in by_band.items():
+            if band not in bounds:
+                drawn.update(dict.fromkeys(members))
+                continue
+            low, high = bounds[band]
+            pivot = low + (User.id * 2654435761 + salt) % (high - low + 1)
+            attempted = exists().where(and_(Progress.user_id == User.id, Progress.problem_id == Problem.id)) \
+                .correlate_except(Progress)
+            unsolved = select(Problem.id).where(Problem.difficulty == band, ~attempted).correlate(User)
+            if taken:
+                unsolved = unsolved.where(Problem.id.notin_(taken))
+            after = unsolved.where(Problem.id >= pivot).order_by(Problem.id).limit(1).scalar_subquery()
+            before = unsolved.where(Problem.id < pivot).order_by(Problem.id).limit(1).scalar_subquery()
+            drawn.update(connection.execute(
+                select(User.id, func.coalesce(after, before)).where(User.id.in_(members))).all())
+
+        retry = {}
+        for user_id, choice in pending.items():
+            problem_id = drawn.get(user_id)
+            if problem_id is None:
+                # Band exhausted (or no such user): move on to the next band
+                if choice + 1 < len(bands[user_id]) and user_id in drawn:
+                    retry[user_id] = choice + 1
+            elif problem_id in taken:
+                retry[user_id] = choice
+            else:
+                chosen[user_id] = problem_id
+                if unique:
+                    taken.add(problem_id)
+        pending = retry
+    return chosen
+
+# Recommendations for a group of users in a few set-based queries: one for all their
+# counters and ratings, then the candidates and the users' attempts at them, and one
+# for the chosen problems. Returns {user_id: entry}; with `unique` no problem goes to
+# two users.
+# With `bands_for`, each user gets an unattempted problem from the first band of
+# bands_for(total, correct) that has one, as recommend_problem() does without
+# RATING_RECOMMENDER. Otherwise users are matched by rating, served in target order,
+# in windows doubling from RATING_WINDOW to RATING_MAX_WINDOW and then unbounded.
+def recommend_batch(user_ids, unique=False, bands_for=None):
+    connection = db.session.connection()
+    user_ids = list(dict.fromkeys(user_ids))
+    rows = {row[0]: row[1:] for row in connection.execute(
+        select(stats_table.c.user_id, stats_table.c.total_problems, stats_table.c.correct_answers,
+               stats_table.c.rating).where(stats_table.c.user_id.in_(user_ids)))}
+    totals, corrects, thetas = np.array([rows.get(user_id, (0, 0, 0.0)) for user_id in user_ids],
+                                        dtype=np.float64).reshape(-1, 3).T
+    # Same default as difficulty_for(): no attempts yet counts as a perfect record
+    ratios = np.divide(corrects, totals, out=np.ones_like(totals), where=totals > 0)
+
+    if bands_for is not None:
+        chosen = _assign_by_band(connection, user_ids, {
+            user_id: bands_for(total, correct) for user_id, total, correct in zip(user_ids, totals, corrects)},
+            unique)
+    else:
+        chosen = {}
+        targets = dict(zip(user_ids, (target_rating(theta) for theta in thetas)))
+        max_width = _setting('RATING_MAX_WINDOW', 4.0)
+        # The widest window in one query; narrower ones are slices of it
+        window = _windows(targets.values(), max_width)
+        candidates, ratings = _ordered(connection.execute(select(Problem.id, Problem.rating).where(window)))
+        attempted = _attempted(connection, user_ids, window)
+        pending = sorted(user_ids, key=targets.get)
+        width = _setting('RATING_WINDOW', 0.25)
+        while pending and width <= max_width:
+            pending = _assign(candidates, ratings, targets, pending, attempted, chosen, unique, width)
+            width *= 2
+        if pending:
+            candidates, ratings = _ordered(connection.execute(select(Problem.id, Problem.rating)))
+            attempted = _attempted(connection, pending)
+            _assign(candidates, ratings, targets, pending, attempted, chosen, unique)
+
+    problems = {problem.id: problem for problem in connection.execute(
+        select(Problem.id, Problem.question, Problem.difficulty, Problem.feedback)
+        .where(Problem.id.in_(set(chosen.values()))))} if chosen else {}
+    results = {}
+    for user_id, ratio, theta in zip(user_ids, ratios, thetas):
+        problem = problems.get(chosen.get(user_id))
+        results[user_id] = {
+            'performance_ratio': float(ratio),
+            'rating': float(theta),
+            'problem': {'problem_id': problem.id, 'question': problem.question, 'difficulty': problem.difficulty,
+                        'feedback': problem.feedback} if problem else None,
+        }
+    return results
+
+
+def _sigmoid(values):
+    return 1 / (1 + np.exp(-values))
+
+# Maximum a posteriori 1PL fit over whole attempt arrays. Alternates one diagonal Newton
+# step for every user skill and every problem difficulty per iteration, all as NumPy
+# bincounts; `prior` holds each problem's authored difficulty and anchors the scale.
+def fit_ratings(users, problems, outcomes, user_count, prior, iterations=25, l2=0.5):
+    theta = np.zeros(user_count)
+    difficulty = prior.astype(np.float64)
+    for _ in range(iterations):
+        expected = _sigmoid(theta[users] - difficulty[problems])
+        residual = outcomes - expected
+        weight = expected * (1 - expected)
+        theta += ((np.bincount(users, residual, user_count) - l2 * theta)
+                  / (np.bincount(users, weight, user_count) + l2))
+
+        expected = _sigmoid(theta[users] - difficulty[problems])
+        residual = outcomes - expected
+        weight = expected * (1 - expected)
+        difficulty -= ((np.bincount(problems, residual, len(prior)) + l2 * (difficulty - prior))
+                       / (np.bincount(problems, weight, len(prior)) + l2))
+    return theta, difficulty
+
+def _load_attempts(connection, chunk_size):
+    users, problems, outcomes = [], [], []
+    statement = select(Progress.user_id, Progress.problem_id, Progress.status == COMPLETED) \
+        .compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    # Plain DBAPI tuples: building arrays from Row objects is several times slower
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(str(statement))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 3).reshape(-1, 3)
+            users.append(chunk[:, 0])
+            problems.append(chunk[:, 1])
+            outcomes.append(chunk[:, 2])
+    finally:
+        cursor.close()
+    if not users:
+        return None
+    return np.concatenate(users), np.concatenate(problems), np.concatenate(outcomes).astype(np.float64)
+
+# Refit every rating from the Progress log and write them back. Users and problems are
+# indexed by id in dense arrays; attempts recorded while the fit runs are overwritten.
+def recalibrate_ratings(connection=None, chunk_size=500000, iterations=25):
+    own_session = connection is None
+    if own_session:
+        connection = db.session.connection()
+    problem_rows = connection.execute(select(Problem.id, Problem.difficulty)).all()
+    attempts = _load_attempts(connection, chunk_size)
+    if not problem_rows or attempts is None:
+        return {'attempts': 0, 'users': 0, 'problems': 0}
+    users, problems, outcomes = attempts
+
+    problem_ids = np.array([problem_id for problem_id, _ in problem_rows], dtype=np.int64)
+    prior = np.zeros(max(int(problem_ids.max()), int(problems.max())) + 1)
+    prior[problem_ids] = [DIFFICULTY_RATINGS.get(difficulty, 0.0) for _, difficulty in problem_rows]
+    theta, difficulty = fit_ratings(users, problems, outcomes, int(users.max()) + 1, prior, iterations)
+
+    user_attempts = np.bincount(users)
+    problem_attempts = np.bincount(problems, minlength=len(prior))
+    rated_users = np.nonzero(user_attempts)[0]
+    connection.execute(stats_table.update().where(stats_table.c.user_id == bindparam('row_id'))
+                       .values(rating=bindparam('new_rating')),
+                       [{'row_id': int(user_id), 'new_rating': float(theta[user_id])} for user_id in rated_users])
+    connection.execute(problem_table.update().where(problem_table.c.id == bindparam('row_id'))
+                       .values(rating=bindparam('new_rating'), attempt_count=bindparam('attempts')),
+                       [{'row_id': int(problem_id), 'new_rating': float(difficulty[problem_id]),
+                         'attempts': int(problem_attempts[problem_id])} for problem_id in problem_ids])
+    if own_session:
+        db.session.commit()
+    return {'attempts': len(users), 'users': len(rated_users), 'problems': len(problem_ids)}
+
+# Recalibrate a scratch SQLite database holding `attempts` simulated attempts of
+# `users` users on `problems` problems, and report the time taken and how well the
+# fitted ratings recover the simulated ones
+def run_rating_benchmark(attempts=10000000, users=100000, problems=20000, seed=7, chunk_size=500000):
+    rng = np.random.default_rng(seed)
+    true_theta = rng.normal(0, 1, users + 1)
+    difficulties = rng.choice(list(DIFFICULTY_RATINGS), problems + 1)
+    true_difficulty = np.array([DIFFICULTY_RATINGS[name] for name in difficulties]) + rng.normal(0, 0.5, problems + 1)
+
+    directory = tempfile.mkdtemp(prefix='rating-bench-')
+    engine = create_engine('sqlite:///' + os.path.join(directory, 'ratings.db'))
+    try:
+        db.metadata.create_all(engine, tables=[Problem.__table__, UserStats.__table__, Progress.__table__])
+        with engine.begin() as connection:
+            connection.execute(problem_table.insert(), [
+                {'id': problem_id, 'question': f'Problem {problem_id}', 'difficulty': difficulties[problem_id]}
+                for problem_id in range(1, problems + 1)])
+            connection.execute(stats_table.insert(), [
+                {'user_id': user_id, 'total_problems': 0, 'correct_answers': 0}
+                for user_id in range(1, users + 1)])
+            for first in range(0, attempts, chunk_size):
+                count = min(chunk_size, attempts - first)
+                user_ids = rng.integers(1, users + 1, count)
+                problem_ids = rng.integers(1, problems + 1, count)
+                solved = rng.random(count) < _sigmoid(true_theta[user_ids] - true_difficulty[problem_ids])
+                connection.exec_driver_sql(
+                    'INSERT INTO progress (user_id, problem_id, status) VALUES (?, ?, ?)',
+                    list(zip(user_ids.tolist(), problem_ids.tolist(),
+                             np.where(solved, COMPLETED, 'attempted').tolist())))
+
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            summary = recalibrate_ratings(connection, chunk_size)
+        elapsed = time.perf_counter() - started
+
+        with engine.connect() as connection:
+            fitted_users = dict(connection.execute(select(stats_table.c.user_id, stats_table.c.rating)).all())
+            fitted_problems = dict(connection.execute(select(problem_table.c.id, problem_table.c.rating)).all())
+        user_ids = np.arange(1, users + 1)
+        problem_ids = np.arange(1, problems + 1)
+        return {
+            **summary,
+            'seconds': elapsed,
+            'user_correlation': float(np.corrcoef(true_theta[user_ids],
+                                                  [fitted_users[i] for i in user_ids])[0, 1]),
+            'problem_correlation': float(np.corrcoef(true_difficulty[problem_ids],
+                                                     [fitted_problems[i] for i in problem_ids])[0, 1]),
+        }
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,248 @@
+from backend import db
+from backend.database import reads, sqlite_pragmas
+from backend.models import DiscussionPost, DiscussionTopic, Hint, Problem, Tutorial
+from sqlalchemy import create_engine, event, inspect, or_, select, text
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+# Searchable models: kind, code folded into the index rowid, title attribute (or None) and body attribute
+SOURCES = {
+    Problem: ('problem', 1, None, 'question'),
+    Tutorial: ('tutorial', 2, 'title', 'content'),
+    Hint: ('hint', 3, None, 'hint_text'),
+    DiscussionTopic: ('discussion_topic', 4, 'topic_title', 'description'),
+    DiscussionPost: ('discussion_post', 5, None, 'post_content'),
+}
+KINDS = {kind: code for kind, code, _, _ in SOURCES.values()}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+KIND_BITS = 3
+
+# Rows are stored once per source row under rowid = (id << KIND_BITS) | code, so writes
+# and deletes address them directly. Titles weigh more than bodies in the bm25 rank;
+# ordering by FTS5's own rank column lets it sort the matches and apply the LIMIT itself.
+CREATE_INDEX = ("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                "title, body, tokenize='porter unicode61')")
+INSERT_ROW = text('INSERT INTO search_index (rowid, title, body) VALUES (:rowid, :title, :body)')
+DELETE_ROW = text('DELETE FROM search_index WHERE rowid = :rowid')
+SEARCH = ("SELECT rowid, title, snippet(search_index, 1, '', '', '…', :snippet_words), rank "
+          "FROM search_index WHERE search_index MATCH :match AND rank MATCH 'bm25(4.0, 1.0)' {kinds} "
+          "ORDER BY rank LIMIT :limit OFFSET :offset")
+
+TOKEN = re.compile(r'\w+')
+
+# Words found in nearly every document add nothing to a match but cost a scan of their
+# whole doclist when bm25 computes their document frequency, so queries leave them out
+STOPWORDS = frozenset('a an and are as at be by do does for from how i if in is it of on or so '
+                      'than that the then this to what when which why with'.split())
+
+class SearchUnavailable(Exception):
+    pass
+
+# Engines whose index table is known to be committed
+_ready = set()
+
+def rowid(code, row_id):
+    return (row_id << KIND_BITS) | code
+
+# The index is an SQLite FTS5 table; other databases have no search index.
+# Checked once at startup (create_search_index) and by the first write on each engine.
+def ensure_index(connection):
+    if connection.engine in _ready:
+        return True
+    if connection.dialect.name != 'sqlite':
+        return False
+    exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                     "AND name = 'search_index'")).first()
+    if exists:
+        _ready.add(connection.engine)
+    else:
+        # Not cached yet: the surrounding transaction may still roll the table back
+        connection.execute(text(CREATE_INDEX))
+    return True
+
+def _document(model, values):
+    _, code, title, body = SOURCES[model]
+    return {'rowid': rowid(code, values['id']), 'title': (values.get(title) or '') if title else '',
+            'body': values.get(body) or ''}
+
+def index_rows(connection, model, rows):
+    if rows and ensure_index(connection):
+        connection.execute(INSERT_ROW, [_document(model, row) for row in rows])
+
+def _values(model, target):
+    _, _, title, body = SOURCES[model]
+    return {name: getattr(target, name) for name in ('id', title, body) if name}
+
+# Listeners write the index on the flush connection, so it commits with the row
+def _row_inserted(mapper, connection, target):
+    index_rows(connection, mapper.class_, [_values(mapper.class_, target)])
+
+def _row_updated(mapper, connection, target):
+    _, code, title, body = SOURCES[mapper.class_]
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in (title, body) if name):
+        return
+    if ensure_index(connection):
+        connection.execute(DELETE_ROW, {'rowid': rowid(code, target.id)})
+        index_rows(connection, mapper.class_, [_values(mapper.class_, target)])
+
+def _row_deleted(mapper, connection, target):
+    if ensure_index(connection):
+        connection.execute(DELETE_ROW, {'rowid': rowid(SOURCES[mapper.class_][1], target.id)})
+
+for _model in SOURCES:
+    event.listen(_model, 'after_insert', _row_inserted)
+    event.listen(_model, 'after_update', _row_updated)
+    event.listen(_model, 'after_delete', _row_deleted)
+
+# Create the index table if migrations left it out; run once per process at startup
+def create_search_index():
+    with db.engine.begin() as connection:
+        return ensure_index(connection)
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def _create_index(metadata, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(CREATE_INDEX))
+
+@event.listens_for(db.Model.metadata, 'after_drop')
+def _drop_index(metadata, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS search_index'))
+    _ready.discard(connection.engine)
+
+# Rows written with bulk_insert_mappings skip the listeners; index every row of
+# `model` with an id above `after_id` (or in `ids`) on the session's connection
+def index_new_rows(model, after_id, ids=()):
+    _, _, title, body = SOURCES[model]
+    columns = [getattr(model, name) for name in ('id', title, body) if name]
+    condition = model.id > after_id if after_id is not None else model.id.isnot(None)
+    if ids:
+        condition = or_(condition, model.id.in_(ids))
+    rows = db.session.execute(select(*columns).where(condition)).mappings().all()
+    index_rows(db.session.connection(), model, rows)
+
+# Drop and refill the index from the source tables, `chunk_size` rows at a time
+def rebuild_search_index(chunk_size=5000):
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        raise SearchUnavailable('Full-text search needs SQLite FTS5')
+    connection.execute(text('DROP TABLE IF EXISTS search_index'))
+    connection.execute(text(CREATE_INDEX))
+    counts = {}
+    for model, (kind, _, title, body) in SOURCES.items():
+        columns = [getattr(model, name) for name in ('id', title, body) if name]
+        last_id, counts[kind] = 0, 0
+        while True:
+            rows = connection.execute(select(*columns).where(model.id > last_id)
+                                      .order_by(model.id).limit(chunk_size)).mappings().all()
+            if not rows:
+                break
+            index_rows(connection, model, rows)
+            last_id = rows[-1]['id']
+            counts[kind] += len(rows)
+    connection.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+    return counts
+
+# Quoted terms ANDed together; the porter tokenizer matches other forms of each word
+def match_expression(query, max_terms=16):
+    words = TOKEN.findall(query.lower())
+    terms = [word for word in words if word not in STOPWORDS] or words
+    if not terms:
+        return None
+    return ' '.join('"{}"'.format(term) for term in terms[:max_terms])
+
+def _search_sql(codes):
+    kinds = ''
+    if codes:
+        kinds = 'AND (rowid & {}) IN ({})'.format((1 << KIND_BITS) - 1, ', '.join(str(code) for code in codes))
+    return text(SEARCH.format(kinds=kinds))
+
+# Ranked results for `query`, best bm25 score first; returns (results, has_more).
+# The index table is created at startup, so this only checks the dialect.
+def search(query, kinds=None, limit=20, offset=0):
+    session = reads.session()
+    if session.connection().dialect.name != 'sqlite':
+        raise SearchUnavailable('Full-text search needs SQLite FTS5')
+    match = match_expression(query)
+    if match is None:
+        return [], False
+    rows = session.execute(_search_sql([KINDS[kind] for kind in kinds or ()]), {
+        'match': match,
+        'snippet_words': 16,
+        'limit': limit + 1,
+        'offset': offset,
+    }).all()
+    results = [{'kind': KIND_NAMES[row_id & ((1 << KIND_BITS) - 1)], 'id': row_id >> KIND_BITS,
+                'title': title, 'snippet': snippet, 'score': round(-rank, 4)}
+               for row_id, title, snippet, rank in rows[:limit]]
+    return results, len(rows) > limit
+
+WORDS = ('angle', 'area', 'algebra', 'axis', 'binomial', 'calculus', 'circle', 'coefficient', 'cosine',
+         'curve', 'decimal', 'denominator', 'derivative', 'diameter', 'equation', 'exponent', 'factor',
+         'fraction', 'function', 'geometry', 'gradient', 'graph', 'hypotenuse', 'integer', 'integral',
+         'inequality', 'limit', 'linear', 'logarithm', 'matrix', 'mean', 'median', 'multiply', 'numerator',
+         'parabola', 'percent', 'perimeter', 'polynomial', 'prime', 'probability', 'product', 'proof',
+         'quadratic', 'quotient', 'radius', 'ratio', 'root', 'sequence', 'series', 'sine', 'slope', 'solve',
+         'square', 'statistics', 'sum', 'tangent', 'theorem', 'triangle', 'variable', 'vector', 'volume')
+
+# Build an index of `documents` synthetic documents (Zipf-distributed vocabulary) in a
+# scratch SQLite file and time `queries` searches of one to three terms against it
+def run_search_benchmark(config, documents=1000000, queries=500, chunk_size=20000, seed=7):
+    rng = random.Random(seed)
+    # Stopwords head the distribution as in real text; queries use content words only
+    vocabulary = sorted(STOPWORDS) + list(WORDS) + [f'term{n}' for n in range(50000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    content_words = vocabulary[len(STOPWORDS):]
+    content_cumulative = [value - cumulative[len(STOPWORDS) - 1] for value in cumulative[len(STOPWORDS):]]
+
+    directory = tempfile.mkdtemp(prefix='search-bench-')
+    path = os.path.join(directory, 'search.db')
+    engine = create_engine('sqlite:///' + path)
+    pragmas = sqlite_pragmas(config)
+    try:
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            for name, value in pragmas.items():
+                connection.exec_driver_sql(f'PRAGMA {name}={value}')
+            connection.execute(text(CREATE_INDEX))
+            for first in range(0, documents, chunk_size):
+                connection.execute(INSERT_ROW, [{
+                    'rowid': rowid(1 + number % 5, number),
+                    'title': ' '.join(rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(2, 6))),
+                    'body': ' '.join(rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(15, 60))),
+                } for number in range(first + 1, min(first + chunk_size, documents) + 1)])
+            connection.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+        build_seconds = time.perf_counter() - started
+
+        statement = _search_sql(())
+        latencies = []
+        with engine.connect() as connection:
+            for _ in range(queries):
+                terms = rng.choices(content_words, cum_weights=content_cumulative, k=rng.randint(1, 3))
+                started = time.perf_counter()
+                connection.execute(statement, {'match': match_expression(' '.join(terms)),
+                                               'snippet_words': 16, 'limit': 21, 'offset': 0}).all()
+                latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {
+            'documents': documents,
+            'build_seconds': build_seconds,
+            'index_bytes': os.path.getsize(path),
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        }
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
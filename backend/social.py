@@ -0,0 +1,284 @@
+from backend import db
+from backend.database import reads
+from backend.models import DiscussionPost, Follow
+from backend.pagination import decode_cursor, encode_cursor, keyset_page, parse_fields, parse_limit
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from flask import request
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+FEED_FIELDS = ('id', 'topic_id', 'user_id', 'post_content', 'timestamp')
+
+# In-memory follow graph and feed timelines for this process.
+# The followers and following sets of every user are loaded from Follow on first use.
+# After FEED_GRAPH_TTL seconds a background thread reloads them while readers keep
+# using the old graph, then swaps the new one in; another worker's follows can
+# therefore go unseen for FEED_GRAPH_TTL plus one reload. This process's own follows
+# and unfollows apply as they commit, and are replayed onto a graph loaded meanwhile.
+# A user's timeline is the (timestamp, id) of the newest FEED_TIMELINE_SIZE discussion
+# posts by the people they follow, oldest first. It is built with one query on first
+# read, then new posts are pushed into the timelines of the author's followers, so a
+# feed page is a slice plus one primary-key lookup. Timelines are evicted least
+# recently read beyond FEED_MAX_TIMELINES, and dropped when their owner follows or unfollows.
+class SocialGraph:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._followers = defaultdict(set)
+        self._following = defaultdict(set)
+        self._timelines = OrderedDict()
+        self._loaded_at = None
+        self._load_lock = threading.Lock()
+        self._pending = None  # follow/unfollow changes committed while a load runs
+        self._building = {}  # user id -> whether their timeline changed while being queried
+        self.app = None
+        self.ttl = 300
+        self.timeline_size = 500
+        self.max_timelines = 10000
+        self.timeline_hits = 0
+        self.timeline_builds = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.get('FEED_GRAPH_TTL', 300)
+        self.timeline_size = app.config.get('FEED_TIMELINE_SIZE', 500)
+        self.max_timelines = app.config.get('FEED_MAX_TIMELINES', 10000)
+
+    def clear(self):
+        with self._lock:
+            self._followers.clear()
+            self._following.clear()
+            self._timelines.clear()
+            self._loaded_at = None
+
+    # Load the graph on first use; once it is older than the TTL, start a background
+    # reload and keep serving the current one. Never called with _lock held.
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded_at is not None:
+                if self.ttl and time.monotonic() - self._loaded_at >= self.ttl and self.app is not None \
+                        and not self._load_lock.locked():
+                    threading.Thread(target=self._reload, name='feed-graph-reload', daemon=True).start()
+                return
+        with self._load_lock:
+            if self._loaded_at is None:
+                self._load()
+
+    def _reload(self):
+        if not self._load_lock.acquire(blocking=False):
+            return
+        try:
+            with self.app.app_context():
+                try:
+                    self._load()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Reloading the follow graph failed')
+        finally:
+            self._load_lock.release()
+
+    # Read Follow outside _lock, then swap the new sets in. Callers hold _load_lock.
+    def _load(self):
+        with self._lock:
+            self._pending = []
+        try:
+            followers, following = defaultdict(set), defaultdict(set)
+            for follower_id, followed_id in db.session.execute(select(Follow.follower_id, Follow.followed_id)):
+                followers[followed_id].add(follower_id)
+                following[follower_id].add(followed_id)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            # Commits seen by this process during the scan may or may not be in it; replaying is idempotent
+            for change, follower_id, followed_id in self._pending:
+                self._apply_follow(followers, following, change, follower_id, followed_id)
+            self._pending = None
+            self._followers, self._following = followers, following
+            self._timelines.clear()
+            self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _apply_follow(followers, following, change, follower_id, followed_id):
+        if change == 'follow':
+            followers[followed_id].add(follower_id)
+            following[follower_id].add(followed_id)
+            return
+        for index, user_id, other_id in ((followers, followed_id, follower_id),
+                                         (following, follower_id, followed_id)):
+            members = index.get(user_id)
+            if members is not None:
+                members.discard(other_id)
+                if not members:
+                    del index[user_id]
+
+    def followers(self, user_id):
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._followers.get(user_id, ()))
+
+    def following(self, user_id):
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._following.get(user_id, ()))
+
+    def follow(self, follower_id, followed_id):
+        self._change('follow', follower_id, followed_id)
+
+    def unfollow(self, follower_id, followed_id):
+        self._change('unfollow', follower_id, followed_id)
+
+    def _change(self, change, follower_id, followed_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((change, follower_id, followed_id))
+            if self._loaded_at is None:
+                return
+            self._apply_follow(self._followers, self._following, change, follower_id, followed_id)
+            self._timelines.pop(follower_id, None)
+            if follower_id in self._building:
+                self._building[follower_id] = True
+
+    def add_post(self, author_id, timestamp, post_id):
+        entry = (timestamp, post_id)
+        with self._lock:
+            for follower_id in self._followers.get(author_id, ()):
+                if follower_id in self._building:
+                    self._building[follower_id] = True
+                timeline = self._timelines.get(follower_id)
+                if timeline is None:
+                    continue
+                entries = timeline[0]
+                position = bisect_left(entries, entry)
+                # A timeline built while this post committed may already hold it
+                if position < len(entries) and entries[position] == entry:
+                    continue
+                entries.insert(position, entry)
+                if len(entries) > self.timeline_size:
+                    del entries[0]
+                    timeline[1] = False
+
+    def remove_post(self, author_id, post_id):
+        with self._lock:
+            for follower_id in self._followers.get(author_id, ()):
+                if follower_id in self._building:
+                    self._building[follower_id] = True
+                timeline = self._timelines.get(follower_id)
+                if timeline is not None:
+                    timeline[0] = [entry for entry in timeline[0] if entry[1] != post_id]
+
+    # Returns (entries, complete); complete means nothing older exists beyond the entries.
+    # A missing timeline is queried outside the lock and cached only if no post, follow
+    # or graph reload touched it meanwhile.
+    def timeline(self, user_id):
+        self._ensure_loaded()
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is not None:
+                self._timelines.move_to_end(user_id)
+                self.timeline_hits += 1
+                return list(timeline[0]), timeline[1]
+            graph = self._following
+            following = set(graph.get(user_id, ()))
+            owner = user_id not in self._building
+            if owner:
+                self._building[user_id] = False
+
+        try:
+            rows = []
+            if following:
+                rows = db.session.execute(
+                    select(DiscussionPost.timestamp, DiscussionPost.id)
+                    .where(DiscussionPost.user_id.in_(following))
+                    .order_by(DiscussionPost.timestamp.desc(), DiscussionPost.id.desc())
+                    .limit(self.timeline_size + 1)).all()
+            timeline = [sorted(tuple(row) for row in rows[:self.timeline_size]), len(rows) <= self.timeline_size]
+        finally:
+            if owner:
+                with self._lock:
+                    dirty = self._building.pop(user_id)
+        with self._lock:
+            self.timeline_builds += 1
+            if owner and not dirty and self._following is graph:
+                self._timelines[user_id] = timeline
+                while len(self._timelines) > self.max_timelines:
+                    self._timelines.popitem(last=False)
+        return list(timeline[0]), timeline[1]
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'feed_graph_users': len(self._followers.keys() | self._following.keys()),
+                'feed_timelines': len(self._timelines),
+                'feed_timeline_hits_total': self.timeline_hits,
+                'feed_timeline_builds_total': self.timeline_builds,
+            }
+
+social_graph = SocialGraph()
+
+# One page of the user's feed, newest first, in the keyset_page() cursor format.
+# Pages within the materialized timeline cost one lookup by primary key; older
+# pages beyond it fall back to querying the followed users' posts.
+def feed_page(user_id):
+    limit = parse_limit()
+    fields = parse_fields(FEED_FIELDS)
+    cursor = request.args.get('after')
+    entries, complete = social_graph.timeline(user_id)
+    end = bisect_left(entries, decode_cursor(cursor)) if cursor else len(entries)
+    if end < limit and not complete:
+        query = reads.query(DiscussionPost).filter(DiscussionPost.user_id.in_(social_graph.following(user_id)))
+        return keyset_page(query, DiscussionPost, FEED_FIELDS, descending=True)
+
+    page = entries[max(end - limit, 0):end][::-1]
+    ids = [post_id for _, post_id in page]
+    rows = {}
+    if ids:
+        columns = [getattr(DiscussionPost, name) for name in FEED_FIELDS]
+        rows = {row.id: row for row in reads.query(DiscussionPost).with_entities(*columns)
+                .filter(DiscussionPost.id.in_(ids))}
+    items = [{name: getattr(rows[post_id], name) for name in fields} for post_id in ids if post_id in rows]
+    next_cursor = encode_cursor(*page[-1]) if page and (end > limit or not complete) else None
+    return items, next_cursor
+
+# Graph and timeline changes are applied once the transaction commits
+def _record(target, change):
+    session = object_session(target)
+    if session is None:
+        _apply(change)
+    else:
+        session.info.setdefault('social_changes', []).append(change)
+
+def _apply(change):
+    kind, *args = change
+    getattr(social_graph, kind)(*args)
+
+@event.listens_for(Follow, 'after_insert')
+def _follow_inserted(mapper, connection, target):
+    _record(target, ('follow', target.follower_id, target.followed_id))
+
+@event.listens_for(Follow, 'after_delete')
+def _follow_deleted(mapper, connection, target):
+    _record(target, ('unfollow', target.follower_id, target.followed_id))
+
+@event.listens_for(DiscussionPost, 'after_insert')
+def _post_inserted(mapper, connection, target):
+    _record(target, ('add_post', target.user_id, target.timestamp, target.id))
+
+@event.listens_for(DiscussionPost, 'after_delete')
+def _post_deleted(mapper, connection, target):
+    _record(target, ('remove_post', target.user_id, target.id))
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed_changes(session):
+    for change in session.info.pop('social_changes', ()):
+        _apply(change)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('social_changes', None)
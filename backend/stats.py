@@ -0,0 +1,116 @@
+from backend import db
+from backend.database import conflict_insert, reads
+from backend.models import Progress, UserStats
+from datetime import datetime
+from sqlalchemy import case, event, func, inspect, insert, select
+
+COMPLETED = 'completed'
+
+stats_table = UserStats.__table__
+
+
+def _counts(status):
+    return 1, 1 if status == COMPLETED else 0
+
+
+# Add a (total, correct) delta to a user's counters on the given connection.
+# Runs inside the flush that wrote the Progress row, so both commit or roll back together.
+# A single upsert, so two first attempts by the same user cannot both try to insert the row.
+def apply_stats_delta(connection, user_id, total_delta, correct_delta):
+    if not total_delta and not correct_delta:
+        return
+    now = datetime.utcnow()
+    upsert = conflict_insert(connection, stats_table)
+    if upsert is not None:
+        upsert = upsert.values(user_id=user_id, total_problems=total_delta, correct_answers=correct_delta,
+                               updated_on=now)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=[stats_table.c.user_id],
+            set_={'total_problems': stats_table.c.total_problems + upsert.excluded.total_problems,
+                  'correct_answers': stats_table.c.correct_answers + upsert.excluded.correct_answers,
+                  'updated_on': upsert.excluded.updated_on}))
+        return
+    result = connection.execute(
+        stats_table.update()
+        .where(stats_table.c.user_id == user_id)
+        .values(total_problems=stats_table.c.total_problems + total_delta,
+                correct_answers=stats_table.c.correct_answers + correct_delta,
+                updated_on=now)
+    )
+    if result.rowcount == 0:
+        connection.execute(
+            stats_table.insert().values(user_id=user_id, total_problems=total_delta,
+                                        correct_answers=correct_delta, updated_on=now)
+        )
+
+
+@event.listens_for(Progress, 'after_insert')
+def _progress_inserted(mapper, connection, target):
+    total, correct = _counts(target.status)
+    apply_stats_delta(connection, target.user_id, total, correct)
+
+
+@event.listens_for(Progress, 'after_update')
+def _progress_updated(mapper, connection, target):
+    state = inspect(target)
+    user_history = state.attrs.user_id.history
+    status_history = state.attrs.status.history
+    if not user_history.has_changes() and not status_history.has_changes():
+        return
+    old_user_id = user_history.deleted[0] if user_history.deleted else target.user_id
+    old_status = status_history.deleted[0] if status_history.deleted else target.status
+    old_total, old_correct = _counts(old_status)
+    new_total, new_correct = _counts(target.status)
+    if old_user_id == target.user_id:
+        apply_stats_delta(connection, target.user_id, new_total - old_total, new_correct - old_correct)
+    else:
+        apply_stats_delta(connection, old_user_id, -old_total, -old_correct)
+        apply_stats_delta(connection, target.user_id, new_total, new_correct)
+
+
+@event.listens_for(Progress, 'after_delete')
+def _progress_deleted(mapper, connection, target):
+    total, correct = _counts(target.status)
+    apply_stats_delta(connection, target.user_id, -total, -correct)
+
+
+# Dashboard/analytics figures for a user, read from the maintained counters
+def get_performance(user_id):
+    stats = reads.query(UserStats).get(user_id)
+    total_problems = stats.total_problems if stats else 0
+    correct_answers = stats.correct_answers if stats else 0
+    return {
+        'total_problems': total_problems,
+        'correct_answers': correct_answers,
+        'incorrect_answers': total_problems - correct_answers,
+        'performance_ratio': correct_answers / total_problems if total_problems else 0
+    }
+
+
+# Recompute counters from the Progress log, for one user or everyone.
+# Rows are updated in place, so ratings and unread counts stored alongside survive.
+def rebuild_user_stats(user_id=None):
+    attempts = select(func.count(Progress.id)).where(Progress.user_id == stats_table.c.user_id)
+    correct = attempts.where(Progress.status == COMPLETED)
+    latest = select(func.max(Progress.timestamp)).where(Progress.user_id == stats_table.c.user_id)
+    update = stats_table.update().values(
+        total_problems=attempts.scalar_subquery(),
+        correct_answers=correct.scalar_subquery(),
+        updated_on=func.coalesce(latest.scalar_subquery(), stats_table.c.updated_on))
+    aggregate = select(
+        Progress.user_id,
+        func.count(Progress.id),
+        func.sum(case((Progress.status == COMPLETED, 1), else_=0)),
+        func.max(Progress.timestamp)
+    ).where(Progress.user_id.notin_(select(stats_table.c.user_id))).group_by(Progress.user_id)
+    if user_id is not None:
+        update = update.where(stats_table.c.user_id == user_id)
+        aggregate = aggregate.where(Progress.user_id == user_id)
+
+    updated = db.session.execute(update).rowcount
+    inserted = db.session.execute(
+        insert(stats_table).from_select(
+            ['user_id', 'total_problems', 'correct_answers', 'updated_on'], aggregate)
+    ).rowcount
+    db.session.commit()
+    return updated + inserted
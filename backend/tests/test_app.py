@@ -1,11 +1,47 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import OperationalError
+import json
+import os
 import pytest
-from backend.app import app, db
-from backend.models import User, Problem, Progress
+import queue
+import socketio as python_socketio
+import time
+from backend.app import app, bcrypt, db, limiter, socketio
+from backend.bus import IPCBus, MemoryBus, RoomBus, decode_message, encode_message, private_directory
+from backend.catalog import catalog
+from backend.conversations import (backfill_conversations, conversation_for, conversation_table, participant_table,
+                                   record_message)
+from backend.database import reads
+from backend.engagement import HotRanker, rebuild_vote_scores, recompute_hot_scores
+from backend.hashing import HasherSaturated, PasswordHasher
+from backend.http_cache import response_cache
+from backend.identity import user_cache
+from backend.metrics import RepeatedQueryError
+from backend.models import (Comment, DiscussionPost, DiscussionTopic, Follow, ForumPost, Message, Notification,
+                            Problem, Progress, Report, Tutorial, User, UserStats, Vote)
+from backend.notifications import notifier, user_room
+from backend.presence import presence
+from backend.ratings import recalibrate_ratings
+from backend.search import rebuild_search_index
+from backend.social import social_graph
+from backend.stats import apply_stats_delta, rebuild_user_stats
+from backend.whiteboard import BoardStore, decode_frame, encode_frame, parse_draw_data, share_boards
+from backend.writebehind import WriteBehindQueue, write_queue
+
+# Process-local state that must not leak from one test into the next
+CACHES = (user_cache, reads, response_cache, social_graph, catalog, presence)
 
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    # Fan-out runs on a worker thread that would share the in-memory connection; tests opt in
+    app.config['NOTIFY_FANOUT_ENABLED'] = False
+    app.config['HOT_RANKER_ENABLED'] = False
+    limiter.enabled = False
+    for cache in CACHES:
+        cache.clear()
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
@@ -100,7 +136,7 @@ def test_get_dashboard(client):
     assert b'test@example.com' in response.data
 
 def test_recommend(client):
-    user = User(username='testuser', email='test@example.com', password='password123')
+    user = User(username='testuser', email='test@example.com', password=bcrypt.generate_password_hash('password123').decode('utf-8'))
     db.session.add(user)
     db.session.commit()
     problem = Problem(question='2+2', answer='4', difficulty='easy')
@@ -116,7 +152,7 @@ def test_recommend(client):
     assert b'2+2' in response.data
 
 def test_progress(client):
-    user = User(username='testuser', email='test@example.com', password='password123')
+    user = User(username='testuser', email='test@example.com', password=bcrypt.generate_password_hash('password123').decode('utf-8'))
     db.session.add(user)
     db.session.commit()
     problem = Problem(question='2+2', answer='4', difficulty='easy')
@@ -127,10 +163,1043 @@ def test_progress(client):
         'password': 'password123'
     })
     access_token = login_response.json['access_token']
+    headers = {'Authorization': f'Bearer {access_token}'}
     response = client.post('/progress', json={
-        'user_id': user.id,
         'problem_id': problem.id,
         'status': 'completed'
-    }, headers={'Authorization': f'Bearer {access_token}'})
+    }, headers=headers)
     assert response.status_code == 201
     assert b'Progress tracked successfully' in response.data
+    other = User(username='other', email='other@example.com', password='x')
+    db.session.add(other)
+    db.session.commit()
+    response = client.post('/progress', json={'user_id': other.id, 'problem_id': problem.id, 'status': 'completed'},
+                           headers=headers)
+    assert response.status_code == 403
+    assert client.get(f'/progress/{other.id}', headers=headers).status_code == 403
+
+    client.post('/progress', json={'problem_id': problem.id, 'status': 'incorrect'}, headers=headers)
+    response = client.get(f'/progress/{user.id}?limit=1', headers=headers)
+    assert response.status_code == 200
+    assert [row['status'] for row in response.json] == ['completed']
+    response = client.get(f"/progress/{user.id}?limit=1&after={response.headers['X-Next-Cursor']}", headers=headers)
+    assert [row['status'] for row in response.json] == ['incorrect']
+    assert 'X-Next-Cursor' not in response.headers
+
+def test_dashboard_uses_maintained_stats(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    user = User.query.filter_by(email='test@example.com').first()
+    problem = Problem(question='2+2', difficulty='easy')
+    db.session.add(problem)
+    db.session.commit()
+    for status in ['completed', 'completed', 'incorrect']:
+        db.session.add(Progress(user_id=user.id, problem_id=problem.id, status=status))
+    db.session.commit()
+    response = client.get('/dashboard', headers={'Authorization': f'Bearer {access_token}'})
+    assert response.status_code == 200
+    assert response.json['total_problems'] == 3
+    assert response.json['correct_answers'] == 2
+    assert response.json['incorrect_answers'] == 1
+
+def test_stats_deltas_are_single_upserts(client):
+    connection = db.session.connection()
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        apply_stats_delta(connection, 7, 1, 1)
+        apply_stats_delta(connection, 7, 2, 0)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert len(statements) == 2 and all('ON CONFLICT' in statement for statement in statements)
+    db.session.commit()
+    stats = UserStats.query.get(7)
+    assert (stats.total_problems, stats.correct_answers, stats.rating) == (3, 1, 0.0)
+
+def test_recommend_skips_attempted_problems(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    user = User.query.filter_by(email='test@example.com').first()
+    solved = Problem(question='1+1', difficulty='hard')
+    unsolved = Problem(question='3*3', difficulty='hard')
+    db.session.add_all([solved, unsolved])
+    db.session.commit()
+    db.session.add(Progress(user_id=user.id, problem_id=solved.id, status='completed'))
+    db.session.commit()
+    response = client.get(f'/recommend/{user.id}', headers={'Authorization': f'Bearer {access_token}'})
+    assert response.status_code == 200
+    assert response.json['problem_id'] == unsolved.id
+
+def test_catalog_samples_unsolved_problems_from_bitmaps(client):
+    problems = [Problem(question=f'Problem {i}', difficulty='easy') for i in range(3)]
+    db.session.add_all(problems + [Problem(question='Other band', difficulty='hard')])
+    db.session.commit()
+    db.session.add_all([Progress(user_id=1, problem_id=problems[0].id, status='completed'),
+                        Progress(user_id=1, problem_id=problems[1].id, status='incorrect')])
+    db.session.commit()
+
+    assert {catalog.sample_unsolved(1, 'easy') for _ in range(20)} == {problems[2].id}
+    assert catalog.performance(1) == (2, 1)
+    assert catalog.sample_unsolved(1, 'medium') is None
+
+    # A committed attempt updates the cached bitmap and counters in place
+    db.session.add(Progress(user_id=1, problem_id=problems[2].id, status='completed'))
+    db.session.commit()
+    assert catalog.sample_unsolved(1, 'easy') is None
+    assert catalog.performance(1) == (3, 2)
+
+    # Problem writes invalidate the catalog; rewritten attempts drop the user's entry
+    added = Problem(question='Problem 3', difficulty='easy')
+    db.session.add(added)
+    db.session.commit()
+    assert catalog.sample_unsolved(1, 'easy') == added.id
+    attempt = Progress.query.filter_by(problem_id=problems[1].id).one()
+    db.session.delete(attempt)
+    db.session.commit()
+    assert {catalog.sample_unsolved(1, 'easy') for _ in range(30)} == {problems[1].id, added.id}
+
+    # An attempt committed by another worker never reached this bitmap; the Progress check catches it
+    db.session.execute(Progress.__table__.insert().values(user_id=1, problem_id=added.id, status='completed',
+                                                          timestamp=datetime.utcnow()))
+    db.session.commit()
+    assert {catalog.sample_unsolved(1, 'easy') for _ in range(30)} == {problems[1].id}
+
+def test_catalog_evicts_least_recently_used_bitmaps(client):
+    db.session.add_all([Problem(question=f'Problem {i}', difficulty='easy') for i in range(3)])
+    db.session.commit()
+    app.config['PROBLEM_CATALOG_MAX_BYTES'] = 2  # three problems fit one byte per bitmap, so two users
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        for user_id in (1, 2, 1, 3):
+            catalog.performance(user_id)
+        assert catalog.metrics()['problem_catalog_cached_users'] == 2
+        del statements[:]
+        catalog.performance(1)
+        assert statements == []
+        catalog.performance(2)
+        assert statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+        app.config['PROBLEM_CATALOG_MAX_BYTES'] = 64 * 1024 * 1024
+
+def test_discussion_topics_keyset_pagination(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    for i in range(5):
+        db.session.add(DiscussionTopic(topic_title=f'Topic {i}', description='Fractions'))
+    db.session.commit()
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    first_page = client.get('/discussion-topics?limit=3&fields=id,topic_title', headers=headers)
+    assert first_page.status_code == 200
+    assert [t['topic_title'] for t in first_page.json] == ['Topic 0', 'Topic 1', 'Topic 2']
+    assert set(first_page.json[0]) == {'id', 'topic_title'}
+
+    cursor = first_page.headers['X-Next-Cursor']
+    second_page = client.get(f'/discussion-topics?limit=3&after={cursor}', headers=headers)
+    assert [t['topic_title'] for t in second_page.json] == ['Topic 3', 'Topic 4']
+    assert 'X-Next-Cursor' not in second_page.headers
+
+    bad_fields = client.get('/discussion-topics?fields=password', headers=headers)
+    assert bad_fields.status_code == 400
+
+def test_export_progress_ndjson(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    user = User.query.filter_by(email='test@example.com').first()
+    problem = Problem(question='2+2', difficulty='easy')
+    db.session.add(problem)
+    db.session.commit()
+    for status in ['completed', 'incorrect']:
+        db.session.add(Progress(user_id=user.id, problem_id=problem.id, status=status))
+    db.session.commit()
+    response = client.get(f'/export/progress?user_id={user.id}&format=ndjson',
+                          headers={'Authorization': f'Bearer {access_token}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode().splitlines()
+    assert len(lines) == 2
+    assert '"status": "completed"' in lines[0]
+
+def test_students_can_only_export_their_own_history(client):
+    tokens = {}
+    for name in ('alice', 'bob', 'teacher'):
+        client.post('/register', json={'username': name, 'email': f'{name}@example.com', 'password': 'password123'})
+        tokens[name] = client.post('/login', json={'email': f'{name}@example.com',
+                                                   'password': 'password123'}).get_json()['access_token']
+    alice, bob, teacher = (User.query.filter_by(username=name).one() for name in ('alice', 'bob', 'teacher'))
+    teacher.role = 'teacher'
+    db.session.commit()
+    client.post('/message', json={'recipient_id': alice.id, 'message_text': 'Private note'},
+                headers={'Authorization': f'Bearer {tokens["bob"]}'})
+
+    headers = {'Authorization': f'Bearer {tokens["alice"]}'}
+    assert client.get(f'/export/messages?user_id={bob.id}', headers=headers).status_code == 403
+    assert client.get('/export/messages', headers=headers).status_code == 403
+    own = client.get(f'/export/messages?user_id={alice.id}', headers=headers)
+    assert own.status_code == 200 and b'Private note' in own.data
+    staff = client.get(f'/export/messages?user_id={bob.id}', headers={'Authorization': f'Bearer {tokens["teacher"]}'})
+    assert staff.status_code == 200 and b'Private note' in staff.data
+
+def test_bulk_ingest_reports_invalid_rows(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    student = client.post('/bulk/progress', json=[{'user_id': 1, 'problem_id': 1, 'status': 'completed'}],
+                          headers={'Authorization': f'Bearer {access_token}'})
+    assert student.status_code == 403
+
+    User.query.filter_by(email='test@example.com').one().role = 'admin'
+    db.session.commit()
+    user_cache.clear()
+    response = client.post('/bulk/problems?chunk_size=-5', json=[
+        {'question': '2+2', 'difficulty': 'easy'},
+        {'difficulty': 'easy'},
+        {'question': '3*3', 'difficulty': 'medium', 'feedback': 'Multiplication'},
+        {'question': '1+1', 'difficulty': 'trivial'}
+    ], headers={'Authorization': f'Bearer {access_token}'})
+    assert response.status_code == 200
+    assert response.json['inserted'] == 2
+    assert response.json['errors'] == [{'index': 1, 'errors': ['Missing question']},
+                                       {'index': 3, 'errors': ['difficulty must be one of easy, medium, hard']}]
+    assert Problem.query.count() == 2
+
+def test_write_behind_comment(client, tmp_path):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    access_token = login_response.json['access_token']
+    app.config['WRITE_BEHIND_ENABLED'] = True
+    app.config['WRITE_BEHIND_SPILL_PATH'] = str(tmp_path / 'spill.ndjson')
+    write_queue.init_app(app)
+    try:
+        response = client.post('/comment', json={
+            'discussion_id': 1,
+            'comment_text': 'Nice proof'
+        }, headers={'Authorization': f'Bearer {access_token}'})
+        assert response.status_code == 202
+        assert 'event_id' in response.json
+        write_queue.flush()
+        assert Comment.query.filter_by(comment_text='Nice proof').count() == 1
+    finally:
+        write_queue.shutdown()
+        app.config['WRITE_BEHIND_ENABLED'] = False
+        write_queue.init_app(app)
+
+def test_write_behind_adopts_journals_of_dead_workers(client, tmp_path):
+    base = tmp_path / 'spill.ndjson'
+    # A crashed worker's journal: more outstanding events than the queue holds
+    with open(tmp_path / 'spill.999999.ndjson', 'w', encoding='utf-8') as journal:
+        for i in range(12):
+            journal.write(json.dumps({'id': f'e{i}', 'kind': 'comment', 'fields': {
+                'discussion_id': 1, 'user_id': 1, 'comment_text': f'Recovered {i}'}}) + '\n')
+        journal.write(json.dumps({'committed': ['e0']}) + '\n')
+    (tmp_path / 'spill.999999.ndjson.lock').touch()
+    app.config.update(WRITE_BEHIND_ENABLED=True, WRITE_BEHIND_SPILL_PATH=str(base), WRITE_BEHIND_MAX_QUEUE=10)
+    write_queue.init_app(app)
+    try:
+        assert Comment.query.filter(Comment.comment_text.like('Recovered %')).count() == 11
+        assert sorted(os.listdir(tmp_path)) == [f'spill.{os.getpid()}.ndjson.lock']
+    finally:
+        write_queue.shutdown()
+        app.config.update(WRITE_BEHIND_ENABLED=False, WRITE_BEHIND_MAX_QUEUE=10000)
+        write_queue.init_app(app)
+    assert not os.listdir(tmp_path)
+
+def test_write_behind_spill_is_compacted_to_outstanding_events(tmp_path):
+    spill = WriteBehindQueue()
+    spill.spill_path = str(tmp_path / 'spill.ndjson')
+    spill.fsync, spill.spill_max_bytes, spill.enqueue_timeout = False, 512, 0.05
+    spill._queue = queue.Queue()
+    ids = [spill.enqueue('comment', {'discussion_id': 1, 'user_id': 1, 'comment_text': f'Comment {i}'})
+           for i in range(6)]
+    events = [spill._queue.get() for _ in ids]
+    spill._mark_committed(events[:2])
+    spill._mark_committed(events[2:5])
+    with open(spill.spill_path, encoding='utf-8') as spilled:
+        assert [json.loads(line)['id'] for line in spilled] == [ids[5]]
+    spill._mark_committed(events[5:])
+    assert not os.path.exists(spill.spill_path)
+
+def test_write_behind_spill_fsyncs_are_shared(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    spill = WriteBehindQueue()
+    spill.spill_path = str(tmp_path / 'spill.ndjson')
+    spill.fsync = True
+    with spill._spill_lock:
+        sequences = [spill._append_spill({'id': str(i)}) for i in range(3)]
+    spill._sync(sequences[0])
+    for sequence in sequences:
+        spill._sync(sequence)
+    assert len(synced) == 1
+    spill._discard_spill()
+
+def test_failed_statements_do_not_leak_query_timers(client):
+    connection = db.session.connection()
+    with pytest.raises(OperationalError):
+        connection.exec_driver_sql('SELECT * FROM no_such_table')
+    db.session.rollback()
+    assert not db.session.connection().info.get('query_started')
+
+def test_metrics_report_password_hashing(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'password_hash_latency_seconds_count' in response.data
+    assert b'password_hash_utilization' in response.data
+
+def test_slow_password_hashes_shed_load_but_keep_their_slot():
+    hasher = PasswordHasher()
+    hasher.executor_kind, hasher.workers, hasher.max_pending, hasher.timeout = 'thread', 1, 1, 0.01
+    with pytest.raises(HasherSaturated):
+        hasher._run(time.sleep, 0.3)
+    assert hasher.metrics()['password_hash_timeouts_total'] == 1
+    with pytest.raises(HasherSaturated):
+        hasher._run(time.sleep, 0)
+    assert hasher.rejected == 1
+    hasher._executor.shutdown(wait=True)
+    assert hasher.in_flight == 0
+
+def test_profile_update_expires_old_token(client):
+    client.post('/register', json={
+        'username': 'testuser',
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    login_response = client.post('/login', json={
+        'email': 'test@example.com',
+        'password': 'password123'
+    })
+    old_token = login_response.json['access_token']
+    response = client.put('/profile', json={
+        'username': 'updateduser'
+    }, headers={'Authorization': f'Bearer {old_token}'})
+    assert response.status_code == 200
+    new_token = response.json['access_token']
+
+    response = client.get('/profile', headers={'Authorization': f'Bearer {old_token}'})
+    assert response.status_code == 401
+    response = client.get('/profile', headers={'Authorization': f'Bearer {new_token}'})
+    assert response.status_code == 200
+    assert b'updateduser' in response.data
+
+def test_draw_packets_are_batched_into_frames(client):
+    drawer = socketio.test_client(app)
+    viewer = socketio.test_client(app)
+    drawer.emit('join', {'room': 'algebra', 'username': 'drawer'})
+    viewer.emit('join', {'room': 'algebra', 'username': 'viewer'})
+    viewer.get_received()
+    for i in range(20):
+        drawer.emit('draw', {'room': 'algebra', 'drawData': {'x0': i, 'y0': i, 'x1': i, 'y1': i}})
+    time.sleep(0.3)
+    frames = [packet['args'][0] for packet in viewer.get_received() if packet['name'] == 'draw_frame']
+    assert frames
+    strokes = [stroke for frame in frames for stroke in decode_frame(frame)]
+    assert strokes[0][1][0] == (0, 0)
+    assert strokes[-1][1][-1] == (19, 19)
+
+def test_draw_packets_reject_non_finite_and_clamp_coordinates():
+    for bad in (float('inf'), float('-inf'), float('nan'), 'inf', '1e400', None):
+        assert parse_draw_data({'x0': bad, 'y0': 0, 'x1': 1, 'y1': 1}) is None
+    assert parse_draw_data({'x0': 0, 'y0': 0, 'x1': 1, 'y1': 1, 'lineWidth': float('inf')}) is None
+    style, start, end = parse_draw_data({'x0': -1e300, 'y0': 2 ** 80, 'x1': 10.4, 'y1': 5, 'lineWidth': 1e9},
+                                        max_coordinate=4096, max_width=64)
+    assert (style, start, end) == (('', 64), (-4096, 4096), (10, 5))
+
+def test_late_joiner_receives_board_state(client):
+    drawer = socketio.test_client(app)
+    drawer.emit('join', {'room': 'geometry', 'username': 'drawer'})
+    for i in range(10):
+        drawer.emit('draw', {'room': 'geometry', 'drawData': {'x0': i, 'y0': 0, 'x1': i + 1, 'y1': 0}})
+    time.sleep(0.3)
+    late = socketio.test_client(app)
+    late.emit('join', {'room': 'geometry', 'username': 'late'})
+    states = [packet['args'][0] for packet in late.get_received() if packet['name'] == 'board_state']
+    assert len(states) == 1
+    frames = ([states[0]['snapshot']] if states[0]['snapshot'] else []) + states[0]['tail']
+    points = [point for frame in frames for _, stroke in decode_frame(frame) for point in stroke]
+    assert points[0] == (0, 0)
+    assert points[-1] == (10, 0)
+
+def test_memory_bus_routes_rooms_across_servers():
+    servers, received = [], []
+    for worker in range(2):
+        server = python_socketio.Server(client_manager=MemoryBus('memory://test-bus'), async_mode='threading')
+        server._emit_internal = lambda eio_sid, event, data, namespace=None, id=None, worker=worker: \
+            received.append((worker, eio_sid, event))
+        server.manager.initialize()
+        servers.append(server)
+    first, second = servers[0].manager, servers[1].manager
+    first.enter_room(first.connect('a', '/'), '/', 'algebra')
+    first.enter_room(first.connect('b', '/'), '/', 'geometry')
+    second.enter_room(second.connect('c', '/'), '/', 'algebra')
+    time.sleep(0.2)
+    assert first.room_size('algebra') == 2
+    assert second.room_size('geometry') == 1
+
+    first.emit('message', 'hi', room='algebra')
+    first.emit('message', 'local', room='geometry')
+    time.sleep(0.2)
+    assert sorted(received) == [(0, 'a', 'message'), (0, 'b', 'message'), (1, 'c', 'message')]
+    assert first.published == 1 and first.local_only == 1
+
+    second.shutdown()
+    time.sleep(0.2)
+    assert first.room_size('algebra') == 1
+    first.shutdown()
+
+def test_boards_follow_rooms_across_workers():
+    servers, stores, received = [], [BoardStore(), BoardStore()], []
+    for worker in range(2):
+        server = python_socketio.Server(client_manager=MemoryBus('memory://board-bus'), async_mode='threading')
+        server._emit_internal = lambda eio_sid, event, data, namespace=None, id=None, worker=worker: \
+            received.append((worker, eio_sid, event, data))
+        server.manager.initialize()
+        share_boards(server.manager, server, stores[worker])
+        servers.append(server)
+    first, second = servers[0].manager, servers[1].manager
+    first.enter_room(first.connect('a', '/'), '/', 'geometry')
+    time.sleep(0.2)
+    drawn = encode_frame([(('black', 2), [(0, 0), (5, 5)])])
+    stores[0].append('geometry', drawn)
+
+    late = second.connect('b', '/')
+    second.enter_room(late, '/', 'geometry')
+    assert second.local_members('geometry') == 1 and second.request_state(late, 'geometry')
+    time.sleep(0.2)
+    states = [data for worker, eio_sid, event, data in received if event == 'board_state']
+    assert states == [{'snapshot': b'', 'tail': [drawn]}]
+
+    # Frames drawn on the first worker from now on reach the second worker's copy too
+    more = encode_frame([(('black', 2), [(5, 5), (9, 9)])])
+    stores[0].append('geometry', more)
+    servers[0].emit('draw_frame', more, room='geometry')
+    time.sleep(0.2)
+    assert stores[1].catch_up('geometry') == {'snapshot': b'', 'tail': [drawn, more]}
+    assert (1, 'b', 'draw_frame', more) in received
+    second.shutdown()
+    first.shutdown()
+
+def test_socket_messages_require_membership_and_are_rate_limited(client):
+    outsider = socketio.test_client(app)
+    member = socketio.test_client(app)
+    member.emit('join', {'room': 'calculus', 'username': 'member'})
+    outsider.emit('message', {'room': 'calculus', 'message': 'spam'})
+    outsider.emit('join', {'room': '../../etc', 'username': 'outsider'})
+    assert [packet['name'] for packet in outsider.get_received()] == ['error']
+    member.get_received()
+
+    for i in range(30):
+        member.emit('message', {'room': 'calculus', 'message': str(i)})
+    responses = [packet for packet in member.get_received() if packet['name'] == 'response']
+    burst = app.config['SOCKET_SID_MESSAGE_RATE'] * app.config['SOCKET_BURST_SECONDS']
+    assert burst <= len(responses) < 30
+
+    sid = next(iter(presence.members('calculus')))
+    member.disconnect()
+    assert presence.members('calculus') == {}
+    assert presence.rooms_of(sid) == set()
+
+def test_file_database_uses_wal_and_separate_read_session(tmp_path):
+    memory_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path}/tutor.db'
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(DiscussionTopic(topic_title='Limits', description='Epsilon-delta'))
+            db.session.commit()
+            assert db.session.execute(db.text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert reads.session() is not db.session
+            assert [topic.topic_title for topic in reads.query(DiscussionTopic)] == ['Limits']
+            with pytest.raises(OperationalError):
+                reads.session().execute(db.text('DELETE FROM discussion_topic'))
+            reads.remove()
+            db.drop_all()
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = memory_uri
+
+def test_reads_go_to_replica_except_right_after_own_write(client, tmp_path):
+    replica_uri = f'sqlite:///{tmp_path}/replica.db'
+    client.post('/register', json={'username': 'reader', 'email': 'reader@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'reader@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    # The stand-in replica lags: it only has a topic the primary never saw
+    replica = db.create_engine(replica_uri, {})
+    db.metadata.create_all(replica)
+    with replica.begin() as connection:
+        connection.execute(DiscussionTopic.__table__.insert().values(topic_title='From replica', description='lag'))
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [replica_uri]
+    try:
+        titles = [topic['topic_title'] for topic in client.get('/discussion-topics', headers=headers).get_json()]
+        assert titles == ['From replica']
+
+        client.post('/discussion-topic', json={'topic_title': 'Mine', 'description': 'new'}, headers=headers)
+        titles = [topic['topic_title'] for topic in client.get('/discussion-topics', headers=headers).get_json()]
+        assert titles == ['Mine']
+    finally:
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        reads.remove()
+
+def test_discussion_topics_use_etags_and_version_counters(client):
+    client.post('/register', json={'username': 'cacher', 'email': 'cacher@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'cacher@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/discussion-topic', json={'topic_title': 'Series', 'description': 'Convergence'}, headers=headers)
+
+    first = client.get('/discussion-topics', headers=headers)
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag.startswith('"')
+    hits = response_cache.hits
+    again = client.get('/discussion-topics', headers={**headers, 'If-None-Match': etag})
+    assert again.status_code == 304 and response_cache.hits == hits + 1
+    since = client.get('/discussion-topics', headers={**headers, 'If-Modified-Since': first.headers['Last-Modified']})
+    assert since.status_code == 304
+
+    client.post('/discussion-topic', json={'topic_title': 'Limits', 'description': 'Epsilon'}, headers=headers)
+    changed = client.get('/discussion-topics', headers={**headers, 'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert [topic['topic_title'] for topic in changed.get_json()] == ['Series', 'Limits']
+
+def test_metrics_record_request_latency_and_sql_counts(client):
+    client.post('/register', json={'username': 'metered', 'email': 'metered@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'metered@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    client.get('/dashboard', headers={'Authorization': f'Bearer {token}'})
+    chatter = socketio.test_client(app)
+    chatter.emit('join', {'room': 'stats', 'username': 'metered'})
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="GET",route="/dashboard"}' in body
+    sql_count = [line for line in body.splitlines()
+                 if line.startswith('http_request_sql_statements_sum{method="GET",route="/dashboard"}')]
+    assert sql_count and float(sql_count[0].split()[-1]) >= 1
+    assert 'socketio_events_total{event="join"}' in body
+
+def test_comment_scores_are_aggregated_per_page(client):
+    client.post('/register', json={'username': 'voter', 'email': 'voter@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'voter@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    comments = [Comment(discussion_id=7, user_id=1, comment_text=f'Comment {i}') for i in range(15)]
+    db.session.add_all(comments)
+    db.session.flush()
+    for comment in comments:
+        db.session.add_all([Vote(user_id=voter, comment_id=comment.id, value=1) for voter in range(comment.id % 3)])
+    db.session.add(Report(user_id=1, comment_id=comments[0].id, reason='Off topic'))
+    db.session.commit()
+
+    response = client.get('/comment/7?limit=20', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    scores = {comment['id']: comment['score'] for comment in response.get_json()}
+    assert scores == {comment.id: comment.id % 3 for comment in comments}
+    assert response.get_json()[0]['report_count'] == 1
+
+def test_repeated_query_shapes_fail_the_request(client):
+    with app.test_request_context('/dashboard'):
+        app.preprocess_request()
+        for user_id in range(10):
+            User.query.filter_by(id=user_id).first()
+        with pytest.raises(RepeatedQueryError):
+            User.query.filter_by(id=10).first()
+
+def test_votes_maintain_scores_and_hot_ranking(client):
+    client.post('/register', json={'username': 'ranker', 'email': 'ranker@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'ranker@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    old = ForumPost(user_id=2, title='Old', content='Old post', timestamp=datetime.utcnow() - timedelta(days=2))
+    new = ForumPost(user_id=2, title='New', content='New post')
+    db.session.add_all([old, new])
+    db.session.flush()
+    db.session.add_all([Vote(user_id=voter, post_id=old.id, value=1) for voter in range(10, 15)])
+    db.session.commit()
+
+    response = client.post('/vote', json={'post_id': new.id, 'value': 1}, headers=headers)
+    assert response.get_json() == {'score': 1, 'vote_count': 1}
+    response = client.post('/vote', json={'post_id': new.id, 'value': -1}, headers=headers)
+    assert response.get_json() == {'score': -1, 'vote_count': 1}
+    response = client.post('/vote', json={'post_id': new.id, 'value': 0}, headers=headers)
+    assert response.get_json() == {'score': 0, 'vote_count': 0}
+    client.post('/vote', json={'post_id': new.id, 'value': 1}, headers=headers)
+
+    assert [post['title'] for post in client.get('/forum-posts/top', headers=headers).get_json()] == ['Old', 'New']
+    recompute_hot_scores(app.config)
+    assert [post['title'] for post in client.get('/forum-posts/hot', headers=headers).get_json()] == ['New', 'Old']
+
+    db.session.execute(ForumPost.__table__.update().values(score=0, vote_count=0))
+    rebuild_vote_scores()
+    assert (db.session.get(ForumPost, old.id).score, db.session.get(ForumPost, new.id).vote_count) == (5, 1)
+
+def test_hot_ranker_only_starts_when_enabled():
+    ranker = HotRanker()
+    ranker.init_app(app)
+    app.config['HOT_RANKER_ENABLED'] = False
+    ranker.start()
+    assert ranker._thread is None
+    app.config['HOT_RANKER_ENABLED'] = True
+    try:
+        ranker.start()
+        assert ranker._thread.is_alive()
+    finally:
+        ranker.stop()
+        app.config['HOT_RANKER_ENABLED'] = False
+
+def test_search_index_follows_writes(client):
+    client.post('/register', json={'username': 'seeker', 'email': 'seeker@example.com', 'password': 'password123'})
+    User.query.filter_by(email='seeker@example.com').one().role = 'teacher'
+    db.session.commit()
+    token = client.post('/login', json={'email': 'seeker@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    tutorial = Tutorial(title='Fractions', content='Adding fractions with unlike denominators')
+    problem = Problem(question='Simplify the fraction 6/8', difficulty='easy')
+    db.session.add_all([tutorial, problem])
+    db.session.commit()
+    client.post('/bulk/problems', json=[{'question': f'Reduce fraction number {i}', 'difficulty': 'easy'}
+                                        for i in range(3)], headers=headers)
+
+    results = client.get('/search?q=fraction', headers=headers).get_json()
+    assert results[0] == {'kind': 'tutorial', 'id': tutorial.id, 'title': 'Fractions',
+                          'snippet': 'Adding fractions with unlike denominators', 'score': results[0]['score']}
+    assert len(results) == 5
+    page = client.get('/search?q=the fraction&kind=problem&limit=3', headers=headers)
+    assert [result['kind'] for result in page.get_json()] == ['problem'] * 3
+    assert len(client.get(f"/search?q=fraction&kind=problem&after={page.headers['X-Next-Cursor']}",
+                          headers=headers).get_json()) == 1
+
+    problem.question = 'Expand the binomial'
+    db.session.delete(tutorial)
+    db.session.commit()
+    assert len(client.get('/search?q=fractions', headers=headers).get_json()) == 3
+    assert client.get('/search?q=binomial', headers=headers).get_json()[0]['id'] == problem.id
+    assert rebuild_search_index() == {'problem': 4, 'tutorial': 0, 'hint': 0, 'discussion_topic': 0,
+                                      'discussion_post': 0}
+    assert client.get('/search?q=', headers=headers).status_code == 400
+
+def test_attempts_update_ratings_and_drive_recommendations(client):
+    client.post('/register', json={'username': 'rated', 'email': 'rated@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'rated@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    user = User.query.filter_by(email='rated@example.com').first()
+    problems = {name: Problem(question=name, difficulty=name) for name in ('easy', 'medium', 'hard')}
+    solved = Problem(question='warm-up', difficulty='easy')
+    db.session.add_all(list(problems.values()) + [solved])
+    db.session.commit()
+    assert [problems[name].rating for name in ('easy', 'medium', 'hard')] == [-1.0, 0.0, 1.0]
+
+    db.session.add(Progress(user_id=user.id, problem_id=solved.id, status='completed'))
+    db.session.commit()
+    db.session.refresh(solved)
+    assert UserStats.query.get(user.id).rating > 0
+    assert solved.rating < -1.0 and solved.attempt_count == 1
+
+    # A new user's target (about 70% success) sits closest to the easy problem
+    app.config['RATING_RECOMMENDER'] = True
+    try:
+        response = client.get(f'/recommend/{user.id}', headers={'Authorization': f'Bearer {token}'})
+    finally:
+        app.config['RATING_RECOMMENDER'] = False
+    assert response.json['problem_id'] == problems['easy'].id
+
+    assert recalibrate_ratings() == {'attempts': 1, 'users': 1, 'problems': 4}
+    db.session.refresh(solved)
+    assert solved.attempt_count == 1 and solved.rating < -1.0
+
+def test_bulk_ingested_attempts_update_ratings(client):
+    client.post('/register', json={'username': 'rated', 'email': 'rated@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'rated@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    user = User.query.filter_by(email='rated@example.com').first()
+    user.role = 'teacher'
+    problem = Problem(question='2+2', difficulty='easy')
+    db.session.add(problem)
+    db.session.commit()
+
+    response = client.post('/bulk/progress', json=[
+        {'user_id': user.id, 'problem_id': problem.id, 'status': 'completed'}
+    ], headers={'Authorization': f'Bearer {token}'})
+    assert response.json['inserted'] == 1
+    db.session.refresh(problem)
+    stats = UserStats.query.get(user.id)
+    assert stats.rating > 0 and stats.total_problems == 1
+    assert problem.rating < -1.0 and problem.attempt_count == 1
+
+    # A chunk of attempts is rated exactly as the same attempts recorded one by one
+    loaded, recorded = ([User(username=f'{name}{i}', email=f'{name}{i}@example.com', password='x') for i in range(2)]
+                        for name in ('loaded', 'recorded'))
+    loaded_problems, recorded_problems = ([Problem(question=f'{name} {i}', difficulty=difficulty)
+                                           for i, difficulty in enumerate(('medium', 'hard'))]
+                                          for name in ('Loaded', 'Recorded'))
+    db.session.add_all(loaded + recorded + loaded_problems + recorded_problems)
+    db.session.commit()
+    attempts = [(0, 0, 'completed'), (0, 1, 'incorrect'), (1, 0, 'completed'), (0, 1, 'completed'),
+                (1, 1, 'incorrect')]
+    response = client.post('/bulk/progress', json=[
+        {'user_id': loaded[u].id, 'problem_id': loaded_problems[p].id, 'status': status} for u, p, status in attempts
+    ], headers={'Authorization': f'Bearer {token}'})
+    assert response.json['inserted'] == len(attempts)
+    for u, p, status in attempts:
+        db.session.add(Progress(user_id=recorded[u].id, problem_id=recorded_problems[p].id, status=status))
+    db.session.commit()
+    db.session.expire_all()
+    for ingested, written in zip(loaded + loaded_problems, recorded + recorded_problems):
+        if isinstance(ingested, User):
+            ingested, written = UserStats.query.get(ingested.id), UserStats.query.get(written.id)
+            assert ingested.total_problems == written.total_problems
+        else:
+            assert ingested.attempt_count == written.attempt_count
+        assert ingested.rating == pytest.approx(written.rating)
+
+def test_rebuilding_stats_keeps_ratings(client):
+    client.post('/register', json={'username': 'rated', 'email': 'rated@example.com', 'password': 'password123'})
+    user = User.query.filter_by(email='rated@example.com').first()
+    problem = Problem(question='2+2', difficulty='easy')
+    db.session.add(problem)
+    db.session.commit()
+    db.session.add(Progress(user_id=user.id, problem_id=problem.id, status='completed'))
+    db.session.commit()
+    rating = UserStats.query.get(user.id).rating
+    assert rating > 0
+
+    stats = UserStats.query.get(user.id)
+    stats.total_problems = 5
+    db.session.commit()
+    assert rebuild_user_stats() == 1
+    stats = UserStats.query.get(user.id)
+    assert (stats.total_problems, stats.correct_answers, stats.rating) == (1, 1, rating)
+
+def test_batch_recommendation_is_set_based(client):
+    client.post('/register', json={'username': 'teacher', 'email': 'teacher@example.com', 'password': 'password123'})
+    token = client.post('/login', json={'email': 'teacher@example.com',
+                                        'password': 'password123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    problems = [Problem(question=f'Problem {i}', difficulty=('easy', 'medium', 'hard')[i % 3]) for i in range(60)]
+    students = [User(username=f'student{i}', email=f'student{i}@example.com', password='x') for i in range(30)]
+    db.session.add_all(problems + students)
+    db.session.commit()
+    student_ids = [student.id for student in students]
+    hard = [problem for problem in problems if problem.difficulty == 'hard']
+    # The first student has done every hard problem but one: no extra queries for that
+    db.session.add_all([Progress(user_id=student_ids[0], problem_id=problem.id, status='completed')
+                        for problem in hard[:-1]])
+    db.session.commit()
+
+    assert client.post('/recommend/batch', json={'user_ids': student_ids}, headers=headers).status_code == 403
+    User.query.filter_by(username='teacher').one().role = 'teacher'
+    db.session.commit()
+    user_cache.clear()
+
+    for by_rating in (True, False):
+        app.config['RATING_RECOMMENDER'] = by_rating
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = client.post('/recommend/batch', json={'user_ids': student_ids, 'unique': True},
+                                   headers=headers)
+            unique_statements = len(statements)
+            shared = client.post('/recommend/batch', json={'user_ids': student_ids[1:]}, headers=headers).get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+            app.config['RATING_RECOMMENDER'] = False
+        assert response.status_code == 200
+        entries = response.get_json()
+        assigned = [entry['problem']['problem_id'] for entry in entries]
+        assert [entry['user_id'] for entry in entries] == student_ids
+        assert len(set(assigned)) == 30
+        assert not set(assigned[:1]) & {problem.id for problem in hard[:-1]}
+        assert {entry['performance_ratio'] for entry in entries} == {1.0}
+        # Counters, candidates (a few rounds when unique picks collide) and the chosen rows
+        assert unique_statements <= 10
+        assert len(statements) - unique_statements <= 5
+    # Without ratings a perfect record means a hard problem first, spread over the band
+    assert {entry['problem']['difficulty'] for entry in shared} == {'hard'}
+    assert len({entry['problem']['problem_id'] for entry in shared}) > 1
+
+def test_posts_fan_out_notifications_to_followers(client):
+    tokens = {}
+    for name in ('author', 'reader', 'lurker'):
+        client.post('/register', json={'username': name, 'email': f'{name}@example.com', 'password': 'password123'})
+        tokens[name] = client.post('/login', json={'email': f'{name}@example.com',
+                                                   'password': 'password123'}).get_json()['access_token']
+    author_id = User.query.filter_by(username='author').one().id
+    db.session.add_all([Follow(follower_id=follower_id, followed_id=author_id) for follower_id in range(1000, 1025)])
+    db.session.commit()
+    client.post(f'/follow/{author_id}', headers={'Authorization': f'Bearer {tokens["reader"]}'})
+    reader_socket = socketio.test_client(app, auth={'token': tokens['reader']})
+    anonymous_socket = socketio.test_client(app)
+    reader_id = User.query.filter_by(username='reader').one().id
+    # Personal rooms are joined by the server only
+    anonymous_socket.emit('join', {'room': user_room(reader_id), 'username': 'eve'})
+    assert [packet['args'][0] for packet in anonymous_socket.get_received()] == [{'message': 'Invalid room'}]
+
+    app.config['NOTIFY_FANOUT_ENABLED'] = True
+    notifier.chunk_size = 10
+    try:
+        for title in ('Primes', 'Proofs'):
+            response = client.post('/forum-post', json={'title': title, 'content': 'Read this'},
+                                   headers={'Authorization': f'Bearer {tokens["author"]}'})
+            assert response.status_code == 201
+            # The test database is one shared connection, so let each fan-out finish first
+            notifier.flush()
+    finally:
+        app.config['NOTIFY_FANOUT_ENABLED'] = False
+        notifier.chunk_size = app.config['NOTIFY_CHUNK_SIZE']
+
+    assert Notification.query.count() == 52
+    assert db.session.get(UserStats, 1010).unread_notifications == 2
+    pushed = [packet['args'][0]['message'] for packet in reader_socket.get_received()
+              if packet['name'] == 'notification']
+    assert pushed == ['author posted: Primes', 'author posted: Proofs']
+    assert not anonymous_socket.get_received()
+
+    headers = {'Authorization': f'Bearer {tokens["reader"]}'}
+    first = client.get('/notifications?limit=1', headers=headers)
+    assert first.headers['X-Unread-Count'] == '2'
+    assert [item['message'] for item in first.get_json()] == ['author posted: Proofs']
+    second = client.get(f'/notifications?limit=1&after={first.headers["X-Next-Cursor"]}', headers=headers)
+    assert [item['message'] for item in second.get_json()] == ['author posted: Primes']
+
+    # Only the notifications actually marked come off the counter, e.g. not one a
+    # concurrent fan-out has counted but not yet made visible
+    db.session.get(UserStats, reader_id).unread_notifications = 3
+    db.session.commit()
+    assert client.post('/notifications/read', headers=headers).get_json()['marked_read'] == 2
+    response = client.get('/notifications?unread=true', headers=headers)
+    assert response.get_json() == [] and response.headers['X-Unread-Count'] == '1'
+    assert client.get('/notifications', headers={'Authorization': f'Bearer {tokens["lurker"]}'}).get_json() == []
+    reader_socket.disconnect()
+    anonymous_socket.disconnect()
+
+def test_feed_is_served_from_materialized_timelines(client):
+    tokens = {}
+    for name in ('reader', 'alice', 'bob', 'carol'):
+        client.post('/register', json={'username': name, 'email': f'{name}@example.com', 'password': 'password123'})
+        tokens[name] = client.post('/login', json={'email': f'{name}@example.com',
+                                                   'password': 'password123'}).get_json()['access_token']
+    ids = {user.username: user.id for user in User.query}
+    headers = {'Authorization': f'Bearer {tokens["reader"]}'}
+    topic = DiscussionTopic(topic_title='Limits', description='Epsilon-delta')
+    db.session.add(topic)
+    db.session.commit()
+    start = datetime(2024, 1, 1)
+    db.session.add_all([DiscussionPost(topic_id=topic.id, user_id=ids[author], post_content=f'{author} {n}',
+                                       timestamp=start + timedelta(minutes=n))
+                        for n, author in enumerate(['alice', 'bob', 'carol'] * 3)])
+    db.session.commit()
+    for followed in ('alice', 'bob'):
+        assert client.post(f'/follow/{ids[followed]}', headers=headers).status_code == 201
+    assert social_graph.followers(ids['alice']) == {ids['reader']}
+
+    app.config['FEED_TIMELINE_SIZE'] = social_graph.timeline_size = 4
+    try:
+        first = client.get('/feed?limit=3', headers=headers)
+        assert [post['post_content'] for post in first.get_json()] == ['bob 7', 'alice 6', 'bob 4']
+        # New posts are pushed into the materialized timeline without rebuilding it
+        client.post('/discussion-post', json={'topic_id': topic.id, 'post_content': 'alice new'},
+                    headers={'Authorization': f'Bearer {tokens["alice"]}'})
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            latest = client.get('/feed?limit=2', headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert [post['post_content'] for post in latest.get_json()] == ['alice new', 'bob 7']
+        assert sum('discussion_post' in statement for statement in statements) == 1
+        assert social_graph.timeline_builds == 1
+
+        # Past the capped timeline, pages come from the database in the same cursor format
+        second = client.get(f'/feed?limit=3&after={first.headers["X-Next-Cursor"]}', headers=headers)
+        assert [post['post_content'] for post in second.get_json()] == ['alice 3', 'bob 1', 'alice 0']
+        assert 'X-Next-Cursor' not in second.headers
+    finally:
+        app.config['FEED_TIMELINE_SIZE'] = social_graph.timeline_size = 500
+
+    client.delete(f'/unfollow/{ids["bob"]}', headers=headers)
+    assert [post['post_content'] for post in client.get('/feed?limit=2', headers=headers).get_json()] == \
+        ['alice new', 'alice 6']
+
+def test_follow_graph_reloads_in_the_background(client):
+    db.session.add_all([User(username=name, email=f'{name}@example.com', password='x') for name in ('ann', 'ben')])
+    db.session.commit()
+    ann, ben = (User.query.filter_by(username=name).one().id for name in ('ann', 'ben'))
+    assert social_graph.followers(ann) == set()
+    # Written by another worker: no listener sees it
+    db.session.execute(Follow.__table__.insert().values(follower_id=ben, followed_id=ann))
+    db.session.commit()
+    social_graph._loaded_at -= social_graph.ttl
+    assert social_graph.followers(ann) == set()
+    deadline = time.monotonic() + 5
+    while social_graph.followers(ann) != {ben} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert social_graph.followers(ann) == {ben}
+
+def test_concurrent_first_messages_share_one_conversation(client):
+    connection = db.session.connection()
+    existing = connection.execute(conversation_table.insert().values(
+        user_low_id=1, user_high_id=2, created_on=datetime.utcnow())).inserted_primary_key[0]
+
+    # Misses the first lookup, as if another sender created the pair just after it
+    class Racing:
+        lookups = 0
+        def execute(self, statement, *args):
+            self.lookups += 1
+            if self.lookups == 1:
+                return connection.execute(statement.where(conversation_table.c.id < 0))
+            return connection.execute(statement, *args)
+        def __getattr__(self, name):
+            return getattr(connection, name)
+
+    assert conversation_for(Racing(), 2, 1) == existing
+    assert connection.execute(select(func.count()).select_from(conversation_table)).scalar() == 1
+
+def test_inbox_entries_are_upserted(client):
+    connection = db.session.connection()
+    conversation_id = conversation_for(connection, 1, 2)
+    # The recipient's entry appears between a lookup and an insert, as if another message raced this one
+    connection.execute(participant_table.insert().values(
+        conversation_id=conversation_id, user_id=1, other_user_id=2, unread_count=2, last_message_id=1,
+        last_sender_id=2, last_message_preview='Earlier', last_message_at=datetime(2020, 1, 1)))
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        record_message(connection, conversation_id, Message(id=2, sender_id=2, recipient_id=1, message_text='Later',
+                                                            timestamp=datetime(2020, 1, 2)))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert len(statements) == 2
+    entries = connection.execute(select(participant_table.c.user_id, participant_table.c.unread_count,
+                                        participant_table.c.last_message_preview)
+                                 .order_by(participant_table.c.user_id)).all()
+    assert entries == [(1, 3, 'Later'), (2, 0, 'Later')]
+
+def test_conversations_keep_inbox_summaries(client):
+    tokens = {}
+    for name in ('ann', 'ben', 'cat'):
+        client.post('/register', json={'username': name, 'email': f'{name}@example.com', 'password': 'password123'})
+        tokens[name] = client.post('/login', json={'email': f'{name}@example.com',
+                                                   'password': 'password123'}).get_json()['access_token']
+    ids = {user.username: user.id for user in User.query}
+    headers = {name: {'Authorization': f'Bearer {token}'} for name, token in tokens.items()}
+
+    for sender, recipient, text in [('ann', 'ben', 'Hi Ben'), ('ben', 'ann', 'Hi Ann'), ('ann', 'ben', 'Homework?'),
+                                    ('cat', 'ben', 'Study group at 5')]:
+        response = client.post('/message', json={'recipient_id': ids[recipient], 'message_text': text},
+                               headers=headers[sender])
+        assert response.status_code == 201
+
+    inbox = client.get('/conversations', headers=headers['ben']).get_json()
+    assert [(entry['other_user_id'], entry['last_message_preview'], entry['unread_count']) for entry in inbox] == \
+        [(ids['cat'], 'Study group at 5', 1), (ids['ann'], 'Homework?', 2)]
+    thread_id = inbox[1]['conversation_id']
+
+    first = client.get(f'/conversations/{thread_id}/messages?limit=2', headers=headers['ben'])
+    assert [message['message_text'] for message in first.get_json()] == ['Homework?', 'Hi Ann']
+    second = client.get(f'/conversations/{thread_id}/messages?limit=2&after={first.headers["X-Next-Cursor"]}',
+                        headers=headers['ben'])
+    assert [message['message_text'] for message in second.get_json()] == ['Hi Ben']
+    assert client.get(f'/conversations/{thread_id}/messages', headers=headers['cat']).status_code == 404
+
+    assert client.post(f'/conversations/{thread_id}/read', headers=headers['ben']).status_code == 200
+    inbox = client.get('/conversations', headers=headers['ben']).get_json()
+    assert [entry['unread_count'] for entry in inbox] == [1, 0]
+    assert client.get('/conversations', headers=headers['ann']).get_json()[0]['unread_count'] == 1
+
+    # Messages stored before conversations existed are grouped by the backfill
+    db.session.execute(Message.__table__.insert(), [
+        {'sender_id': ids['cat'], 'recipient_id': ids['ann'], 'message_text': f'Old {n}',
+         'timestamp': datetime(2020, 1, 1) + timedelta(minutes=n)} for n in range(3)])
+    db.session.commit()
+    assert backfill_conversations(chunk_size=2) == 3
+    inbox = client.get('/conversations', headers=headers['ann']).get_json()
+    assert [(entry['other_user_id'], entry['last_message_preview'], entry['unread_count']) for entry in inbox] == \
+        [(ids['ben'], 'Homework?', 1), (ids['cat'], 'Old 2', 0)]
+
+def test_ipc_bus_requires_a_private_directory(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o777)
+    with pytest.raises(PermissionError):
+        IPCBus(f'ipc://{shared}', channel='test')
+
+    message = {'method': 'emit', 'data': {'snapshot': b'\x57\x01', 'tail': [b'\x00']}, 'room': 'algebra'}
+    assert decode_message(encode_message(message)) == message
+    private_directory(str(tmp_path / 'private'))
+    assert (tmp_path / 'private').stat().st_mode & 0o777 == 0o700
+
+def test_ipc_bus_fragments_large_messages():
+    with pytest.raises(TypeError):
+        RoomBus()
+    # The default directory keeps socket paths under the AF_UNIX length limit
+    channel = f'fragments-{os.getpid()}'
+    sender, receiver = IPCBus('ipc://', channel=channel), IPCBus('ipc://', channel=channel)
+    sender.chunk_size = 1024
+    receiver._receiver.settimeout(5)
+    try:
+        state = {'method': 'state', 'host_id': sender.host_id, 'room': 'algebra', 'state': os.urandom(50000)}
+        messages = receiver._listen()
+        sender._send([receiver.host_id], state)
+        assert decode_message(next(messages)) == state
+        sender._send([receiver.host_id], {'method': 'hello', 'host_id': sender.host_id})
+        assert decode_message(next(messages))['method'] == 'hello'
+        assert sender.dropped == 0
+    finally:
+        sender.shutdown()
+        receiver.shutdown()
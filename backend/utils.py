@@ -1,27 +1,69 @@
-from backend.models import Problem, Progress
+from backend import db
+from backend.catalog import catalog
+from backend.models import Problem, Progress, UserStats
+from backend.ratings import recommend_batch, recommend_by_rating
+from flask import current_app
+from sqlalchemy import and_, exists, func
 import random
 
-def recommend_problem(user_id):
-    # Retrieve user progress
-    progress = Progress.query.filter_by(user_id=user_id).all()
-    completed_problems = {p.problem_id for p in progress}
+def difficulty_for(total_problems, correct_answers):
+    performance_ratio = correct_answers / total_problems if total_problems else 1
+    if performance_ratio >= 0.75:
+        return 'hard'
+    elif performance_ratio >= 0.5:
+        return 'medium'
+    return 'easy'
 
-    # Retrieve user's performance metrics
-    correct_answers = sum(1 for p in progress if p.status == 'completed')
-    incorrect_answers = len(progress) - correct_answers
-    performance_ratio = correct_answers / len(progress) if progress else 1
+# Pick the difficulty band from the user's maintained stats (no history scan)
+def choose_difficulty(user_id):
+    stats = UserStats.query.get(user_id)
+    if stats:
+        return difficulty_for(stats.total_problems, stats.correct_answers)
+    return difficulty_for(0, 0)
 
-    # Filter out completed problems and categorize by difficulty
-    easy_problems = Problem.query.filter(~Problem.id.in_(completed_problems), Problem.difficulty == 'easy').all()
-    medium_problems = Problem.query.filter(~Problem.id.in_(completed_problems), Problem.difficulty == 'medium').all()
-    hard_problems = Problem.query.filter(~Problem.id.in_(completed_problems), Problem.difficulty == 'hard').all()
+# Select one problem of the given difficulty the user has not attempted.
+# Seeks to a random id in the (difficulty, id) index and takes the first unsolved
+# row from there, wrapping around once; the anti-join probes (user_id, problem_id).
+def pick_unsolved_problem(user_id, difficulty):
+    low, high = db.session.query(func.min(Problem.id), func.max(Problem.id)) \
+        .filter(Problem.difficulty == difficulty).one()
+    if low is None:
+        return None
 
-    # Recommendation logic based on performance ratio
-    if performance_ratio >= 0.75:
-        recommended_problem = random.choice(hard_problems) if hard_problems else None
-    elif performance_ratio >= 0.5:
-        recommended_problem = random.choice(medium_problems) if medium_problems else None
-    else:
-        recommended_problem = random.choice(easy_problems) if easy_problems else None
+    pivot = random.randint(low, high)
+    attempted = exists().where(and_(Progress.user_id == user_id, Progress.problem_id == Problem.id))
+    unsolved = Problem.query.filter(Problem.difficulty == difficulty, ~attempted).order_by(Problem.id)
+    return unsolved.filter(Problem.id >= pivot).first() or unsolved.filter(Problem.id < pivot).first()
+
+# Bands to try when the preferred one has nothing left, nearest first
+FALLBACK_BANDS = {
+    'hard': ['hard', 'medium', 'easy'],
+    'medium': ['medium', 'easy', 'hard'],
+    'easy': ['easy', 'medium', 'hard'],
+}
+
+def recommend_problem(user_id):
+    if current_app.config.get('RATING_RECOMMENDER', False):
+        return recommend_by_rating(user_id)
+    if current_app.config.get('PROBLEM_CATALOG_ENABLED', True):
+        # Sample from the in-process catalog; only the chosen row is fetched
+        difficulty = difficulty_for(*catalog.performance(user_id))
+        for band in FALLBACK_BANDS[difficulty]:
+            problem_id = catalog.sample_unsolved(user_id, band)
+            if problem_id:
+                return Problem.query.get(problem_id)
+        return None
+    for difficulty in FALLBACK_BANDS[choose_difficulty(user_id)]:
+        problem = pick_unsolved_problem(user_id, difficulty)
+        if problem:
+            return problem
+    return None
+
+def fallback_bands(total_problems, correct_answers):
+    return FALLBACK_BANDS[difficulty_for(total_problems, correct_answers)]
 
-    return recommended_problem
+# Recommendations for a group of users, by rating or by difficulty band like recommend_problem()
+def recommend_group(user_ids, unique=False):
+    if current_app.config.get('RATING_RECOMMENDER', False):
+        return recommend_batch(user_ids, unique)
+    return recommend_batch(user_ids, unique, bands_for=fallback_bands)
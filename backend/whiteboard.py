@@ -0,0 +1,413 @@
+from collections import OrderedDict
+import hashlib
+import math
+import os
+import threading
+import time
+
+FRAME_MAGIC = 0x57  # 'W'
+FRAME_VERSION = 1
+
+# Unsigned LEB128 varint
+def _put_uvarint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _get_uvarint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+def _distance_to_segment(point, start, end):
+    (px, py), (ax, ay), (bx, by) = point, start, end
+    dx, dy = bx - ax, by - ay
+    if dx == 0 and dy == 0:
+        return ((px - ax) ** 2 + (py - ay) ** 2) ** 0.5
+    return abs(dy * px - dx * py + bx * ay - by * ax) / (dx * dx + dy * dy) ** 0.5
+
+# Ramer-Douglas-Peucker, iterative; keeps points further than epsilon from the simplified line
+def simplify(points, epsilon):
+    if len(points) < 3 or epsilon <= 0:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        index, furthest = None, epsilon
+        for i in range(first + 1, last):
+            distance = _distance_to_segment(points[i], points[first], points[last])
+            if distance > furthest:
+                index, furthest = i, distance
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+# Frame layout (all integers are varints, coordinates in whole pixels):
+#   magic, version, style count, [width, color length, color utf-8] * styles,
+#   stroke count, [style index, point count, x0, y0 (zigzag), dx, dy (zigzag deltas)...] * strokes
+def encode_frame(strokes):
+    styles = []
+    style_index = {}
+    for style, _ in strokes:
+        if style not in style_index:
+            style_index[style] = len(styles)
+            styles.append(style)
+
+    out = bytearray([FRAME_MAGIC, FRAME_VERSION])
+    _put_uvarint(out, len(styles))
+    for color, width in styles:
+        encoded = color.encode('utf-8')
+        _put_uvarint(out, width)
+        _put_uvarint(out, len(encoded))
+        out += encoded
+    _put_uvarint(out, len(strokes))
+    for style, points in strokes:
+        _put_uvarint(out, style_index[style])
+        _put_uvarint(out, len(points))
+        previous_x = previous_y = 0
+        for x, y in points:
+            _put_uvarint(out, _zigzag(x - previous_x))
+            _put_uvarint(out, _zigzag(y - previous_y))
+            previous_x, previous_y = x, y
+    return bytes(out)
+
+def decode_frame(data):
+    if data[0] != FRAME_MAGIC or data[1] != FRAME_VERSION:
+        raise ValueError('Not a whiteboard frame')
+    offset = 2
+    style_count, offset = _get_uvarint(data, offset)
+    styles = []
+    for _ in range(style_count):
+        width, offset = _get_uvarint(data, offset)
+        length, offset = _get_uvarint(data, offset)
+        styles.append((bytes(data[offset:offset + length]).decode('utf-8'), width))
+        offset += length
+    stroke_count, offset = _get_uvarint(data, offset)
+    strokes = []
+    for _ in range(stroke_count):
+        index, offset = _get_uvarint(data, offset)
+        point_count, offset = _get_uvarint(data, offset)
+        points = []
+        x = y = 0
+        for _ in range(point_count):
+            dx, offset = _get_uvarint(data, offset)
+            dy, offset = _get_uvarint(data, offset)
+            x, y = x + _unzigzag(dx), y + _unzigzag(dy)
+            points.append((x, y))
+        strokes.append((styles[index], points))
+    return strokes
+
+# Round a client number to a whole pixel within [-bound, bound]; inf and NaN are rejected
+def _pixel(value, bound):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('Non-finite coordinate')
+    return int(round(min(max(value, -bound), bound)))
+
+# Parse a client drawData packet into (style, start, end), or None if malformed.
+# Coordinates are clamped to the canvas bounds and widths to max_width, so every
+# value encodes as a short varint.
+def parse_draw_data(draw_data, max_coordinate=100000, max_width=1000):
+    if not isinstance(draw_data, dict):
+        return None
+    try:
+        start = (_pixel(draw_data['x0'], max_coordinate), _pixel(draw_data['y0'], max_coordinate))
+        end = (_pixel(draw_data['x1'], max_coordinate), _pixel(draw_data['y1'], max_coordinate))
+        width = _pixel(draw_data.get('lineWidth', 0), max_width)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+    color = draw_data.get('color', '')
+    if not isinstance(color, str) or width < 0:
+        return None
+    return (color[:32], width), start, end
+
+# Coalesces per-room draw packets into binary frames emitted once per tick.
+# Consecutive packets from the same sender and style are chained into a stroke,
+# simplified, and delta-encoded; a room holding more than WHITEBOARD_MAX_PENDING_POINTS
+# unsent points applies WHITEBOARD_DROP_POLICY ('drop_oldest' or 'drop_newest').
+class DrawAggregator:
+    # Rooms with no new points for this many ticks drop their per-sender state
+    IDLE_TICKS = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._pending = {}
+        self._idle = {}
+        self._task = None
+        self.enabled = False
+        self.packets_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.points_dropped = 0
+
+    def init_app(self, app, socketio):
+        self.socketio = socketio
+        self.enabled = app.config.get('WHITEBOARD_BATCHING', True)
+        self.interval = 1 / app.config.get('WHITEBOARD_TICK_HZ', 30)
+        self.max_frame_points = app.config.get('WHITEBOARD_MAX_FRAME_POINTS', 2000)
+        self.max_pending_points = app.config.get('WHITEBOARD_MAX_PENDING_POINTS', 20000)
+        self.drop_policy = app.config.get('WHITEBOARD_DROP_POLICY', 'drop_oldest')
+        self.epsilon = app.config.get('WHITEBOARD_SIMPLIFY_EPSILON', 1.0)
+        self.join_distance = app.config.get('WHITEBOARD_JOIN_DISTANCE', 50)
+        self.max_coordinate = app.config.get('WHITEBOARD_MAX_COORDINATE', 100000)
+        self.max_line_width = app.config.get('WHITEBOARD_MAX_LINE_WIDTH', 1000)
+
+    def _ensure_ticking(self):
+        if self._task is None:
+            self._task = self.socketio.start_background_task(self._run)
+
+    # A run is [style, points, anchored]; an anchored run's first point was already
+    # sent as the end of the previous frame and is only resent to keep the line joined.
+    @staticmethod
+    def _new_points(run):
+        return len(run[1]) - (1 if run[2] else 0)
+
+    def _drop_oldest(self, room, runs_by_sender):
+        while self._pending[room] > self.max_pending_points:
+            sender, runs = next(iter(runs_by_sender.items()))
+            dropped = self._new_points(runs.pop(0))
+            self._pending[room] -= dropped
+            self.points_dropped += dropped
+            if not runs:
+                del runs_by_sender[sender]
+
+    def _near(self, a, b):
+        return abs(a[0] - b[0]) <= self.join_distance and abs(a[1] - b[1]) <= self.join_distance
+
+    # Queue one drawData packet; returns False if it was malformed or dropped
+    def add(self, room, sender, draw_data):
+        parsed = parse_draw_data(draw_data, self.max_coordinate, self.max_line_width)
+        if parsed is None:
+            return False
+        style, start, end = parsed
+        with self._lock:
+            self.packets_in += 1
+            runs_by_sender = self._rooms.setdefault(room, OrderedDict())
+            pending = self._pending.get(room, 0)
+            if pending >= self.max_pending_points and self.drop_policy == 'drop_newest':
+                self.points_dropped += 1
+                return False
+
+            runs = runs_by_sender.setdefault(sender, [])
+            last = runs[-1] if runs else None
+            if last is not None and last[0] == style and last[1][-1] == start:
+                added = [end] if end != start else []
+                last[1].extend(added)
+            elif last is not None and last[0] == style and start == end and self._near(last[1][-1], start):
+                # Pointer-move clients send single points; consecutive ones form a line
+                added = [start]
+                last[1].append(start)
+            else:
+                added = [start] if end == start else [start, end]
+                runs.append([style, added, False])
+            self._pending[room] = pending + len(added)
+            if self._pending[room] > self.max_pending_points:
+                self._drop_oldest(room, runs_by_sender)
+        self._ensure_ticking()
+        return True
+
+    # Drop a sender's state in a room (on leave/disconnect)
+    def forget(self, room, sender):
+        with self._lock:
+            runs = self._rooms.get(room, {}).pop(sender, [])
+            if room in self._pending:
+                self._pending[room] -= sum(self._new_points(run) for run in runs)
+
+    # Take up to max_frame_points new points from the room's queued runs.
+    # Each sender's open run keeps its last sent point as the anchor for the next frame.
+    def _take_strokes(self, room):
+        runs_by_sender = self._rooms[room]
+        strokes = []
+        budget = self.max_frame_points
+        for runs in runs_by_sender.values():
+            while runs and budget > 0:
+                run = runs[0]
+                new_points = self._new_points(run)
+                if new_points == 0:
+                    break
+                taken = min(new_points, budget)
+                end = taken + (1 if run[2] else 0)
+                strokes.append((run[0], simplify(run[1][:end], self.epsilon)))
+                budget -= taken
+                self._pending[room] -= taken
+                if end < len(run[1]) or len(runs) == 1:
+                    run[1] = run[1][end - 1:]
+                    run[2] = True
+                else:
+                    runs.pop(0)
+            if budget == 0:
+                break
+        return strokes
+
+    def _collect_frames(self):
+        frames = []
+        for room in list(self._rooms):
+            strokes = self._take_strokes(room) if self._pending.get(room) else []
+            if strokes:
+                self._idle[room] = 0
+                frames.append((room, encode_frame(strokes)))
+            else:
+                self._idle[room] = self._idle.get(room, 0) + 1
+                if self._idle[room] >= self.IDLE_TICKS:
+                    del self._rooms[room]
+                    self._pending.pop(room, None)
+                    self._idle.pop(room, None)
+        return frames
+
+    def _run(self):
+        next_eviction = time.monotonic() + board_store.idle_seconds
+        while True:
+            self.socketio.sleep(self.interval)
+            with self._lock:
+                frames = self._collect_frames()
+            for room, frame in frames:
+                self.frames_out += 1
+                self.bytes_out += len(frame)
+                board_store.append(room, frame)
+                self.socketio.emit('draw_frame', frame, to=room)
+            if time.monotonic() >= next_eviction:
+                board_store.evict_idle()
+                next_eviction = time.monotonic() + board_store.idle_seconds
+
+    def metrics(self):
+        return {
+            'whiteboard_draw_packets_total': self.packets_in,
+            'whiteboard_frames_total': self.frames_out,
+            'whiteboard_frame_bytes_total': self.bytes_out,
+            'whiteboard_points_dropped_total': self.points_dropped,
+        }
+
+# Whiteboard contents of one room: a compacted snapshot frame plus the frames sent since
+class RoomBoard:
+    def __init__(self, snapshot=b''):
+        self.snapshot = snapshot
+        self.log = []
+        self.log_bytes = 0
+        self.touched = time.monotonic()
+
+    def size(self):
+        return len(self.snapshot) + self.log_bytes
+
+# Keeps each room's board as an append-only log of emitted frames, periodically
+# compacted into a single snapshot frame, so a late joiner can be sent the whole
+# board in one payload. Compaction keeps the newest strokes within
+# WHITEBOARD_ROOM_MAX_BYTES; rooms idle for WHITEBOARD_STATE_IDLE_SECONDS are
+# written to WHITEBOARD_STATE_DIR and reloaded when next used.
+class BoardStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self.compact_every = 100
+        self.max_bytes = 1024 * 1024
+        self.idle_seconds = 300
+        self.state_dir = 'whiteboards'
+
+    def init_app(self, app):
+        self.compact_every = app.config.get('WHITEBOARD_COMPACT_EVERY', 100)
+        self.max_bytes = app.config.get('WHITEBOARD_ROOM_MAX_BYTES', 1024 * 1024)
+        self.idle_seconds = app.config.get('WHITEBOARD_STATE_IDLE_SECONDS', 300)
+        self.state_dir = app.config.get('WHITEBOARD_STATE_DIR', 'whiteboards')
+
+    def _path(self, room):
+        return os.path.join(self.state_dir, hashlib.sha1(room.encode('utf-8')).hexdigest() + '.wbf')
+
+    def _board(self, room):
+        board = self._rooms.get(room)
+        if board is None:
+            snapshot = b''
+            path = self._path(room)
+            if os.path.exists(path):
+                with open(path, 'rb') as state:
+                    snapshot = state.read()
+            board = self._rooms[room] = RoomBoard(snapshot)
+        board.touched = time.monotonic()
+        return board
+
+    def _compact(self, board):
+        strokes = decode_frame(board.snapshot) if board.snapshot else []
+        for frame in board.log:
+            strokes.extend(decode_frame(frame))
+        snapshot = encode_frame(strokes)
+        while len(snapshot) > self.max_bytes and strokes:
+            # Over the room's cap: drop the oldest tenth of the strokes
+            strokes = strokes[len(strokes) // 10 or 1:]
+            snapshot = encode_frame(strokes)
+        board.snapshot = snapshot if strokes else b''
+        board.log = []
+        board.log_bytes = 0
+
+    def append(self, room, frame):
+        with self._lock:
+            board = self._board(room)
+            board.log.append(frame)
+            board.log_bytes += len(frame)
+            if len(board.log) >= self.compact_every or board.size() > self.max_bytes:
+                self._compact(board)
+
+    # Adopt a board fetched from another worker in place of this worker's copy
+    def replace(self, room, state):
+        with self._lock:
+            board = self._rooms[room] = RoomBoard(state.get('snapshot') or b'')
+            board.log = list(state.get('tail') or [])
+            board.log_bytes = sum(len(frame) for frame in board.log)
+
+    # Latest snapshot plus the frames sent after it, for a client joining mid-session
+    def catch_up(self, room):
+        with self._lock:
+            board = self._board(room)
+            return {'snapshot': board.snapshot, 'tail': list(board.log)}
+
+    # Compact idle rooms to disk and drop them from memory
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [room for room, board in self._rooms.items() if board.touched < cutoff]
+            if idle:
+                os.makedirs(self.state_dir, exist_ok=True)
+            for room in idle:
+                board = self._rooms.pop(room)
+                self._compact(board)
+                path = self._path(room)
+                if not board.snapshot:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                with open(path + '.tmp', 'wb') as state:
+                    state.write(board.snapshot)
+                os.replace(path + '.tmp', path)
+
+draw_aggregator = DrawAggregator()
+board_store = BoardStore()
+
+# With a RoomBus client manager, keep boards in step across workers. Frames drawn on
+# other workers are appended as they are relayed here, and a room's first local member
+# is sent the board fetched from a worker that already has members in it.
+def share_boards(manager, socketio, store=board_store):
+    def on_remote_emit(event, data, namespace, room):
+        if event == 'draw_frame' and isinstance(data, bytes) and room:
+            store.append(room, data)
+
+    def on_state(namespace, room, sid, state):
+        store.replace(room, state)
+        socketio.emit('board_state', state, to=sid, namespace=namespace)
+
+    manager.emit_listener = on_remote_emit
+    manager.state_provider = lambda namespace, room: store.catch_up(room)
+    manager.state_listener = on_state
@@ -0,0 +1,322 @@
+from backend import db
+from backend.models import Comment, DiscussionPost, DiscussionTopic, ForumPost, Hint, LearningPath, Message, Progress
+from datetime import datetime
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Event kinds accepted by the write-behind queue
+MODELS = {
+    'comment': Comment,
+    'discussion_post': DiscussionPost,
+    'discussion_topic': DiscussionTopic,
+    'forum_post': ForumPost,
+    'hint': Hint,
+    'learning_path': LearningPath,
+    'message': Message,
+    'progress': Progress,
+}
+
+class QueueFull(Exception):
+    pass
+
+# Each process journals to its own file next to WRITE_BEHIND_SPILL_PATH, e.g.
+# logs/write_behind.1234.ndjson, and holds an flock on <journal>.lock while it runs
+def _process_path(base, pid):
+    root, extension = os.path.splitext(base)
+    return f'{root}.{pid}{extension}'
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+# Optional write-behind mode for request-path inserts.
+# Handlers enqueue (kind, fields) and return immediately; a background worker
+# group-commits queued events every WRITE_BEHIND_FLUSH_MS or WRITE_BEHIND_BATCH_SIZE rows.
+# Each accepted event is appended to a spill file before the request returns, and
+# committed ids are appended after each commit, so events still outstanding after a
+# crash are replayed on the next start. Once the file passes WRITE_BEHIND_SPILL_MAX_BYTES
+# it is rewritten with just the outstanding events. Appends are fsynced as a group:
+# whichever writer syncs first covers every line appended before it.
+# Journals are per process; on start a process also adopts the journals of processes
+# whose lock is no longer held, i.e. that died, and commits their events before serving.
+class WriteBehindQueue:
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self._queue = None
+        self._worker = None
+        self._stopping = threading.Event()
+        self._spill_lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # taken before _spill_lock when both are held
+        self._written = 0
+        self._synced = 0
+        self._outstanding = {}
+        self._spill = None
+        self._spill_bytes = 0
+        self._lock_file = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('WRITE_BEHIND_ENABLED', False)
+        if not self.enabled:
+            return
+        self.app = app
+        self.batch_size = app.config.get('WRITE_BEHIND_BATCH_SIZE', 500)
+        self.flush_interval = app.config.get('WRITE_BEHIND_FLUSH_MS', 50) / 1000
+        self.enqueue_timeout = app.config.get('WRITE_BEHIND_ENQUEUE_TIMEOUT_MS', 50) / 1000
+        self.spill_base = app.config.get('WRITE_BEHIND_SPILL_PATH', 'logs/write_behind.ndjson')
+        self.spill_path = _process_path(self.spill_base, os.getpid())
+        self.fsync = app.config.get('WRITE_BEHIND_FSYNC', True)
+        self.spill_max_bytes = app.config.get('WRITE_BEHIND_SPILL_MAX_BYTES', 16 * 1024 * 1024)
+        self._queue = queue.Queue(maxsize=app.config.get('WRITE_BEHIND_MAX_QUEUE', 10000))
+        self._stopping.clear()
+
+        self._hold_spill_lock()
+        self._replay_spill()
+        self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._worker.start()
+        atexit.register(self.shutdown)
+
+    # Write one line and return its sequence number; pass that to _sync before relying on it.
+    # Callers hold _spill_lock.
+    def _append_spill(self, record):
+        if self._spill is None:
+            self._spill = open(self.spill_path, 'a', encoding='utf-8')
+            self._spill_bytes = self._spill.tell()
+        line = json.dumps(record, default=_encode) + '\n'
+        self._spill.write(line)
+        self._spill.flush()
+        self._spill_bytes += len(line)
+        self._written += 1
+        return self._written
+
+    # Make sure line `sequence` is on disk. One fsync covers every line written before it
+    # started, so writers that queued behind it usually find their line already synced.
+    def _sync(self, sequence):
+        if not self.fsync:
+            return
+        with self._sync_lock:
+            if self._synced >= sequence:
+                return
+            with self._spill_lock:
+                target = self._written
+                spill = self._spill
+            # The file cannot be closed or replaced meanwhile: that needs _sync_lock
+            if spill is not None:
+                os.fsync(spill.fileno())
+            self._synced = target
+
+    def _discard_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._spill_bytes = 0
+        if os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    # Replace the spill file with one holding only the outstanding events; the rename
+    # is atomic, so a crash leaves either the old file or the complete new one.
+    # Callers hold _sync_lock and _spill_lock.
+    def _compact_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        compacted = self.spill_path + '.compact'
+        with open(compacted, 'w', encoding='utf-8') as spill:
+            for event in self._outstanding.values():
+                spill.write(json.dumps(event, default=_encode) + '\n')
+            spill.flush()
+            if self.fsync:
+                os.fsync(spill.fileno())
+        os.replace(compacted, self.spill_path)
+        self._synced = self._written
+
+    # Lock this process's journal. The lock file is locked under a temporary name and
+    # renamed into place, so no other process ever sees it unlocked.
+    def _hold_spill_lock(self):
+        if self._lock_file is not None:
+            return
+        directory = os.path.dirname(self.spill_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        staging = f'{self.spill_path}.lock.{uuid.uuid4().hex}'
+        self._lock_file = open(staging, 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        os.replace(staging, self.spill_path + '.lock')
+
+    def _release_spill_lock(self):
+        if self._lock_file is None:
+            return
+        if os.path.exists(self.spill_path + '.lock'):
+            os.remove(self.spill_path + '.lock')
+        self._lock_file.close()
+        self._lock_file = None
+
+    # Lock files of dead processes, locked by us: [(lock file, journal path)]
+    def _orphaned_journals(self):
+        root, extension = os.path.splitext(self.spill_base)
+        orphans = []
+        for lock_path in glob.glob(glob.escape(root) + '.*' + glob.escape(extension) + '.lock'):
+            journal = lock_path[:-len('.lock')]
+            if journal == self.spill_path:
+                continue
+            try:
+                lock_file = open(lock_path, 'a')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()  # still running
+                continue
+            orphans.append((lock_file, journal))
+        return orphans
+
+    @staticmethod
+    def _read_spill(path, pending):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as spill:
+            for line in spill:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn final line from a crash mid-write
+                if 'committed' in record:
+                    for event_id in record['committed']:
+                        pending.pop(event_id, None)
+                else:
+                    pending[record['id']] = record
+
+    # Commit events that were spilled but never marked committed, by this pid's previous
+    # process or by dead ones. They are first moved into this process's journal, then
+    # committed in batches here, before the worker starts and before any request can
+    # fill the queue.
+    def _replay_spill(self):
+        pending = {}
+        self._read_spill(self.spill_path, pending)
+        orphans = self._orphaned_journals()
+        for _, journal in orphans:
+            self._read_spill(journal, pending)
+        if pending:
+            logger.warning('Replaying %d write-behind events into %s', len(pending), self.spill_path)
+            with self._sync_lock, self._spill_lock:
+                self._outstanding.update(pending)
+                self._compact_spill()
+        elif os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        for lock_file, journal in orphans:
+            for path in (journal, journal + '.lock'):
+                if os.path.exists(path):
+                    os.remove(path)
+            lock_file.close()
+
+        events = list(pending.values())
+        with self.app.app_context():
+            for start in range(0, len(events), self.batch_size):
+                batch = events[start:start + self.batch_size]
+                self._commit(batch)
+                self._mark_committed(batch)
+
+    # Accept an insert for later commit and return its event id.
+    # Raises QueueFull when the queue stays full for WRITE_BEHIND_ENQUEUE_TIMEOUT_MS.
+    def enqueue(self, kind, fields):
+        event = {'id': uuid.uuid4().hex, 'kind': kind, 'fields': fields}
+        # Spill before the worker can see the event, so its commit marker always comes later
+        with self._spill_lock:
+            self._outstanding[event['id']] = event
+            sequence = self._append_spill(event)
+        self._sync(sequence)
+        try:
+            self._queue.put(event, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._mark_committed([event])
+            raise QueueFull()
+        return event['id']
+
+    def _collect_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _build(event):
+        fields = dict(event['fields'])
+        if isinstance(fields.get('timestamp'), str):
+            fields['timestamp'] = datetime.fromisoformat(fields['timestamp'])
+        return MODELS[event['kind']](**fields)
+
+    def _commit(self, batch):
+        try:
+            db.session.add_all([self._build(event) for event in batch])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if len(batch) == 1:
+                # Dropped rather than retried forever
+                logger.exception('Dropping write-behind event %s', batch[0]['id'])
+                return
+            for event in batch:
+                self._commit([event])
+
+    # Record events as done; once nothing is outstanding the spill file is discarded,
+    # and while the queue never drains it is compacted whenever it outgrows its cap
+    def _mark_committed(self, batch):
+        ids = [event['id'] for event in batch]
+        with self._sync_lock, self._spill_lock:
+            for event_id in ids:
+                self._outstanding.pop(event_id, None)
+            if not self._outstanding:
+                self._discard_spill()
+                return
+            if self._spill_bytes > self.spill_max_bytes:
+                self._compact_spill()
+                return
+            sequence = self._append_spill({'committed': ids})
+        self._sync(sequence)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            with self.app.app_context():
+                self._commit(batch)
+            self._mark_committed(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    # Block until everything enqueued so far has been committed
+    def flush(self):
+        if self.enabled:
+            self._queue.join()
+
+    def shutdown(self):
+        if not self.enabled or self._worker is None:
+            return
+        self._stopping.set()
+        self._worker.join()
+        self._worker = None
+        self._release_spill_lock()
+
+write_queue = WriteBehindQueue()
@@ -4,6 +4,53 @@ import io from 'socket.io-client';
 
 const socket = io('http://localhost:5000');
 
+// Decode a binary 'draw_frame' from the server (see backend/whiteboard.py encode_frame)
+const decodeFrame = (buffer) => {
+    const data = new Uint8Array(buffer);
+    let offset = 2;
+    const readVarint = () => {
+        let value = 0;
+        let shift = 0;
+        let byte;
+        do {
+            byte = data[offset++];
+            value += (byte & 0x7f) * 2 ** shift;
+            shift += 7;
+        } while (byte >= 0x80);
+        return value;
+    };
+    const readSigned = () => {
+        const value = readVarint();
+        return value % 2 === 0 ? value / 2 : -(value + 1) / 2;
+    };
+
+    const styles = [];
+    const styleCount = readVarint();
+    for (let i = 0; i < styleCount; i++) {
+        const width = readVarint();
+        const length = readVarint();
+        const color = new TextDecoder().decode(data.slice(offset, offset + length));
+        offset += length;
+        styles.push({ color, width });
+    }
+    const strokes = [];
+    const strokeCount = readVarint();
+    for (let i = 0; i < strokeCount; i++) {
+        const style = styles[readVarint()];
+        const pointCount = readVarint();
+        const points = [];
+        let x = 0;
+        let y = 0;
+        for (let j = 0; j < pointCount; j++) {
+            x += readSigned();
+            y += readSigned();
+            points.push([x, y]);
+        }
+        strokes.push({ style, points });
+    }
+    return strokes;
+};
+
 const Whiteboard = ({ username, room }) => {
     const { t } = useTranslation();
     const canvasRef = useRef(null);
@@ -19,6 +66,27 @@ const Whiteboard = ({ username, room }) => {
             drawLine(context, x0, y0, x1, y1);
         });
 
+        const drawFrame = (frame) => {
+            const context = canvasRef.current.getContext('2d');
+            decodeFrame(frame).forEach(({ style, points }) => {
+                context.beginPath();
+                context.lineWidth = style.width || 5;
+                context.lineCap = 'round';
+                if (style.color) context.strokeStyle = style.color;
+                context.moveTo(points[0][0], points[0][1]);
+                points.forEach(([x, y]) => context.lineTo(x, y));
+                context.stroke();
+            });
+        };
+
+        socket.on('draw_frame', drawFrame);
+
+        // Sent once on join: the compacted board so far plus the frames since
+        socket.on('board_state', ({ snapshot, tail }) => {
+            if (snapshot && snapshot.byteLength) drawFrame(snapshot);
+            tail.forEach(drawFrame);
+        });
+
         return () => {
             socket.emit('leave', { username, room });
             socket.off();